@@ -5,6 +5,9 @@
 This module contains methods to interface with DEAP evolutionary computation
 framewor, including a Genetic Algorithm (GA) based method to solve scaffold
 ordering and orientation problem.
+
+With islands, several populations evolve side by side in their own processes
+and trade their best individuals every few generations, see eaIslands().
 """
 
 import array
@@ -52,6 +55,9 @@ def genome_mutation(candidate):
     locations along the candidate and reverses the values within that
     slice. Insertion is done by popping one item and insert it back at random
     position.
+
+    If the candidate has been scored, the mutant remembers that score along
+    with the window that changed, see `evaluate()`.
     """
     size = len(candidate)
     prob = random.random()
@@ -63,13 +69,19 @@ def genome_mutation(candidate):
         q += 1
         s = candidate[p:q]
         x = candidate[:p] + s[::-1] + candidate[q:]
-        return (creator.Individual(x),)
+        mutant = creator.Individual(x)
+        lo, hi = p, q
     else:  # Insertion
         p = random.randint(0, size - 1)
         q = random.randint(0, size - 1)
+        lo, hi = min(p, q), max(p, q) + 1
+        s = candidate[lo:hi]
         cq = candidate.pop(q)
         candidate.insert(p, cq)
-        return (candidate,)
+        mutant = candidate
+    if candidate.fitness.valid:
+        mutant.move = (candidate.fitness.values, lo, hi, array.array("i", s))
+    return (mutant,)
 
 
 def genome_mutation_orientation(candidate):
@@ -100,6 +112,27 @@ def GA_setup(guess):
     return toolbox
 
 
+def evaluate(toolbox, individuals):
+    """Score the individuals. Mutants of a scored candidate are scored by
+    `toolbox.evaluate_delta(mutant, lo, hi, segment)`, when registered, which
+    returns the change in score given that mutant[lo:hi] used to be segment.
+    All others go through `toolbox.evaluate`.
+    """
+    evaluate_delta = getattr(toolbox, "evaluate_delta", None)
+    full = []
+    for ind in individuals:
+        move = ind.__dict__.pop("move", None)
+        if evaluate_delta is None or move is None:
+            full.append(ind)
+            continue
+        (score,), lo, hi, segment = move
+        ind.fitness.values = (score + evaluate_delta(ind, lo, hi, segment),)
+
+    fitnesses = toolbox.map(toolbox.evaluate, full)
+    for ind, fit in zip(full, fitnesses):
+        ind.fitness.values = fit
+
+
 def eaSimpleConverge(
     population,
     toolbox,
@@ -121,9 +154,7 @@ def eaSimpleConverge(
     """
     # Evaluate the individuals with an invalid fitness
     invalid_ind = [ind for ind in population if not ind.fitness.valid]
-    fitnesses = toolbox.map(toolbox.evaluate, invalid_ind)
-    for ind, fit in zip(invalid_ind, fitnesses):
-        ind.fitness.values = fit
+    evaluate(toolbox, invalid_ind)
 
     if halloffame is not None:
         halloffame.update(population)
@@ -142,9 +173,7 @@ def eaSimpleConverge(
 
         # Evaluate the individuals with an invalid fitness
         invalid_ind = [ind for ind in offspring if not ind.fitness.valid]
-        fitnesses = toolbox.map(toolbox.evaluate, invalid_ind)
-        for ind, fit in zip(invalid_ind, fitnesses):
-            ind.fitness.values = fit
+        evaluate(toolbox, invalid_ind)
 
         # Update the hall of fame with the generated individuals
         if halloffame is not None:
@@ -175,10 +204,170 @@ def eaSimpleConverge(
     return population
 
 
-def GA_run(toolbox, ngen=500, npop=100, seed=666, cpus=1, callback=None):
+# Toolbox of the islands evolving in this process, see eaIslands()
+ISLAND = {}
+
+
+def init_island(toolbox):
+    ISLAND["toolbox"] = toolbox
+
+
+def evolve_island(args):
+    """Evolve one island for a number of generations. The island carries its
+    own random state, so the outcome does not depend on the process it runs
+    in. Returns the population, the random state and the best individuals
+    seen along the way.
+    """
+    population, state, generations, cxpb, mutpb, nbest = args
+    toolbox = ISLAND["toolbox"]
+    if isinstance(state, int):
+        random.seed(state)
+    else:
+        random.setstate(state)
+    hof = tools.HallOfFame(nbest)
+
+    invalid_ind = [ind for ind in population if not ind.fitness.valid]
+    evaluate(toolbox, invalid_ind)
+    hof.update(population)
+    for _ in range(generations):
+        offspring = toolbox.select(population, len(population))
+        offspring = varAnd(offspring, toolbox, cxpb, mutpb)
+        invalid_ind = [ind for ind in offspring if not ind.fitness.valid]
+        evaluate(toolbox, invalid_ind)
+        hof.update(offspring)
+        population[:] = offspring
+
+    return population, random.getstate(), list(hof)
+
+
+def eaIslands(
+    toolbox,
+    islands,
+    npop,
+    cxpb,
+    mutpb,
+    ngen,
+    seed=666,
+    halloffame=None,
+    callback=None,
+    interval=20,
+    migrants=2,
+    cpus=1,
+    verbose=True,
+):
+    """Island model of eaSimpleConverge(). Each of the islands is a population
+    of npop individuals, seeded with seed + i, that evolves for `interval`
+    generations at a time on up to `cpus` processes. In between, the best
+    `migrants` of each island replace the worst of the next one around the
+    ring, and the shared halloffame is updated. Terminates when the best is
+    NOT updated for ngen generations.
+    """
+    if halloffame is None:
+        halloffame = tools.HallOfFame(1)
+    populations = [toolbox.population(n=npop) for _ in range(islands)]
+    states = [seed + i for i in range(islands)]
+    processes = min(cpus, islands)
+    pool = None
+    if processes > 1:
+        pool = multiprocessing.Pool(
+            processes, initializer=init_island, initargs=(toolbox,)
+        )
+        mapper = pool.map
+    else:
+        init_island(toolbox)
+        mapper = map
+
+    gen = 0
+    best = updated = None
+    try:
+        while True:
+            results = list(
+                mapper(
+                    evolve_island,
+                    [
+                        (population, state, interval, cxpb, mutpb, migrants)
+                        for population, state in zip(populations, states)
+                    ],
+                )
+            )
+            populations, states, elites = [list(x) for x in zip(*results)]
+            gen += interval
+            for elite in elites:
+                halloffame.update(elite)
+
+            # Ring migration, the elites of each island replace the worst
+            # individuals of the next
+            for i, elite in enumerate(elites):
+                population = populations[(i + 1) % islands]
+                population.sort(key=lambda ind: ind.fitness.values)
+                population[: len(elite)] = [toolbox.clone(ind) for ind in elite]
+
+            if callback is not None:
+                callback(halloffame[0], gen)
+
+            current_best = halloffame[0].fitness.values
+            if verbose:
+                printf(
+                    "Current iteration {0}: max_score={1}".format(gen, current_best),
+                )
+            if best is None or current_best > best:
+                best = current_best
+                updated = gen
+            if gen - updated > ngen:
+                break
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+    return [ind for population in populations for ind in population]
+
+
+def GA_run(
+    toolbox,
+    ngen=500,
+    npop=100,
+    seed=666,
+    cpus=1,
+    callback=None,
+    pool=None,
+    islands=1,
+    interval=20,
+    migrants=2,
+):
+    """Run GA, scoring on `pool` if given, which is left open for reuse, or on
+    a pool of `cpus` processes created for this run. With more than one
+    island, the islands evolve on their own processes instead, see eaIslands().
+    """
     logger.debug("GA setup: ngen=%d npop=%d cpus=%d seed=%d", ngen, npop, cpus, seed)
-    if cpus > 1:
+    if islands > 1:
+        logger.debug(
+            "GA islands: %d islands, %d migrants every %d generations",
+            islands,
+            migrants,
+            interval,
+        )
+        hof = tools.HallOfFame(1)
+        eaIslands(
+            toolbox,
+            islands,
+            npop,
+            0.7,
+            0.2,
+            ngen,
+            seed=seed,
+            halloffame=hof,
+            callback=callback,
+            interval=interval,
+            migrants=migrants,
+            cpus=cpus,
+        )
+        tour = hof[0]
+        return tour, tour.fitness
+
+    own_pool = pool is None and cpus > 1
+    if own_pool:
         pool = multiprocessing.Pool(cpus)
+    if pool is not None:
         toolbox.register("map", pool.map)
     random.seed(seed)
     pop = toolbox.population(n=npop)
@@ -192,7 +381,7 @@ def GA_run(toolbox, ngen=500, npop=100, seed=666, cpus=1, callback=None):
         pop, toolbox, 0.7, 0.2, ngen, stats=stats, halloffame=hof, callback=callback
     )
     tour = hof[0]
-    if cpus > 1:
+    if own_pool:
         pool.terminate()
     return tour, tour.fitness
 
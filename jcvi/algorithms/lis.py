@@ -5,12 +5,10 @@
 Longest increasing subsequence, code stolen from internet (thanks)
 http://wordaligned.org/articles/patience-sort
 """
-import bisect
 
-# We want a maximum function which accepts a default value
-from functools import partial, reduce
+import bisect
 
-maximum = partial(reduce, max)
+import numpy as np
 
 
 def patience_sort(xs):
@@ -47,17 +45,31 @@ def longest_monotonic_subseq_length(xs):
 
 
 def longest_increasing_subseq_length(xs):
-    """Return the length of the longest increasing subsequence of xs.
+    """Return the length of the longest increasing subsequence of xs. Only the
+    pile tops of the patience sort are tracked. NumPy arrays are accepted.
 
     >>> longest_increasing_subseq_length(range(3))
     3
     >>> longest_increasing_subseq_length([3, 1, 2, 0])
     2
+    >>> longest_increasing_subseq_length(np.array([4, 5, 1, 2, 3]))
+    3
     """
-    return 1 + maximum((pile for x, pile in patience_sort(xs)), -1)
+    if isinstance(xs, np.ndarray):
+        xs = xs.tolist()
+    pile_tops = []
+    for x in xs:
+        pile = bisect.bisect_left(pile_tops, x)
+        if pile == len(pile_tops):
+            pile_tops.append(x)
+        else:
+            pile_tops[pile] = x
+    return len(pile_tops)
 
 
 def longest_decreasing_subseq_length(xs):
+    if isinstance(xs, np.ndarray):
+        xs = xs.tolist()
     return longest_increasing_subseq_length(reversed(xs))
 
 
@@ -143,48 +155,56 @@ def longest_decreasing_subsequence_loose(xs):
     return [x for (x, i) in ll]
 
 
-def backtracking(a, L, bestsofar):
-    """
-    Start with the heaviest weight and emit index
-    """
-    w, j = max(L.items())
-    while j != -1:
-        yield j
-        w, j = bestsofar[j]
-
-
 def heaviest_increasing_subsequence(a, debug=False):
     """
     Returns the heaviest increasing subsequence for array a. Elements are (key,
-    weight) pairs.
+    weight) pairs, keys must be strictly increasing in the subsequence.
+
+    The best weight of a subsequence ending with each element is the weight of
+    the element plus the best weight ending in a smaller key, which is a prefix
+    maximum over the compressed keys, kept in a Fenwick tree for O(n log n).
 
     >>> heaviest_increasing_subsequence([(3, 3), (2, 2), (1, 1), (0, 5)])
     ([(0, 5)], 5)
+    >>> heaviest_increasing_subsequence([(1, 2), (5, 1), (2, 3), (3, 1)])
+    ([(1, 2), (2, 3), (3, 1)], 6)
     """
-    # Stores the smallest idx of last element of a subsequence of weight w
-    L = {0: -1}
+    keys = sorted(set(key for key, weight in a))
+    n = len(keys)
+    tree = [(0, -1)] * (n + 1)  # Fenwick tree of prefix max (best weight, idx)
     bestsofar = [(0, -1)] * len(a)  # (best weight, from_idx)
+    best = (0, -1)
     for i, (key, weight) in enumerate(a):
-
-        for w, j in list(L.items()):
-            if j != -1 and a[j][0] >= key:
-                continue
-
-            new_weight = w + weight
-            if new_weight in L and a[L[new_weight]][0] <= key:
-                continue
-
-            L[new_weight] = i
-            newbest = (new_weight, j)
-            if newbest > bestsofar[i]:
-                bestsofar[i] = newbest
+        rank = bisect.bisect_left(keys, key)
+        # Prefix max over keys strictly smaller than key
+        prev = (0, -1)
+        r = rank
+        while r > 0:
+            if tree[r] > prev:
+                prev = tree[r]
+            r -= r & -r
+        w, j = prev
+        bestsofar[i] = (w + weight, j)
+        if bestsofar[i][0] > best[0]:
+            best = (bestsofar[i][0], i)
+
+        # Update the Fenwick tree at this key
+        entry = (w + weight, i)
+        r = rank + 1
+        while r <= n:
+            if entry > tree[r]:
+                tree[r] = entry
+            r += r & -r
 
         if debug:
-            # print (key, weight), L
             print((key, weight), bestsofar)
 
-    tb = reversed(list(backtracking(a, L, bestsofar)))
-    return [a[x] for x in tb], max(L.items())[0]
+    weight, j = best
+    tb = []
+    while j != -1:
+        tb.append(j)
+        j = bestsofar[j][1]
+    return [a[x] for x in reversed(tb)], weight
 
 
 if __name__ == "__main__":
@@ -192,8 +212,6 @@ if __name__ == "__main__":
 
     doctest.testmod()
 
-    import numpy as np
-
     LENGTH = 20
     A = [np.random.randint(0, 20) for x in range(LENGTH)]
     A = list(A)
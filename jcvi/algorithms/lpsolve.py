@@ -28,6 +28,7 @@ import os.path as op
 
 from dataclasses import dataclass
 from io import StringIO
+from typing import Optional
 from more_itertools import pairwise
 
 import networkx as nx
@@ -61,6 +62,7 @@ class MIPDataModel:
     obj_coeffs: list  # Coefficient in the objective function
     num_vars: int
     num_constraints: int
+    hint: Optional[list] = None  # Initial 0/1 solution to warm start the solver
 
     def format_lp(self) -> str:
         """Format data dictionary into MIP formatted string.
@@ -121,6 +123,9 @@ class MIPDataModel:
             for j, coeff in constraint_coeff.items():
                 constraint.SetCoefficient(x[j], coeff)
 
+        if self.hint:
+            solver.SetHint([x[j] for j in range(self.num_vars)], self.hint)
+
         self.log()
 
         objective = solver.Objective()
@@ -149,6 +149,7 @@ class ScaffoldOO(object):
         npop=100,
         cpus=8,
         seed=666,
+        islands=1,
     ):
 
         self.lgs = lgs
@@ -201,7 +202,13 @@ class ScaffoldOO(object):
             toolbox = GA_setup(tour)
             toolbox.register("evaluate", colinear_evaluate_multi, scfs=scfs, weights=ww)
             tour, fitness = GA_run(
-                toolbox, ngen=ngen, npop=npop, cpus=cpus, seed=seed, callback=callbacki
+                toolbox,
+                ngen=ngen,
+                npop=npop,
+                cpus=cpus,
+                seed=seed,
+                callback=callbacki,
+                islands=islands,
             )
             tour = callbacki(tour, "FIN")
             if best_fitness and fitness <= best_fitness:
@@ -1422,6 +1429,12 @@ def path(args):
         "--npop", default=100, type=int, help="Population size in GA, higher ~ slower"
     )
     q.add_argument("--seed", default=666, type=int, help="Random seed number")
+    q.add_argument(
+        "--islands",
+        default=1,
+        type=int,
+        help="Populations evolving in parallel, with migration of the best",
+    )
     opts, args, iopts = p.set_image_options(args, figsize="10x6")
 
     if len(args) != 2:
@@ -1564,6 +1577,7 @@ def path(args):
             npop=npop,
             cpus=cpus,
             seed=seed,
+            islands=opts.islands,
         )
 
         solutions.append(s)
@@ -12,6 +12,18 @@ Support three versions with different objective functions:
   plus the actual link distances. Maximize Sum(1 / distance) for all links.
   For performance consideration, we actually use a histogram to approximate
   all link distances. See golden_array() in hic for details.
+
+The matrices are sparse, with the links of each contig in CSR layout (see
+CLMFile.M, .P and .Q in hic), so each contig only visits the contigs it has
+links with.
+
+The score_delta_* functions give the change in score for a local move (flip,
+removal or a shuffle within a window) by visiting only the links of the
+contigs involved, rather than scoring the whole tour again.
+
+anneal_M() is a local search on the same objective as score_evaluate_M,
+using segment reversals (2-opt) and single contig moves (Or-opt) scored
+by their delta, with simulated annealing and restarts.
 """
 
 from __future__ import division
@@ -19,10 +31,12 @@ import numpy as np
 cimport numpy as np
 cimport cython
 from cpython cimport array
+from libc.math cimport exp, log
 import array
 
 
-ctypedef np.int INT
+ctypedef np.int64_t INT
+ctypedef np.int32_t IDX
 DEF LIMIT = 10000000
 DEF BB = 12
 cdef int *GR = \
@@ -31,75 +45,490 @@ cdef int *GR = \
        271443,  439204,  710647, 1149851]
 
 
+cdef np.ndarray[IDX, ndim=1] tour_positions(array.array[int] tour, int N):
+    """Position of each contig in the tour, -1 for contigs not in the tour"""
+    cdef np.ndarray[IDX, ndim=1] pos = np.full(N, -1, dtype=np.int32)
+    cdef int ia
+    for ia in range(len(tour)):
+        pos[tour[ia]] = ia
+    return pos
+
+
+def tour_layout(array.array[int] tour, np.ndarray[INT, ndim=1] tour_sizes=None):
+    """Contig positions and cumulative sizes along the tour, as used by
+    score_evaluate_P() and score_evaluate_Q()
+    """
+    return tour_positions(tour, len(tour_sizes)), np.cumsum(tour_sizes[tour])
+
+
 def score_evaluate_M(array.array[int] tour,
                      np.ndarray[INT, ndim=1] tour_sizes=None,
-                     np.ndarray[INT, ndim=2] tour_M=None):
+                     tour_M=None):
+    """tour_M is a CSR matrix of links between contigs"""
     cdef np.ndarray[INT, ndim=1] sizes_oo = tour_sizes[tour]
     cdef np.ndarray[INT, ndim=1] sizes_cum = np.cumsum(sizes_oo) - sizes_oo // 2
+    cdef IDX[:] indptr = tour_M.indptr
+    cdef IDX[:] indices = tour_M.indices
+    cdef INT[:] data = tour_M.data
+    cdef np.ndarray[IDX, ndim=1] pos = tour_positions(tour, len(indptr) - 1)
 
     cdef double s = 0.0
     cdef int size = len(tour)
-    cdef int a, b, ia, ib
-    cdef int links
+    cdef int a, ia, ib, k
     cdef double dist
     for ia in range(size):
         a = tour[ia]
-        for ib in range(ia + 1, size):
-            b = tour[ib]
-            links = tour_M[a, b]
-            if links == 0:
+        for k in range(indptr[a], indptr[a + 1]):
+            ib = pos[indices[k]]
+            if ib <= ia:
                 continue
             dist = sizes_cum[ib] - sizes_cum[ia]
             if dist > LIMIT:
-                break
-            s += links / dist
+                continue
+            s += data[k] / dist
     return s,
 
 
 def score_evaluate_P(array.array[int] tour,
                      np.ndarray[INT, ndim=1] tour_sizes=None,
-                     np.ndarray[INT, ndim=3] tour_P=None):
+                     tour_P=None):
+    """tour_P is a PairStore of (links, harmonic mean distance) per pair"""
     cdef np.ndarray[INT, ndim=1] sizes_oo = tour_sizes[tour]
     cdef np.ndarray[INT, ndim=1] sizes_cum = np.cumsum(sizes_oo)
+    cdef IDX[:] indptr = tour_P.indptr
+    cdef IDX[:] indices = tour_P.indices
+    cdef INT[:, :] data = tour_P.data
+    cdef np.ndarray[IDX, ndim=1] pos = tour_positions(tour, len(indptr) - 1)
 
     cdef double s = 0.0
     cdef int size = len(tour)
-    cdef int a, b, c, ia, ib
+    cdef int a, c, ia, ib, k
     cdef double dist
     for ia in range(size):
         a = tour[ia]
-        for ib in range(ia + 1, size):
-            b = tour[ib]
+        for k in range(indptr[a], indptr[a + 1]):
+            ib = pos[indices[k]]
+            if ib <= ia:
+                continue
             dist = sizes_cum[ib - 1] - sizes_cum[ia]
             if dist > LIMIT:
-                break
-            c = tour_P[a, b, 0]
+                continue
+            c = data[k, 0]
             if c == 0:
                 continue
-            s += c / (tour_P[a, b, 1] + dist)
+            s += c / (data[k, 1] + dist)
     return s,
 
 
 def score_evaluate_Q(array.array[int] tour,
                      np.ndarray[INT, ndim=1] tour_sizes=None,
-                     np.ndarray[INT, ndim=3] tour_Q=None):
+                     tour_Q=None):
+    """tour_Q is a PairStore of link distance histograms per oriented pair"""
     cdef np.ndarray[INT, ndim=1] sizes_oo = tour_sizes[tour]
     cdef np.ndarray[INT, ndim=1] sizes_cum = np.cumsum(sizes_oo)
+    cdef IDX[:] indptr = tour_Q.indptr
+    cdef IDX[:] indices = tour_Q.indices
+    cdef IDX[:, :] data = tour_Q.data
+    cdef np.ndarray[IDX, ndim=1] pos = tour_positions(tour, len(indptr) - 1)
 
     cdef double s = 0.0
+    cdef int a, c, ia, ib, ic, k
     cdef int size = len(tour)
-    cdef int a, b, c, ia, ib, ic
     cdef double dist
     for ia in range(size):
         a = tour[ia]
-        for ib in range(ia + 1, size):
-            b = tour[ib]
-            if tour_Q[a, b, 0] == -1:
+        for k in range(indptr[a], indptr[a + 1]):
+            ib = pos[indices[k]]
+            if ib <= ia:
                 continue
             dist = sizes_cum[ib - 1] - sizes_cum[ia]
             if dist > LIMIT:
-                break
+                continue
             for ic in range(BB):
-                c = tour_Q[a, b, ic]
+                c = data[k, ic]
                 s += c / (GR[ic] + dist)
     return s,
+
+
+def score_delta_M(array.array[int] tour, int lo, int hi,
+                  array.array[int] segment,
+                  np.ndarray[INT, ndim=1] tour_sizes=None,
+                  tour_M=None):
+    """Change in score_evaluate_M() when tour[lo:hi] used to be segment, a
+    permutation of the same contigs. Only the links of contigs in the window
+    are visited, since distances between contigs outside of it are unchanged.
+    """
+    cdef np.ndarray[INT, ndim=1] sizes_oo = tour_sizes[tour]
+    cdef np.ndarray[INT, ndim=1] cum_new = np.cumsum(sizes_oo) - sizes_oo // 2
+    old = array.array("i", tour)
+    old[lo:hi] = segment
+    sizes_oo = tour_sizes[old]
+    cdef np.ndarray[INT, ndim=1] cum_old = np.cumsum(sizes_oo) - sizes_oo // 2
+    cdef IDX[:] indptr = tour_M.indptr
+    cdef IDX[:] indices = tour_M.indices
+    cdef INT[:] data = tour_M.data
+    cdef int N = len(indptr) - 1
+    cdef np.ndarray[IDX, ndim=1] pos_new = tour_positions(tour, N)
+    cdef np.ndarray[IDX, ndim=1] pos_old = tour_positions(old, N)
+
+    cdef double s = 0.0
+    cdef int a, b, ia, ib, k
+    cdef double dist
+    for ia in range(lo, hi):
+        a = tour[ia]
+        for k in range(indptr[a], indptr[a + 1]):
+            b = indices[k]
+            ib = pos_new[b]
+            if ib < 0 or (lo <= ib < hi and b < a):  # Count pairs once
+                continue
+            dist = abs(cum_new[ib] - cum_new[ia])
+            if dist <= LIMIT:
+                s += data[k] / dist
+            dist = abs(cum_old[pos_old[b]] - cum_old[pos_old[a]])
+            if dist <= LIMIT:
+                s -= data[k] / dist
+    return s
+
+
+def score_delta_remove_M(array.array[int] tour,
+                         np.ndarray[INT, ndim=1] tour_sizes=None,
+                         tour_M=None):
+    """Drop in score_evaluate_M() from removing each contig in the tour, by
+    position. Removing a contig takes away its own links and brings closer
+    the linked pairs on either side of it.
+    """
+    cdef np.ndarray[INT, ndim=1] sizes_oo = tour_sizes[tour]
+    cdef np.ndarray[INT, ndim=1] sizes_cum = np.cumsum(sizes_oo) - sizes_oo // 2
+    cdef IDX[:] indptr = tour_M.indptr
+    cdef IDX[:] indices = tour_M.indices
+    cdef INT[:] data = tour_M.data
+    cdef np.ndarray[IDX, ndim=1] pos = tour_positions(tour, len(indptr) - 1)
+
+    cdef int size = len(tour)
+    cdef np.ndarray[double, ndim=1] deltas = np.zeros(size)
+    cdef INT max_size = sizes_oo.max() if size else 0
+    cdef int a, ia, ib, ic, k
+    cdef double dist, dist_removed, before, after
+    for ia in range(size):
+        a = tour[ia]
+        for k in range(indptr[a], indptr[a + 1]):
+            ib = pos[indices[k]]
+            if ib <= ia:
+                continue
+            dist = sizes_cum[ib] - sizes_cum[ia]
+            before = data[k] / dist if dist <= LIMIT else 0
+            deltas[ia] += before
+            deltas[ib] += before
+            if dist - max_size > LIMIT:  # Out of reach for any removal
+                continue
+            for ic in range(ia + 1, ib):
+                dist_removed = dist - sizes_oo[ic]
+                after = data[k] / dist_removed if dist_removed <= LIMIT else 0
+                deltas[ic] += before - after
+    return deltas
+
+
+cdef double oriented_score(IDX[:, :, :] data, int k, int o, double dist):
+    """Score of the k-th pair in orientation o, 0 if never seen that way"""
+    cdef double s = 0.0
+    cdef int ic
+    if data[k, o, 0] == -1:
+        return 0
+    for ic in range(BB):
+        s += data[k, o, ic] / (GR[ic] + dist)
+    return s
+
+
+def score_delta_flip_Q(int t,
+                       np.ndarray[IDX, ndim=1] pos,
+                       np.ndarray[INT, ndim=1] sizes_cum,
+                       np.ndarray[INT, ndim=1] signs,
+                       tour_Q4=None):
+    """Change in score_evaluate_Q() from flipping contig t, on the tour given
+    by tour_layout(). tour_Q4 has the distance histograms of each directed pair
+    in all four orientations, at 2 * (a is +) + (b is +).
+    """
+    cdef IDX[:] indptr = tour_Q4.indptr
+    cdef IDX[:] indices = tour_Q4.indices
+    cdef IDX[:, :, :] data = tour_Q4.data
+
+    cdef double s = 0.0
+    cdef int b, ia, ib, k, st, sb
+    cdef double dist
+    ia = pos[t]
+    st = signs[t] == 1
+    for k in range(indptr[t], indptr[t + 1]):
+        b = indices[k]
+        ib = pos[b]
+        if ib < 0:
+            continue
+        sb = signs[b] == 1
+        if ia < ib:
+            dist = sizes_cum[ib - 1] - sizes_cum[ia]
+            if dist > LIMIT:
+                continue
+            s += oriented_score(data, k, 2 * (1 - st) + sb, dist)
+            s -= oriented_score(data, k, 2 * st + sb, dist)
+        else:
+            # Pair (b, t) seen as (b+, t+) is the same links as (t-, b-)
+            dist = sizes_cum[ia - 1] - sizes_cum[ib]
+            if dist > LIMIT:
+                continue
+            s += oriented_score(data, k, 2 * st + (1 - sb), dist)
+            s -= oriented_score(data, k, 2 * (1 - st) + (1 - sb), dist)
+    return s
+
+
+cdef inline unsigned long long xorshift(unsigned long long *state):
+    cdef unsigned long long x = state[0]
+    x ^= x << 13
+    x ^= x >> 7
+    x ^= x << 17
+    state[0] = x
+    return x
+
+
+cdef inline double uniform(unsigned long long *state):
+    return (xorshift(state) >> 11) * (1.0 / 9007199254740992.0)
+
+
+cdef inline int randint(unsigned long long *state, int n):
+    return <int>(xorshift(state) % <unsigned long long>n)
+
+
+cdef class TourAnnealer:
+    """
+    Tour under local search. Keeps the contig at each position, the position
+    of each contig and the cumulative sizes along the tour, and updates them
+    within the window of every accepted move. A move is first proposed, which
+    fills in the new mid-points of the contigs in its window, and scored by
+    delta() before it is applied.
+    """
+    cdef IDX[:] indptr
+    cdef IDX[:] indices
+    cdef INT[:] data
+    cdef INT[:] sizes
+    cdef int n
+    cdef int[:] order
+    cdef IDX[:] pos
+    cdef INT[:] ends
+    cdef INT[:] newmid
+    cdef IDX[:] stamp
+    cdef int move_id
+    cdef unsigned long long rng
+    cdef public double score
+
+    def __init__(self, array.array[int] tour,
+                 np.ndarray[INT, ndim=1] tour_sizes, tour_M, seed=666):
+        cdef int N = len(tour_sizes)
+        self.indptr = tour_M.indptr
+        self.indices = tour_M.indices
+        self.data = tour_M.data
+        self.sizes = tour_sizes
+        self.n = len(tour)
+        self.order = array.array("i", tour)
+        self.pos = np.full(N, -1, dtype=np.int32)
+        self.ends = np.zeros(self.n, dtype=np.int64)
+        self.newmid = np.zeros(N, dtype=np.int64)
+        self.stamp = np.zeros(N, dtype=np.int32)
+        self.move_id = 0
+        self.rng = <unsigned long long>seed * 2685821657736338717ULL + 1
+        self.relayout(0, self.n)
+        self.score = score_evaluate_M(tour, tour_sizes, tour_M)[0]
+
+    @property
+    def tour(self):
+        return array.array("i", self.order)
+
+    cdef void relayout(self, int lo, int hi):
+        cdef INT end = self.ends[lo - 1] if lo > 0 else 0
+        cdef int i, x
+        for i in range(lo, hi):
+            x = self.order[i]
+            end += self.sizes[x]
+            self.ends[i] = end
+            self.pos[x] = i
+
+    cdef double delta(self, int lo, int hi):
+        """Change in score once the contigs in tour[lo:hi] move to newmid"""
+        cdef double s = 0.0
+        cdef double dist
+        cdef INT mid_a, mid_b, new_b
+        cdef int a, b, ia, k
+        for ia in range(lo, hi):
+            a = self.order[ia]
+            mid_a = self.ends[ia] - self.sizes[a] // 2
+            for k in range(self.indptr[a], self.indptr[a + 1]):
+                b = self.indices[k]
+                if self.pos[b] < 0:
+                    continue
+                mid_b = self.ends[self.pos[b]] - self.sizes[b] // 2
+                new_b = mid_b
+                if self.stamp[b] == self.move_id:
+                    if b < a:  # Count pairs once
+                        continue
+                    new_b = self.newmid[b]
+                dist = self.newmid[a] - new_b
+                if dist < 0:
+                    dist = -dist
+                if dist <= LIMIT:
+                    s += self.data[k] / dist
+                dist = mid_a - mid_b
+                if dist < 0:
+                    dist = -dist
+                if dist <= LIMIT:
+                    s -= self.data[k] / dist
+        return s
+
+    cdef double propose_reverse(self, int lo, int hi):
+        """Reverse tour[lo:hi]"""
+        cdef INT start = self.ends[lo - 1] if lo > 0 else 0
+        cdef INT end = self.ends[hi - 1]
+        cdef int i, x
+        self.move_id += 1
+        for i in range(lo, hi):
+            x = self.order[i]
+            self.newmid[x] = start + end - self.ends[i] + \
+                self.sizes[x] - self.sizes[x] // 2
+            self.stamp[x] = self.move_id
+        return self.delta(lo, hi)
+
+    cdef void apply_reverse(self, int lo, int hi):
+        cdef int i = lo, j = hi - 1, x
+        while i < j:
+            x = self.order[i]
+            self.order[i] = self.order[j]
+            self.order[j] = x
+            i += 1
+            j -= 1
+        self.relayout(lo, hi)
+
+    cdef double propose_move(self, int q, int p):
+        """Take out the contig at q and put it back at p"""
+        cdef int x = self.order[q], y, i
+        cdef INT sx = self.sizes[x]
+        self.move_id += 1
+        if q < p:
+            for i in range(q + 1, p + 1):
+                y = self.order[i]
+                self.newmid[y] = self.ends[i] - sx - self.sizes[y] // 2
+                self.stamp[y] = self.move_id
+            self.newmid[x] = self.ends[p] - sx // 2
+            self.stamp[x] = self.move_id
+            return self.delta(q, p + 1)
+        for i in range(p, q):
+            y = self.order[i]
+            self.newmid[y] = self.ends[i] + sx - self.sizes[y] // 2
+            self.stamp[y] = self.move_id
+        self.newmid[x] = (self.ends[p - 1] if p > 0 else 0) + sx - sx // 2
+        self.stamp[x] = self.move_id
+        return self.delta(p, q + 1)
+
+    cdef void apply_move(self, int q, int p):
+        cdef int x = self.order[q], i
+        if q < p:
+            for i in range(q, p):
+                self.order[i] = self.order[i + 1]
+            self.order[p] = x
+            self.relayout(q, p + 1)
+        else:
+            for i in range(q, p, -1):
+                self.order[i] = self.order[i - 1]
+            self.order[p] = x
+            self.relayout(p, q + 1)
+
+    cdef double propose(self, int window, int *move):
+        """Random reversal or contig move spanning at most window contigs"""
+        cdef int n = self.n, w = max(2, min(window, n))
+        cdef int lo = randint(&self.rng, n - 1), hi
+        move[0] = randint(&self.rng, 2)
+        if move[0] == 0:
+            hi = min(lo + 2 + randint(&self.rng, w - 1), n)
+            move[1], move[2] = lo, hi
+            return self.propose_reverse(lo, hi)
+        hi = lo + 1 + randint(&self.rng, w - 1)
+        if hi >= n:
+            hi = n - 1
+        if randint(&self.rng, 2):
+            lo, hi = hi, lo
+        move[1], move[2] = lo, hi
+        return self.propose_move(lo, hi)
+
+    cdef void apply(self, int *move):
+        if move[0] == 0:
+            self.apply_reverse(move[1], move[2])
+        else:
+            self.apply_move(move[1], move[2])
+
+    def temperature(self, int window, int samples=1000):
+        """Starting temperature, at which a typical move that lowers the
+        score is accepted with probability 1/e
+        """
+        cdef int move[3]
+        cdef double d, s = 0.0
+        cdef int i, worse = 0
+        if self.n < 2:
+            return 0
+        for i in range(samples):
+            d = self.propose(window, move)
+            if d < 0:
+                s -= d
+                worse += 1
+        return s / worse if worse else 0
+
+    def anneal(self, long iterations, double t0, double t1, int window,
+               callback=None, long every=0):
+        """One annealing run, cooling geometrically from t0 to t1. Returns the
+        number of accepted moves. callback(step) is called every so many steps.
+        """
+        cdef int move[3]
+        cdef long step, accepted = 0
+        cdef double d, t = t0
+        cdef double cooling = exp(log(t1 / t0) / iterations) if t0 > 0 else 1
+        if self.n < 2:
+            return 0
+        for step in range(iterations):
+            d = self.propose(window, move)
+            if d > 0 or (t > 0 and uniform(&self.rng) < exp(d / t)):
+                self.apply(move)
+                self.score += d
+                accepted += 1
+            t *= cooling
+            if callback is not None and every and (step + 1) % every == 0:
+                callback(step + 1)
+        return accepted
+
+
+def anneal_M(array.array[int] tour,
+             np.ndarray[INT, ndim=1] tour_sizes=None,
+             tour_M=None, long iterations=0, int restarts=3, int window=50,
+             int seed=666, callback=None, int checkpoints=10):
+    """
+    Maximize score_evaluate_M() by simulated annealing. Each restart reheats
+    from the best tour so far, and the result is kept if it scores higher.
+    callback(tour, restart, step, score) is called a number of times during
+    each restart, and again at the end of it. Returns the best tour and its
+    score.
+    """
+    cdef int n = len(tour)
+    if iterations <= 0:
+        iterations = 100 * n * max(1, min(window, n))
+    best = tour
+    best_score = score_evaluate_M(tour, tour_sizes, tour_M)[0]
+    for restart in range(restarts):
+        annealer = TourAnnealer(best, tour_sizes, tour_M, seed=seed + restart)
+        t0 = annealer.temperature(window)
+        report = None
+        if callback is not None:
+            report = lambda step: callback(annealer.tour, restart, step,
+                                           annealer.score)
+        annealer.anneal(iterations, t0, t0 * 1e-4, window, callback=report,
+                        every=max(1, iterations // checkpoints))
+        # Rescore from scratch so the running sum of deltas does not drift
+        candidate = annealer.tour
+        score = score_evaluate_M(candidate, tour_sizes, tour_M)[0]
+        if score > best_score:
+            best, best_score = candidate, score
+        if callback is not None:
+            callback(best, restart, iterations, best_score)
+    return best, best_score
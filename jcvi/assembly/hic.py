@@ -13,12 +13,15 @@ import sys
 
 from collections import defaultdict
 from functools import partial
+from itertools import chain, islice
 from multiprocessing import Pool
-from typing import List, Optional, Tuple
+from tempfile import mkdtemp
+from typing import List, NamedTuple, Optional, Tuple
 
 import numpy as np
 
 from natsort import natsorted
+from scipy.sparse import coo_matrix, csr_matrix, diags, issparse, load_npz, save_npz
 
 from ..algorithms.ec import GA_run, GA_setup
 from ..algorithms.formula import outlier_cutoff
@@ -27,9 +30,11 @@ from ..apps.base import (
     ActionDispatcher,
     OptionParser,
     backup,
+    cleanup,
     iglob,
     logger,
     mkdir,
+    need_update,
     symlink,
 )
 from ..apps.grid import Jobs
@@ -108,6 +113,100 @@ class ContigOrdering(LineFile):
         )
 
 
+class PairStore(NamedTuple):
+    """
+    Per-pair vectors among N contigs, laid out like a CSR matrix whose cells
+    are rows of `data`, so that only pairs with links take up space.
+    """
+
+    indptr: np.ndarray
+    indices: np.ndarray
+    data: np.ndarray
+
+    @property
+    def N(self):
+        return len(self.indptr) - 1
+
+    def toarray(self, fill=0):
+        """Dense N x N x K equivalent, with `fill` in the empty cells."""
+        N = self.N
+        A = np.full((N, N) + self.data.shape[1:], fill, dtype=self.data.dtype)
+        rows = np.repeat(np.arange(N), np.diff(self.indptr))
+        A[rows, self.indices] = self.data
+        return A
+
+
+def csr_layout(rows, cols, N):
+    """
+    CSR layout of the given cells among N contigs. Returns indptr, indices and
+    the positions of the values to pick, which for repeated cells is the last
+    one, as successive assignments into a dense matrix would keep.
+
+    >>> indptr, indices, pick = csr_layout(np.array([1, 0, 1]), np.array([0, 1, 0]), 2)
+    >>> indptr.tolist(), indices.tolist(), pick.tolist()
+    ([0, 1, 2], [1, 0], [1, 2])
+    """
+    cells = rows * N + cols
+    cells, first = np.unique(cells[::-1], return_index=True)
+    pick = len(rows) - 1 - first
+    indptr = np.zeros(N + 1, dtype=np.int32)
+    np.cumsum(np.bincount(cells // N, minlength=N), out=indptr[1:])
+    return indptr, (cells % N).astype(np.int32), pick
+
+
+def interleave(a, b):
+    """Pairs (a, b) followed by (b, a), one after the other."""
+    return np.column_stack((a, b)).ravel()
+
+
+class SharedContacts:
+    """
+    Tour sizes and the CSR arrays of the M matrix, saved as .npy files that
+    pool workers memory-map, so that tours are scored without the matrix being
+    pickled to them. Only `spec`, the file names, is sent along with tasks.
+    """
+
+    def __init__(self, tour_sizes, tour_M):
+        self.dirname = mkdtemp(prefix="contacts-")
+        arrays = {
+            "tour_sizes": tour_sizes,
+            "indptr": tour_M.indptr,
+            "indices": tour_M.indices,
+            "data": tour_M.data,
+        }
+        spec = []
+        for name, a in arrays.items():
+            filename = op.join(self.dirname, name + ".npy")
+            np.save(filename, a)
+            spec.append(filename)
+        self.spec = tuple(spec)
+
+    def close(self):
+        cleanup(self.dirname)
+
+
+# Shared contacts mapped in this worker, keyed by spec
+ATTACHED = {}
+
+
+def attach_contacts(spec):
+    """Tour sizes and M from the files in spec, mapped once per spec"""
+    if spec not in ATTACHED:
+        ATTACHED.clear()  # Contacts of an earlier phase
+        # Copy-on-write keeps the buffers writable, as chic expects
+        tour_sizes, indptr, indices, data = [np.load(x, mmap_mode="c") for x in spec]
+        ATTACHED[spec] = (tour_sizes, PairStore(indptr, indices, data))
+    return ATTACHED[spec]
+
+
+def score_evaluate_M_shared(tour, spec=None):
+    """score_evaluate_M() against contacts shared through SharedContacts"""
+    from .chic import score_evaluate_M
+
+    tour_sizes, tour_M = attach_contacts(spec)
+    return score_evaluate_M(tour, tour_sizes, tour_M)
+
+
 class CLMFile:
     """CLM file (modified) has the following format:
 
@@ -121,12 +220,12 @@ class CLMFile:
     tig00030676- tig00077819-       5       108422 157204 157204 137924 142611
     """
 
-    def __init__(self, clmfile, skiprecover=False):
+    def __init__(self, clmfile, skiprecover=False, cache=True):
         self.name = op.basename(clmfile).rsplit(".", 1)[0]
         self.clmfile = clmfile
         self.idsfile = clmfile.rsplit(".", 1)[0] + ".ids"
         self.parse_ids(skiprecover)
-        self.parse_clm()
+        self.parse_clm(cache=cache)
         self.signs = None
 
     def parse_ids(self, skiprecover):
@@ -160,40 +259,148 @@ class CLMFile:
         # Initially all contigs are considered active
         self.active = set(_tigs)
 
-    def parse_clm(self):
-        clmfile = self.clmfile
-        logger.debug("Parse clmfile `%s`", clmfile)
-        fp = open(clmfile)
-        contacts = {}
-        contacts_oriented = defaultdict(dict)
-        orientations = defaultdict(list)
-        for row in fp:
-            atoms = row.strip().split("\t")
-            assert len(atoms) == 3, "Malformed line `{}`".format(atoms)
-            abtig, links, dists = atoms
-            atig, btig = abtig.split()
-            at, ao = atig[:-1], atig[-1]
-            bt, bo = btig[:-1], btig[-1]
-            if at not in self.tig_to_size:
-                continue
-            if bt not in self.tig_to_size:
-                continue
-            dists = [int(x) for x in dists.split()]
-            contacts[(at, bt)] = len(dists)
-            gdists = golden_array(dists)
-            contacts_oriented[(at, bt)][(FF[ao], FF[bo])] = gdists
-            contacts_oriented[(bt, at)][(RR[bo], RR[ao])] = gdists
-            strandedness = 1 if ao == bo else -1
-            orientations[(at, bt)].append((strandedness, dists))
-
-        self.contacts = contacts
-        self.contacts_oriented = contacts_oriented
-        # Preprocess the orientations dict
-        for (at, bt), dists in orientations.items():
-            dists = [(s, d, hmean_int(d)) for (s, d) in dists]
-            strandedness, md, mh = min(dists, key=lambda x: x[-1])
-            orientations[(at, bt)] = (strandedness, len(md), mh)
-        self.orientations = orientations
+    @property
+    def active(self):
+        return self._active
+
+    @active.setter
+    def active(self, contigs):
+        """Any change to the active contigs invalidates the cached matrices."""
+        self._active = contigs
+        self._cache = {}
+
+    def cached(self, name, build):
+        if name not in self._cache:
+            self._cache[name] = build()
+        return self._cache[name]
+
+    @property
+    def cachefile(self):
+        return self.clmfile + ".npz"
+
+    def parse_clm(self, cache=True):
+        """
+        Parse the CLM file with compile_clm(), or load the arrays from
+        `cachefile` when it is newer than the CLM file. The cache holds all
+        the lines, so it serves any ids file.
+        """
+        clmfile, cachefile = self.clmfile, self.cachefile
+        if cache and not need_update(clmfile, cachefile):
+            with np.load(cachefile, allow_pickle=False) as data:
+                lines = dict(data)
+            logger.debug("CLM cache loaded from `%s`", cachefile)
+        else:
+            logger.debug("Parse clmfile `%s`", clmfile)
+            lines = compile_clm(clmfile)
+            if cache:
+                np.savez(cachefile, **lines)
+                logger.debug("CLM cache written to `%s`", cachefile)
+        self.pairs = self.compile_pairs(lines)
+
+    def compile_pairs(self, lines):
+        """
+        Contacts, orientations and oriented contacts as arrays over contig
+        pairs, from the lines of compile_clm(), with contigs numbered by their
+        order in the ids file. Pairs are listed in the order they first appear
+        in the CLM file, and a later line for the same pair overrides an
+        earlier one, except for the orientation, which is the one with the
+        smallest harmonic mean of distances. These are subset to the active
+        contigs by the matrices below.
+        """
+        tig_to_gidx = dict((x, i) for (i, x) in enumerate(self.tig_to_size))
+        G = len(tig_to_gidx)
+        gidx = np.array(
+            [tig_to_gidx.get(x, -1) for x in lines["names"].tolist()], dtype=int
+        )
+        a, b = gidx[lines["a"]], gidx[lines["b"]]
+        keep = (a >= 0) & (b >= 0)
+        a, b = a[keep], b[keep]
+        ao, bo = lines["ao"][keep], lines["bo"][keep]
+        links, golden, hmean = (
+            lines["links"][keep],
+            lines["golden"][keep],
+            lines["hmean"][keep],
+        )
+
+        keys = a * G + b
+        first, last, rank = first_appearance(keys)
+        ca, cb = a[first], b[first]
+
+        # First line with the smallest harmonic mean for each pair
+        order = np.lexsort((np.arange(len(keys)), hmean, rank))
+        best = order[np.r_[True, np.diff(rank[order]) != 0]]
+        strandedness = np.where(ao == bo, 1, -1)
+        orientations = np.column_stack((strandedness[best], links[best], hmean[best]))
+
+        # Distances for the four orientations of a directed pair, at positions
+        # 2 * (ao == 1) + (bo == 1), with -1 for the ones not seen. Each line
+        # gives (a, b) as written and (b, a) with both contigs reversed.
+        minus = ord("-")
+        qkeys = interleave(keys, b * G + a)
+        slots = interleave(
+            2 * (ao != minus) + (bo != minus), 2 * (bo == minus) + (ao == minus)
+        )
+        rows = np.repeat(np.arange(len(keys)), 2)
+        qfirst, _, qrank = first_appearance(qkeys)
+        qa, qb = a[rows[qfirst]], b[rows[qfirst]]
+        swapped = qfirst % 2 == 1
+        qa[swapped], qb[swapped] = qb[swapped], qa[swapped]
+        cells = 4 * qrank + slots
+        _, clast, _ = first_appearance(cells)
+        qdata = np.full((len(qa) * 4, BB), -1, dtype=np.int32)
+        qdata[cells[clast]] = golden[rows[clast]]
+
+        return {
+            "tig_to_gidx": tig_to_gidx,
+            "contacts": (ca, cb, links[last]),
+            "orientations": (a[best], b[best], orientations),
+            "oriented": (qa, qb, qdata.reshape(-1, 4, BB)),
+        }
+
+    @property
+    def contacts(self):
+        """Number of links of each pair of contigs, keyed by contig names"""
+
+        def build():
+            tigs = list(self.tig_to_size)
+            a, b, links = self.pairs["contacts"]
+            return dict(
+                ((tigs[x], tigs[y]), z)
+                for x, y, z in zip(a.tolist(), b.tolist(), links.tolist())
+            )
+
+        return self.cached("contacts", build)
+
+    @property
+    def orientations(self):
+        """(strandedness, links, harmonic mean distance) of each pair"""
+
+        def build():
+            tigs = list(self.tig_to_size)
+            a, b, values = self.pairs["orientations"]
+            return dict(
+                ((tigs[x], tigs[y]), tuple(z))
+                for x, y, z in zip(a.tolist(), b.tolist(), values.tolist())
+            )
+
+        return self.cached("orientations", build)
+
+    @property
+    def contacts_oriented(self):
+        """golden_array() of the distances of each pair in each orientation"""
+
+        def build():
+            tigs = list(self.tig_to_size)
+            a, b, qdata = self.pairs["oriented"]
+            contacts_oriented = defaultdict(dict)
+            for x, y, q in zip(a.tolist(), b.tolist(), qdata):
+                for o in range(4):
+                    if q[o, 0] >= 0:
+                        ao, bo = (1 if o >= 2 else -1), (1 if o % 2 else -1)
+                        contacts_oriented[(tigs[x], tigs[y])][(ao, bo)] = q[o]
+            return contacts_oriented
+
+        return self.cached("contacts_oriented", build)
 
     def calculate_densities(self):
         """
@@ -201,21 +408,20 @@ class CLMFile:
         considered to have high level of inter-contig links in the current
         partition.
         """
-        active = self.active
-        densities = defaultdict(int)
-        for (at, bt), links in self.contacts.items():
-            if not (at in active and bt in active):
-                continue
-            densities[at] += links
-            densities[bt] += links
-
-        logdensities = {}
-        for x, d in densities.items():
-            s = self.tig_to_size[x]
-            logd = np.log10(d * 1.0 / min(s, 500000))
-            logdensities[x] = logd
-
-        return logdensities
+        tig_to_gidx = self.pairs["tig_to_gidx"]
+        G = len(tig_to_gidx)
+        active = np.zeros(G, dtype=bool)
+        active[[tig_to_gidx[x] for x in self.active]] = True
+        a, b, links = self.pairs["contacts"]
+        keep = active[a] & active[b]
+        ab = np.concatenate((a[keep], b[keep]))
+        densities = np.bincount(ab, weights=np.tile(links[keep], 2), minlength=G)
+        seen = np.flatnonzero(np.bincount(ab, minlength=G))
+
+        tigs = list(self.tig_to_size)
+        sizes = np.array([self.tig_to_size[tigs[i]] for i in seen])
+        logd = np.log10(densities[seen] / np.minimum(sizes, 500000))
+        return dict((tigs[i], d) for i, d in zip(seen.tolist(), logd.tolist()))
 
     def report_active(self):
         logger.debug("Active contigs: %d (length=%d)", self.N, self.active_sizes.sum())
@@ -317,7 +523,7 @@ class CLMFile:
             (score,) = self.evaluate_tour_Q(tour)
 
         # Remember we cannot have ambiguous orientation code (0 or '?') here
-        self.signs = get_signs(self.O, validate=False, ambiguous=False)
+        self.signs = get_signs(self.O.toarray(), validate=False, ambiguous=False)
         (score_flipped,) = self.evaluate_tour_Q(tour)
         if score_flipped >= score:
             tag = ACCEPT
@@ -342,20 +548,23 @@ class CLMFile:
 
     def flip_one(self, tour):
         """Test flipping every single contig sequentially to see if score
-        improves.
+        improves. Each flip is scored by its change on the links of that contig.
         """
+        from .chic import score_delta_flip_Q, tour_layout
+
+        pos, sizes_cum = tour_layout(tour, self.active_sizes)
+        Q4 = self.Q4
         n_accepts = n_rejects = 0
         any_tag_ACCEPT = False
+        (score,) = self.evaluate_tour_Q(tour)
         for i, t in enumerate(tour):
-            if i == 0:
-                (score,) = self.evaluate_tour_Q(tour)
-            self.signs[t] = -self.signs[t]
-            (score_flipped,) = self.evaluate_tour_Q(tour)
-            if score_flipped > score:
+            delta = score_delta_flip_Q(t, pos, sizes_cum, self.signs, Q4)
+            score_flipped = score + delta
+            if delta > 0:
+                self.signs[t] = -self.signs[t]
                 n_accepts += 1
                 tag = ACCEPT
             else:
-                self.signs[t] = -self.signs[t]
                 n_rejects += 1
                 tag = REJECT
             self.flip_log(
@@ -370,28 +579,19 @@ class CLMFile:
         logger.debug("FLIPONE: N_accepts=%d N_rejects=%d", n_accepts, n_rejects)
         return ACCEPT if any_tag_ACCEPT else REJECT
 
-    def prune_tour(self, tour, cpus):
+    def prune_tour(self, tour):
         """Test deleting each contig and check the delta_score; tour here must
         be an array of ints.
         """
+        from .chic import score_delta_remove_M
+
         while True:
             (tour_score,) = self.evaluate_tour_M(tour)
             logger.debug("Starting score: %d", tour_score)
-            active_sizes = self.active_sizes
-            M = self.M
-            args = []
-            for i, t in enumerate(tour):
-                stour = tour[:i] + tour[i + 1 :]
-                args.append((t, stour, tour_score, active_sizes, M))
-
-            # Parallel run
-            p = Pool(processes=cpus)
-            results = list(p.imap(prune_tour_worker, args))
-            assert len(tour) == len(
-                results
-            ), "Array size mismatch, tour({}) != results({})".format(
-                len(tour), len(results)
-            )
+            deltas = score_delta_remove_M(tour, self.active_sizes, self.M)
+            results = [
+                (t, np.log10(d) if d > 1e-9 else -9) for (t, d) in zip(tour, deltas)
+            ]
 
             # Identify outliers
             active_contigs = self.active_contigs
@@ -416,11 +616,14 @@ class CLMFile:
 
     @property
     def active_contigs(self):
-        return list(self.active)
+        return self.cached("active_contigs", lambda: list(self.active))
 
     @property
     def active_sizes(self):
-        return np.array([self.tig_to_size[x] for x in self.active])
+        return self.cached(
+            "active_sizes",
+            lambda: np.array([self.tig_to_size[x] for x in self.active_contigs]),
+        )
 
     @property
     def N(self):
@@ -432,42 +635,64 @@ class CLMFile:
 
     @property
     def tig_to_idx(self):
-        return dict((x, i) for (i, x) in enumerate(self.active))
+        return self.cached(
+            "tig_to_idx", lambda: dict((x, i) for (i, x) in enumerate(self.active))
+        )
+
+    def active_pairs(self, kind):
+        """Pairs of the given kind among active contigs, as active indices."""
+        a, b, values = self.pairs[kind]
+
+        def build():
+            tig_to_gidx = self.pairs["tig_to_gidx"]
+            idx = np.full(len(tig_to_gidx), -1, dtype=int)
+            idx[[tig_to_gidx[x] for x in self.active_contigs]] = np.arange(self.N)
+            return idx
+
+        idx = self.cached("active_idx", build)
+        a, b = idx[a], idx[b]
+        keep = (a >= 0) & (b >= 0)
+        return a[keep], b[keep], values[keep]
+
+    def symmetric_pairs(self, kind, values):
+        """
+        CSR layout for pairs of the given kind among active contigs, filled in
+        both directions. `values` picks what goes into the cells.
+        """
+        a, b, v = self.active_pairs(kind)
+        N = self.N
+        indptr, indices, pick = csr_layout(interleave(a, b), interleave(b, a), N)
+        v = np.repeat(values(v), 2, axis=0)[pick]
+        return indptr, indices, v
 
     @property
     def M(self):
         """
-        Contact frequency matrix. Each cell contains how many inter-contig
-        links between i-th and j-th contigs.
+        Contact frequency matrix, as a sparse CSR matrix. Each cell contains
+        how many inter-contig links between i-th and j-th contigs.
         """
-        N = self.N
-        tig_to_idx = self.tig_to_idx
-        M = np.zeros((N, N), dtype=int)
-        for (at, bt), links in self.contacts.items():
-            if not (at in tig_to_idx and bt in tig_to_idx):
-                continue
-            ai = tig_to_idx[at]
-            bi = tig_to_idx[bt]
-            M[ai, bi] = M[bi, ai] = links
-        return M
+
+        def build():
+            indptr, indices, links = self.symmetric_pairs("contacts", lambda x: x)
+            return csr_matrix((links, indices, indptr), shape=(self.N, self.N))
+
+        return self.cached("M", build)
 
     @property
     def O(self):
         """
-        Pairwise strandedness matrix. Each cell contains whether i-th and j-th
-        contig are the same orientation +1, or opposite orientation -1.
+        Pairwise strandedness matrix, as a sparse CSR matrix. Each cell
+        contains whether i-th and j-th contig are the same orientation +1, or
+        opposite orientation -1.
         """
-        N = self.N
-        tig_to_idx = self.tig_to_idx
-        O = np.zeros((N, N), dtype=int)
-        for (at, bt), (strandedness, md, mh) in self.orientations.items():
-            if not (at in tig_to_idx and bt in tig_to_idx):
-                continue
-            ai = tig_to_idx[at]
-            bi = tig_to_idx[bt]
-            score = strandedness * md
-            O[ai, bi] = O[bi, ai] = score
-        return O
+
+        def build():
+            indptr, indices, scores = self.symmetric_pairs(
+                "orientations", lambda x: x[:, 0] * x[:, 1]
+            )
+            return csr_matrix((scores, indices, indptr), shape=(self.N, self.N))
+
+        return self.cached("O", build)
 
     @property
     def P(self):
@@ -477,39 +702,56 @@ class CLMFile:
         between mid-points of two contigs. In matrix Q, however, we compute
         harmonic mean of the links for the orientation configuration that is
         shortest. This offers better precision for the distance between big
-        contigs.
+        contigs. Stored as a `PairStore` of (links, harmonic mean) per pair.
+        """
+        return self.cached(
+            "P",
+            lambda: PairStore(
+                *self.symmetric_pairs("orientations", lambda x: x[:, 1:])
+            ),
+        )
+
+    @property
+    def Q4(self):
+        """
+        Distance histograms of each directed pair of contigs, in all four
+        orientations at 2 * (a is +) + (b is +), with -1 for the orientations
+        never seen. Lets flip_one() score a flip without rebuilding Q.
         """
-        N = self.N
-        tig_to_idx = self.tig_to_idx
-        P = np.zeros((N, N, 2), dtype=int)
-        for (at, bt), (strandedness, md, mh) in self.orientations.items():
-            if not (at in tig_to_idx and bt in tig_to_idx):
-                continue
-            ai = tig_to_idx[at]
-            bi = tig_to_idx[bt]
-            P[ai, bi, 0] = P[bi, ai, 0] = md
-            P[ai, bi, 1] = P[bi, ai, 1] = mh
-        return P
+
+        def build():
+            a, b, qdata = self.active_pairs("oriented")
+            indptr, indices, pick = csr_layout(a, b, self.N)
+            return PairStore(indptr, indices, qdata[pick])
+
+        return self.cached("Q4", build)
 
     @property
     def Q(self):
         """
         Contact frequency matrix when contigs are already oriented. This is s a
         similar matrix as M, but rather than having the number of links in the
-        cell, it points to an array that has the actual distances.
+        cell, it points to an array that has the actual distances. Stored as a
+        `PairStore` of the distance histograms, and rebuilt only when the
+        active contigs or their signs change.
         """
-        N = self.N
-        tig_to_idx = self.tig_to_idx
         signs = self.signs
-        Q = np.ones((N, N, BB), dtype=int) * -1  # Use -1 as the sentinel
-        for (at, bt), k in self.contacts_oriented.items():
-            if not (at in tig_to_idx and bt in tig_to_idx):
-                continue
-            ai = tig_to_idx[at]
-            bi = tig_to_idx[bt]
-            ao = signs[ai]
-            bo = signs[bi]
-            Q[ai, bi] = k[(ao, bo)]
+        key = signs.tobytes()
+        cached = self._cache.get("Q")
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
+        Q4 = self.Q4
+        rows = np.repeat(np.arange(self.N), np.diff(Q4.indptr))
+        cols = Q4.indices
+        qdata = Q4.data[
+            np.arange(len(cols)), 2 * (signs[rows] == 1) + (signs[cols] == 1)
+        ]
+        seen = qdata[:, 0] != -1
+        indptr = np.zeros(self.N + 1, dtype=np.int32)
+        np.cumsum(np.bincount(rows[seen], minlength=self.N), out=indptr[1:])
+        Q = PairStore(indptr, cols[seen], qdata[seen])
+        self._cache["Q"] = (key, Q)
         return Q
 
 
@@ -520,6 +762,106 @@ def hmean_int(a, a_min=5778, a_max=1149851):
     return int(round(hmean(np.clip(a, a_min, a_max))))
 
 
+def first_appearance(keys):
+    """
+    Distinct keys in the order they first appear. Returns the positions of
+    the first and the last occurrence of each, and the rank of every key.
+
+    >>> first, last, rank = first_appearance(np.array([5, 3, 5, 7, 3]))
+    >>> first.tolist(), last.tolist(), rank.tolist()
+    ([0, 1, 3], [2, 4, 3], [0, 1, 0, 2, 1])
+    """
+    _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    last = len(keys) - 1 - np.unique(keys[::-1], return_index=True)[1]
+    order = np.argsort(first)
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    return first[order], last[order], rank[inverse.ravel()]
+
+
+def compile_clm(clmfile, chunksize=100000):
+    """
+    Parse the CLM file into arrays with one entry per line: the two contigs
+    as indices into `names`, their orientation characters, the number of
+    links, and the golden_array() and hmean_int() of the link distances. The
+    distances are parsed in bulk, chunksize lines at a time.
+    """
+    index = {}
+    chunks = []
+    fp = open(clmfile)
+    while True:
+        rows = list(islice(fp, chunksize))
+        if not rows:
+            break
+        tigs, dists = [], []
+        for row in rows:
+            atoms = row.strip().split("\t")
+            assert len(atoms) == 3, "Malformed line `{}`".format(atoms)
+            abtig, links, d = atoms
+            atig, btig = abtig.split()
+            at = index.setdefault(atig[:-1], len(index))
+            bt = index.setdefault(btig[:-1], len(index))
+            tigs.append((at, bt, ord(atig[-1]), ord(btig[-1])))
+            dists.append(d)
+
+        values = np.fromstring(" ".join(dists), dtype=np.int64, sep=" ")
+        counts = np.fromiter((x.count(" ") + 1 for x in dists), int, len(dists))
+        if counts.sum() != len(values):  # Irregular spacing
+            counts = np.array([len(x.split()) for x in dists])
+        lines = np.repeat(np.arange(len(rows)), counts)
+        tigs = np.array(tigs, dtype=np.int64).reshape(-1, 4)
+        chunks.append(
+            (
+                tigs[:, 0],
+                tigs[:, 1],
+                tigs[:, 2],
+                tigs[:, 3],
+                counts,
+                golden_arrays(values, lines, len(rows)),
+                hmean_ints(values, lines, len(rows)),
+            )
+        )
+    fp.close()
+
+    fields = ("a", "b", "ao", "bo", "links", "golden", "hmean")
+    dtypes = (np.int32, np.int32, np.uint8, np.uint8, np.int64, np.int32, np.int64)
+    clm = {"names": np.array(list(index), dtype=str)}
+    for i, (field, dtype) in enumerate(zip(fields, dtypes)):
+        arrays = [x[i] for x in chunks]
+        if not arrays:
+            arrays = [np.zeros((0, BB) if field == "golden" else 0)]
+        clm[field] = np.concatenate(arrays).astype(dtype)
+    return clm
+
+
+def hmean_ints(dists, lines, nlines, a_min=5778, a_max=1149851):
+    """
+    hmean_int() of many lists at once, given all their values in `dists` and
+    the list each value belongs to in `lines`.
+    """
+    counts = np.bincount(lines, minlength=nlines)
+    inverse = np.bincount(
+        lines, weights=1.0 / np.clip(dists, a_min, a_max), minlength=nlines
+    )
+    return np.rint(1.0 / (inverse / counts)).astype(int)
+
+
+def golden_arrays(dists, lines, nlines, phi=1.61803398875, lb=LB, ub=UB):
+    """
+    golden_array() of many lists at once, see hmean_ints(). Returns one row of
+    counts per list. The bins are found by searching the distances against
+    the midpoints phi ^ (k + 0.5) between the powers of phi.
+
+    >>> golden_arrays(np.array([1000, 7349, 7350, 10**7]), np.array([0, 0, 1, 1]), 2)
+    array([[2, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0],
+           [0, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1]])
+    """
+    breaks = phi ** (np.arange(lb, ub) + 0.5)
+    c = np.searchsorted(breaks, dists, side="right")
+    counts = np.bincount(lines * BB + c, minlength=nlines * BB)
+    return counts.reshape(nlines, BB)
+
+
 def golden_array(a, phi=1.61803398875, lb=LB, ub=UB):
     """Given list of ints, we aggregate similar values so that it becomes an
     array of multiples of phi, where phi is the golden ratio.
@@ -532,26 +874,8 @@ def golden_array(a, phi=1.61803398875, lb=LB, ub=UB):
     discussion here:
     <https://www.johndcook.com/blog/2017/03/22/golden-powers-are-nearly-integers/>
     """
-    counts = np.zeros(BB, dtype=int)
-    for x in a:
-        c = int(round(math.log(x, phi)))
-        if c < lb:
-            c = lb
-        if c > ub:
-            c = ub
-        counts[c - lb] += 1
-    return counts
-
-
-def prune_tour_worker(arg):
-    """Worker thread for CLMFile.prune_tour()"""
-    from .chic import score_evaluate_M
-
-    t, stour, tour_score, active_sizes, M = arg
-    (stour_score,) = score_evaluate_M(stour, active_sizes, M)
-    delta_score = tour_score - stour_score
-    log10d = np.log10(delta_score) if delta_score > 1e-9 else -9
-    return t, log10d
+    a = np.asarray(a, dtype=int)
+    return golden_arrays(a, np.zeros(len(a), dtype=int), 1, phi=phi, lb=lb, ub=ub)[0]
 
 
 def main():
@@ -564,14 +888,16 @@ def main():
         ("simulate", "simulate CLM data"),
         # Scaffolding
         ("optimize", "optimize the contig order and orientation"),
+        ("optimizeall", "optimize many partitions in parallel"),
         ("density", "estimate link density of contigs"),
         # Plotting
         ("movieframe", "plot heatmap and synteny for a particular tour"),
         ("movie", "plot heatmap optimization history in a tourfile"),
         # Reference-based analytics
-        ("bam2mat", "convert bam file to .npy format used in plotting"),
-        ("mergemat", "combine counts from multiple .npy data files"),
-        ("heatmap", "plot heatmap based on .npy file"),
+        ("bam2mat", "convert bam file to .npz format used in plotting"),
+        ("pyramid", "store .npz counts at several resolutions for plotting"),
+        ("mergemat", "combine counts from multiple .npz or .npy data files"),
+        ("heatmap", "plot heatmap based on .npz or .npy file or pyramid"),
         ("dist", "plot distance distribution based on .dist.npy file"),
     )
     p = ActionDispatcher(actions)
@@ -695,22 +1021,32 @@ def read_matrix(
     vmin: int,
     vmax: int,
     plot_breaks: bool,
+    maxbins: int = 1000,
 ):
     """
-    Read the matrix from the npy file and apply log transformation and thresholding.
+    Read the matrix from the npz or npy file and apply log transformation and
+    thresholding. From a pyramid, only the region to plot is read, at the
+    finest zoom with at most `maxbins` bins. Also returns that zoom, which is
+    1 otherwise.
     """
-    # Load the matrix
-    A = np.load(npyfile)
     total_bins = header["total_bins"]
-
-    # Select specific submatrix
     if contig:
-        contig_start = header["starts"][contig]
-        contig_size = header["sizes"][contig]
-        contig_end = contig_start + contig_size
-        A = A[contig_start:contig_end, contig_start:contig_end]
+        start = header["starts"][contig]
+        end = start + header["sizes"][contig]
+    else:
+        start, end = 0, total_bins
+
+    # Load the matrix and select specific submatrix
+    if op.isdir(npyfile):
+        contacts = ContactPyramid(npyfile)
+        zoom = contacts.zoom_for(end - start, maxbins)
+        A = contacts.tile(start, end, zoom)
+        logger.debug("Read bins %d-%d at zoom %d", start, end, zoom)
     else:
-        A = A[:total_bins, :total_bins]
+        zoom = 1
+        A = load_contacts(npyfile)[start:end, start:end]
+        if issparse(A):
+            A = A.toarray()
 
     # Convert seqids to positions for each group
     new_groups = []
@@ -728,8 +1064,8 @@ def read_matrix(
         for seqid in seqids:
             seqid_start = header["starts"][seqid]
             seqid_size = header["sizes"][seqid]
-            position_seqids.append((seqid_start + seqid_size / 2, seqid))
-        new_groups.append((start, end, position_seqids, color))
+            position_seqids.append(((seqid_start + seqid_size / 2) / zoom, seqid))
+        new_groups.append((start / zoom, end / zoom, position_seqids, color))
 
     # Several concerns in practice:
     # The diagonal counts may be too strong, this can either be resolved by
@@ -744,11 +1080,11 @@ def read_matrix(
 
     breaks = list(header["starts"].values())
     breaks += [total_bins]  # This is actually discarded
-    breaks = sorted(breaks)[1:]
+    breaks = [x / zoom for x in sorted(breaks)[1:]]
     if contig or not plot_breaks:
         breaks = []
 
-    return B, new_groups, breaks
+    return B, new_groups, breaks, zoom
 
 
 def draw_hic_heatmap(
@@ -762,13 +1098,15 @@ def draw_hic_heatmap(
     vmin: int,
     vmax: int,
     plot_breaks: bool,
+    maxbins: int = 1000,
 ):
     """
-    Draw heatmap based on .npy file. The .npy file stores a square matrix with
+    Draw heatmap based on .npz or .npy file, which stores a square matrix with
     bins of genome, and cells inside the matrix represent number of links
     between bin i and bin j. The `genome.json` contains the offsets of each
     contig/chr so that we know where to draw boundary lines, or extract per
-    contig/chromosome heatmap.
+    contig/chromosome heatmap. A pyramid is drawn at the finest zoom with at
+    most `maxbins` bins.
     """
     groups = list(generate_groups(groups_file)) if groups_file else []
 
@@ -778,10 +1116,10 @@ def draw_hic_heatmap(
     assert resolution is not None, "`resolution` not found in `{}`".format(jsonfile)
     logger.debug("Resolution set to %d", resolution)
 
-    B, new_groups, breaks = read_matrix(
-        npyfile, header, contig, groups, vmin, vmax, plot_breaks
+    B, new_groups, breaks, zoom = read_matrix(
+        npyfile, header, contig, groups, vmin, vmax, plot_breaks, maxbins=maxbins
     )
-    plot_heatmap(ax, B, breaks, groups=new_groups, binsize=resolution)
+    plot_heatmap(ax, B, breaks, groups=new_groups, binsize=resolution * zoom)
 
     # Title
     if contig:
@@ -800,13 +1138,13 @@ def draw_hic_heatmap(
 
 def heatmap(args):
     """
-    %prog heatmap input.npy genome.json
+    %prog heatmap input.npz genome.json
 
-    Plot heatmap based on .npy data file. The .npy stores a square matrix with
-    bins of genome, and cells inside the matrix represent number of links
-    between bin i and bin j. The `genome.json` contains the offsets of each
-    contig/chr so that we know where to draw boundary lines, or extract per
-    contig/chromosome heatmap.
+    Plot heatmap based on .npz (or .npy) data file, which stores a square
+    matrix with bins of genome, and cells inside the matrix represent number
+    of links between bin i and bin j. The `genome.json` contains the offsets
+    of each contig/chr so that we know where to draw boundary lines, or
+    extract per contig/chromosome heatmap.
 
     If a 'groups' file is given (with --groups), we will draw squares on the
     heatmap. The 'groups' file has the following format, for example:
@@ -817,6 +1155,9 @@ def heatmap(args):
 
     This will first draw a square around seq1+seq2 with blue color, then seq1
     and seq2 individually with green color.
+
+    Instead of input.npz, a pyramid built with `pyramid` only reads the region
+    to plot, at the finest zoom that fits in --maxbins.
     """
     p = OptionParser(heatmap.__doc__)
     p.add_argument("--title", help="Title of the heatmap")
@@ -830,6 +1171,12 @@ def heatmap(args):
         action="store_true",
         help="Do not plot breaks (esp. if contigs are small)",
     )
+    p.add_argument(
+        "--maxbins",
+        default=1000,
+        type=int,
+        help="Most bins across when plotting from a pyramid",
+    )
     opts, args, iopts = p.set_image_options(
         args, figsize="11x11", style="white", cmap="coolwarm", dpi=120
     )
@@ -854,9 +1201,10 @@ def heatmap(args):
         vmin=opts.vmin,
         vmax=opts.vmax,
         plot_breaks=not opts.nobreaks,
+        maxbins=opts.maxbins,
     )
 
-    pf = npyfile.rsplit(".", 1)[0]
+    pf = npyfile.rstrip("/").rsplit(".", 1)[0]
     image_name = pf + "." + iopts.format
     # macOS sometimes has way too verbose output
     savefig(image_name, dpi=iopts.dpi, iopts=iopts)
@@ -864,9 +1212,11 @@ def heatmap(args):
 
 def mergemat(args):
     """
-    %prog mergemat *.npy
+    %prog mergemat *.npz
 
-    Combine counts from multiple .npy data files.
+    Combine counts from multiple .npz or .npy data files. The result is sparse
+    if any of the inputs is. Pyramids are combined level by level into
+    out.pyramid.
     """
     p = OptionParser(mergemat.__doc__)
     p.set_outfile(outfile="out")
@@ -876,16 +1226,169 @@ def mergemat(args):
         sys.exit(not p.print_help())
 
     npyfiles = args
-    A = np.load(npyfiles[0])
+    if all(op.isdir(x) for x in npyfiles):
+        pyramids = [ContactPyramid(x) for x in npyfiles]
+        dirname = opts.outfile + ".pyramid"
+        ContactPyramid.merge(pyramids, dirname)
+        logger.debug("Combined %d pyramids into `%s`", len(npyfiles), dirname)
+        return
+
+    A = load_contacts(npyfiles[0])
     logger.debug("Load `%s`: matrix of shape %s; sum=%d", npyfiles[0], A.shape, A.sum())
     for npyfile in npyfiles[1:]:
-        B = np.load(npyfile)
+        B = load_contacts(npyfile)
+        if issparse(A) != issparse(B):
+            A, B = csr_matrix(A), csr_matrix(B)
         A += B
         logger.debug("Load `%s`: sum=%d", npyfiles[0], A.sum())
 
     pf = opts.outfile
-    np.save(pf, A)
-    logger.debug("Combined %d files into `%s.npy`", len(npyfiles), pf)
+    if issparse(A):
+        save_npz(pf, A)
+        logger.debug("Combined %d files into `%s.npz`", len(npyfiles), pf)
+    else:
+        np.save(pf, A)
+        logger.debug("Combined %d files into `%s.npy`", len(npyfiles), pf)
+
+
+def load_contacts(filename):
+    """
+    Load the contact matrix written by bam2mat or mergemat, sparse from .npz
+    or a pyramid, or dense from .npy.
+    """
+    if op.isdir(filename):
+        return ContactPyramid(filename).level(1)
+    if filename.endswith(".npz"):
+        return load_npz(filename).tocsr()
+    return np.load(filename)
+
+
+def coarsen(A, factor=2):
+    """
+    Sum the counts of every factor x factor block of bins.
+
+    >>> coarsen(csr_matrix(np.arange(9).reshape(3, 3))).toarray().tolist()
+    [[8, 7], [13, 8]]
+    """
+    A = A.tocoo()
+    shape = tuple(-(-x // factor) for x in A.shape)
+    A = coo_matrix((A.data, (A.row // factor, A.col // factor)), shape=shape)
+    return A.tocsr()
+
+
+class ContactPyramid:
+    """
+    Contact matrix stored at several zoom levels, from the full resolution
+    up, each coarsened from the previous by summing blocks of 2x2 bins. The
+    levels are CSR arrays saved as .npy files in a directory and memory-mapped
+    on load, so that a tile only reads the rows it covers.
+    """
+
+    def __init__(self, dirname):
+        self.dirname = dirname
+        with open(op.join(dirname, "pyramid.json")) as fp:
+            header = json.load(fp)
+        self.shape = tuple(header["shape"])
+        self.zooms = header["zooms"]
+
+    def filename(self, zoom, name):
+        return op.join(self.dirname, "zoom_{}.{}.npy".format(zoom, name))
+
+    @classmethod
+    def write(cls, levels, dirname):
+        """Save the levels, a list of (zoom, CSR matrix) from zoom 1 up"""
+        mkdir(dirname)
+        with open(op.join(dirname, "pyramid.json"), "w") as fw:
+            json.dump(
+                {"shape": levels[0][1].shape, "zooms": [x for x, _ in levels]}, fw
+            )
+        contacts = cls(dirname)
+        for zoom, A in levels:
+            for name in ("indptr", "indices", "data"):
+                np.save(contacts.filename(zoom, name), getattr(A, name))
+        return contacts
+
+    @classmethod
+    def build(cls, A, dirname, minbins=1000):
+        """Coarsen A until it has at most minbins bins across"""
+        A = csr_matrix(A)
+        levels = [(1, A)]
+        while max(A.shape) > minbins:
+            A = coarsen(A)
+            levels.append((levels[-1][0] * 2, A))
+        return cls.write(levels, dirname)
+
+    @classmethod
+    def merge(cls, pyramids, dirname):
+        """Sum the counts of pyramids of the same shape, level by level"""
+        if len(set((x.shape, tuple(x.zooms)) for x in pyramids)) > 1:
+            raise ValueError("Pyramids differ in shape or zoom levels")
+        zooms = pyramids[0].zooms
+        levels = [(zoom, sum(x.level(zoom) for x in pyramids)) for zoom in zooms]
+        return cls.write(levels, dirname)
+
+    def arrays(self, zoom):
+        return [
+            np.load(self.filename(zoom, name), mmap_mode="r")
+            for name in ("indptr", "indices", "data")
+        ]
+
+    def level(self, zoom):
+        indptr, indices, data = self.arrays(zoom)
+        n = -(-self.shape[0] // zoom)
+        return csr_matrix((data, indices, indptr), shape=(n, n))
+
+    def zoom_for(self, nbins, maxbins):
+        """Finest zoom with at most maxbins across nbins, else the coarsest"""
+        for zoom in self.zooms:
+            if -(-nbins // zoom) <= maxbins:
+                return zoom
+        return self.zooms[-1]
+
+    def tile(self, start, end, zoom, cstart=None, cend=None):
+        """
+        Dense counts between bins start-end and cstart-cend (same as the rows
+        if not given) at the given zoom. The bins are at full resolution.
+        """
+        if cstart is None:
+            cstart, cend = start, end
+        r0, r1 = start // zoom, -(-end // zoom)
+        c0, c1 = cstart // zoom, -(-cend // zoom)
+        indptr, indices, data = self.arrays(zoom)
+        lo, hi = indptr[r0], indptr[r1]
+        rows = csr_matrix(
+            (data[lo:hi], indices[lo:hi], indptr[r0 : r1 + 1] - lo),
+            shape=(r1 - r0, len(indptr) - 1),
+        )
+        return rows[:, c0:c1].toarray()
+
+
+def pyramid(args):
+    """
+    %prog pyramid input.npz
+
+    Store the counts from bam2mat at several resolutions, halving the number
+    of bins until at most --minbins remain. The levels go to the directory
+    input.pyramid, which heatmap and mergemat take in place of input.npz.
+    """
+    p = OptionParser(pyramid.__doc__)
+    p.add_argument(
+        "--minbins",
+        default=1000,
+        type=int,
+        help="Stop coarsening at this number of bins across",
+    )
+    opts, args = p.parse_args(args)
+
+    if len(args) != 1:
+        sys.exit(not p.print_help())
+
+    (npzfile,) = args
+    dirname = npzfile.rsplit(".", 1)[0] + ".pyramid"
+    contacts = ContactPyramid.build(
+        load_contacts(npzfile), dirname, minbins=opts.minbins
+    )
+    logger.debug("Zoom levels %s written to `%s`", contacts.zooms, dirname)
 
 
 def get_seqstarts(bamfile, N, seqids=None):
@@ -924,16 +1427,116 @@ def get_distbins(start=100, bins=2000, ratio=1.01):
     return bins, binsizes
 
 
+# Flags of the reads skipped by bam2mat, rules borrowed from LACHESIS
+# https://github.com/shendurelab/LACHESIS/blob/master/src/GenomeLinkMatrix.cc#L1476
+BAM_PAIRED = 0x1
+BAM_READ2 = 0x80
+BAM_QCFAIL_DUP = 0x200 | 0x400
+BAM_SECONDARY_SUPPLEMENTARY = 0x100 | 0x800
+
+
+def iter_bam_chunks(records, chunksize=1000000):
+    """
+    Batches of reads as int64 arrays of flag, mapping quality, reference id,
+    position, mate reference id and mate position, one column per read.
+    """
+    rows = []
+    for c in records:
+        rows.append(
+            (
+                c.flag,
+                c.mapping_quality,
+                c.reference_id,
+                c.reference_start,
+                c.next_reference_id,
+                c.next_reference_start,
+            )
+        )
+        if len(rows) == chunksize:
+            yield np.array(rows, dtype=np.int64).T
+            rows = []
+    if rows:
+        yield np.array(rows, dtype=np.int64).T
+
+
+def count_contacts(chunk, tid_starts, N, total_bins, minsize=100, bins=1500):
+    """
+    Count the read pairs in a chunk from iter_bam_chunks(). `tid_starts` has
+    the first bin of each reference id, -1 for those left out, and an extra -1
+    at the end for the unmapped. Returns the links from the bin of each read
+    to the bin of its mate as a sparse matrix, the histogram of link
+    distances within the same reference, and the number of pairs counted.
+    """
+    flag, mapq, atid, apos, btid, bpos = chunk
+    keep = (
+        ((flag & BAM_QCFAIL_DUP) != BAM_QCFAIL_DUP)
+        & ((flag & BAM_SECONDARY_SUPPLEMENTARY) != BAM_SECONDARY_SUPPLEMENTARY)
+        & (mapq != 0)
+        & ((flag & BAM_PAIRED) != 0)
+        & ((flag & BAM_READ2) == 0)
+    )
+    astart, bstart = tid_starts[atid], tid_starts[btid]
+    keep &= (astart >= 0) & (bstart >= 0)
+    dist = np.abs(apos - bpos)
+    same = atid == btid
+    keep &= ~same | (dist >= minsize)
+
+    same &= keep
+    db = np.rint(np.log(dist[same] / minsize) / np.log(1.01)).astype(int)
+    B = np.bincount(db[db < bins], minlength=bins)
+
+    abin = astart[keep] + apos[keep] // N
+    bbin = bstart[keep] + bpos[keep] // N
+    k = len(abin)
+    C = coo_matrix(
+        (np.ones(k, dtype=np.int64), (abin, bbin)), shape=(total_bins, total_bins)
+    ).tocsr()
+    return C, B, k
+
+
+def count_bam_contacts(args):
+    """
+    Count the contacts of the reads on the given references, or of all reads
+    in the bam file if None, see count_contacts().
+    """
+    import pysam
+
+    bamfilename, references, seqstarts, N, total_bins, chunksize = args
+    bamfile = pysam.AlignmentFile(bamfilename, "rb")
+    tid_starts = np.array(
+        [seqstarts.get(x, -1) for x in bamfile.references] + [-1], dtype=np.int64
+    )
+    if references is None:
+        records = bamfile
+    else:
+        records = chain.from_iterable(bamfile.fetch(x) for x in references)
+
+    C = csr_matrix((total_bins, total_bins), dtype=np.int64)
+    B = 0
+    j = k = 0
+    for chunk in iter_bam_chunks(records, chunksize=chunksize):
+        c, b, kc = count_contacts(chunk, tid_starts, N, total_bins)
+        C += c
+        B += b
+        j += chunk.shape[1]
+        k += kc
+        logger.debug("%d reads counted", j)
+    bamfile.close()
+    return C, B, j, k
+
+
 def bam2mat(args):
     """
     %prog bam2mat input.bam
 
-    Convert bam file to .mat format, which is simply numpy 2D array. Important
-    parameter is the resolution, which is the cell size. Small cell size lead
-    to more fine-grained heatmap, but leads to large .mat size and slower
-    plotting.
+    Convert bam file to .npz format, which is a sparse 2D matrix of link
+    counts. Important parameter is the resolution, which is the cell size.
+    Small cell size lead to more fine-grained heatmap, but leads to a larger
+    matrix and slower plotting.
+
+    With --cpus, the references are counted in parallel, which requires the
+    bam file to be indexed.
     """
-    import pysam
     from jcvi.utils.cbook import percentage
 
     p = OptionParser(bam2mat.__doc__)
@@ -947,6 +1550,13 @@ def bam2mat(args):
         "--seqids",
         help="Use a given seqids file, a single line with seqids joined by comma",
     )
+    p.add_argument(
+        "--chunksize",
+        default=1000000,
+        type=int,
+        help="Reads counted at a time",
+    )
+    p.set_cpus(cpus=1)
     opts, args = p.parse_args(args)
 
     if len(args) != 1:
@@ -994,61 +1604,34 @@ def bam2mat(args):
 
     print(sorted(seqstarts.items(), key=lambda x: x[-1]))
     logger.debug("Initialize matrix of size %dx%d", total_bins, total_bins)
-    A = np.zeros((total_bins, total_bins), dtype=int)
-    B = np.zeros(bins, dtype=int)
-
-    # Find the bin ID of each read
-    def bin_number(chr, pos):
-        return seqstarts[chr] + pos // N
-
-    def distbin_number(dist, start=minsize, ratio=1.01):
-        return int(round(math.log(dist * 1.0 / start, ratio)))
-
-    bamfile = pysam.AlignmentFile(bamfilename, "rb")
-    # Check all reads, rules borrowed from LACHESIS
-    # https://github.com/shendurelab/LACHESIS/blob/master/src/GenomeLinkMatrix.cc#L1476
-    j = k = 0
-    for c in bamfile:
-        j += 1
-        if j % 100000 == 0:
-            print("{} reads counted".format(j), file=sys.stderr)
-
-        if c.is_qcfail and c.is_duplicate:
-            continue
-        if c.is_secondary and c.is_supplementary:
-            continue
-        if c.mapping_quality == 0:
-            continue
-        if not c.is_paired:
-            continue
-        if c.is_read2:  # Take only one read
-            continue
-
-        # pysam v0.8.3 does not support keyword reference_name
-        achr = bamfile.getrname(c.reference_id)
-        apos = c.reference_start
-        bchr = bamfile.getrname(c.next_reference_id)
-        bpos = c.next_reference_start
-        if achr not in seqstarts or bchr not in seqstarts:
-            continue
-        if achr == bchr:
-            dist = abs(apos - bpos)
-            if dist < minsize:
-                continue
-            db = distbin_number(dist)
-            B[db] += 1
-
-        abin, bbin = bin_number(achr, apos), bin_number(bchr, bpos)
-        A[abin, bbin] += 1
-        if abin != bbin:
-            A[bbin, abin] += 1
+    seqstarts = dict((x, int(y)) for x, y in seqstarts.items())
+    cpus = opts.cpus
+    if cpus > 1:
+        # Each read is fetched with the reference it is placed on
+        tasks = [
+            (bamfilename, [x], seqstarts, N, total_bins, opts.chunksize)
+            for x in seqstarts
+        ]
+        with Pool(cpus) as pool:
+            counts = list(pool.imap_unordered(count_bam_contacts, tasks))
+    else:
+        counts = [
+            count_bam_contacts(
+                (bamfilename, None, seqstarts, N, total_bins, opts.chunksize)
+            )
+        ]
+    C = sum(x[0] for x in counts)
+    B = sum(x[1] for x in counts)
+    j = sum(x[2] for x in counts)
+    k = sum(x[3] for x in counts)
 
-        k += 1
+    # Each pair counts in both directions, once on the diagonal
+    A = (C + C.T - diags(C.diagonal(), dtype=C.dtype)).tocsr()
+    A.eliminate_zeros()
 
     logger.debug("Total reads counted: %s", percentage(2 * k, j))
-    bamfile.close()
-    np.save(pf, A)
-    logger.debug("Link counts written to `%s.npy`", pf)
+    save_npz(pf, A)
+    logger.debug("Link counts written to `%s.npz`", pf)
     np.save(pf + ".dist", B)
     logger.debug("Link dists written to `%s.dist.npy`", pf)
 
@@ -1069,6 +1652,7 @@ def simulate(args):
     p.add_argument("--genes", default=1000, type=int, help="Number of genes")
     p.add_argument("--contigs", default=100, type=int, help="Number of contigs")
     p.add_argument("--coverage", default=10, type=int, help="Link coverage")
+    p.add_argument("--seed", default=None, type=int, help="Random seed number")
     opts, args = p.parse_args(args)
 
     if len(args) != 1:
@@ -1081,12 +1665,14 @@ def simulate(args):
     Coverage = opts.coverage
     PE = 500
     Links = int(GenomeSize * Coverage / PE)
+    if opts.seed is not None:
+        np.random.seed(opts.seed)
 
     # Simulate the contig sizes that sum to GenomeSize
     # See also:
     # <https://en.wikipedia.org/wiki/User:Skinnerd/Simplex_Point_Picking>
     (ContigSizes,) = np.random.dirichlet([1] * Contigs, 1) * GenomeSize
-    ContigSizes = np.array(np.round_(ContigSizes, decimals=0), dtype=int)
+    ContigSizes = np.rint(ContigSizes).astype(int)
     ContigStarts = np.zeros(Contigs, dtype=int)
     ContigStarts[1:] = np.cumsum(ContigSizes)[:-1]
 
@@ -1107,9 +1693,7 @@ def simulate(args):
     # between [1e3, 1e7], so we map from uniform [1e-7, 1e-3]
     LinkStarts = np.sort(np.random.randint(1, GenomeSize, size=Links))
     a, b = 1e-7, 1e-3
-    LinkSizes = np.array(
-        np.round_(1 / ((b - a) * np.random.rand(Links) + a), decimals=0), dtype=int
-    )
+    LinkSizes = np.rint(1 / ((b - a) * np.random.rand(Links) + a)).astype(int)
     LinkEnds = LinkStarts + LinkSizes
 
     # Find link to contig membership
@@ -1144,26 +1728,26 @@ def write_last_and_beds(pf, GenePositions, ContigStarts):
     qbedfile = pf + "tigs.bed"
     sbedfile = pf + "chr.bed"
     lastfile = "{}tigs.{}chr.last".format(pf, pf)
-    qbedfw = open(qbedfile, "w")
-    sbedfw = open(sbedfile, "w")
-    lastfw = open(lastfile, "w")
 
     GeneContigs = np.searchsorted(ContigStarts, GenePositions) - 1
-    for i, (c, gstart) in enumerate(zip(GeneContigs, GenePositions)):
-        gene = "gene{:05d}".format(i)
-        tig = "tig{:04d}".format(c)
-        start = ContigStarts[c]
-        cstart = gstart - start
-        print("\t".join(str(x) for x in (tig, cstart, cstart + 1, gene)), file=qbedfw)
-        print(
-            "\t".join(str(x) for x in ("chr1", gstart, gstart + 1, gene)), file=sbedfw
+    GeneStarts = GenePositions - ContigStarts[GeneContigs]
+    genes = list(enumerate(zip(GeneContigs.tolist(), GeneStarts.tolist())))
+    with open(qbedfile, "w") as fw:
+        fw.writelines(
+            "tig{:04d}\t{}\t{}\tgene{:05d}\n".format(c, x, x + 1, i)
+            for i, (c, x) in genes
+        )
+    with open(sbedfile, "w") as fw:
+        fw.writelines(
+            "chr1\t{}\t{}\tgene{:05d}\n".format(x, x + 1, i)
+            for i, x in enumerate(GenePositions.tolist())
+        )
+    lastatoms = "\t".join(str(x) for x in [100] + [0] * 8 + [100])
+    with open(lastfile, "w") as fw:
+        fw.writelines(
+            "gene{0:05d}\tgene{0:05d}\t{1}\n".format(i, lastatoms)
+            for i in range(len(GenePositions))
         )
-        lastatoms = [gene, gene, 100] + [0] * 8 + [100]
-        print("\t".join(str(x) for x in lastatoms), file=lastfw)
-
-    qbedfw.close()
-    sbedfw.close()
-    lastfw.close()
 
 
 def write_clm(
@@ -1178,40 +1762,38 @@ def write_clm(
     """
     Write CLM file from simulated data.
     """
-    clm = defaultdict(list)
-    for start, end, linkstart, linkend in zip(
-        ICLinkStartContigs, ICLinkEndContigs, ICLinkStarts, ICLinkEnds
-    ):
-        start_a = ContigStarts[start]
-        start_b = start_a + ContigSizes[start]
-        end_a = ContigStarts[end]
-        end_b = end_a + ContigSizes[end]
-        if linkend >= end_b:
-            continue
-        clm[(start, end)].append(
-            (linkstart - start_a, start_b - linkstart, linkend - end_a, end_b - linkend)
-        )
+    Ends = ContigStarts + ContigSizes
+    keep = ICLinkEnds < Ends[ICLinkEndContigs]
+    start, end = ICLinkStartContigs[keep], ICLinkEndContigs[keep]
+    linkstart, linkend = ICLinkStarts[keep], ICLinkEnds[keep]
+    a = linkstart - ContigStarts[start]
+    b = Ends[start] - linkstart
+    c = linkend - ContigStarts[end]
+    d = Ends[end] - linkend
+
+    # Group the links by contig pair, with the distances sorted in each group
+    keys = start * len(ContigStarts) + end
+    pairs, nlinks = np.unique(keys, return_counts=True)
+    columns = []
+    for dists in (b + c, b + d, a + c, a + d):
+        order = np.lexsort((dists, keys))
+        k, x = keys[order], dists[order]
+        positive = x > 0
+        k, x = k[positive], x[positive]
+        ends = np.searchsorted(k, pairs, side="right")
+        columns.append(np.split(x.astype(str), ends[:-1]))
 
     clmfile = pf + ".clm"
     fw = open(clmfile, "w")
-
-    def format_array(a):
-        return [str(x) for x in sorted(a) if x > 0]
-
-    for (start, end), links in sorted(clm.items()):
-        start = "tig{:04d}".format(start)
-        end = "tig{:04d}".format(end)
-        nlinks = len(links)
-        if not nlinks:
-            continue
-        ff = format_array([(b + c) for a, b, c, d in links])
-        fr = format_array([(b + d) for a, b, c, d in links])
-        rf = format_array([(a + c) for a, b, c, d in links])
-        rr = format_array([(a + d) for a, b, c, d in links])
-        print("{}+ {}+\t{}\t{}".format(start, end, nlinks, " ".join(ff)), file=fw)
-        print("{}+ {}-\t{}\t{}".format(start, end, nlinks, " ".join(fr)), file=fw)
-        print("{}- {}+\t{}\t{}".format(start, end, nlinks, " ".join(rf)), file=fw)
-        print("{}- {}-\t{}\t{}".format(start, end, nlinks, " ".join(rr)), file=fw)
+    ncontigs = len(ContigStarts)
+    for i, (key, n) in enumerate(zip(pairs.tolist(), nlinks.tolist())):
+        start = "tig{:04d}".format(key // ncontigs)
+        end = "tig{:04d}".format(key % ncontigs)
+        ff, fr, rf, rr = (" ".join(x[i]) for x in columns)
+        print("{}+ {}+\t{}\t{}".format(start, end, n, ff), file=fw)
+        print("{}+ {}-\t{}\t{}".format(start, end, n, fr), file=fw)
+        print("{}- {}+\t{}\t{}".format(start, end, n, rf), file=fw)
+        print("{}- {}-\t{}\t{}".format(start, end, n, rr), file=fw)
     fw.close()
 
 
@@ -1275,6 +1857,19 @@ def optimize(args):
         help="Do not resume from existing tour file",
     )
     p.add_argument("--skipGA", default=False, action="store_true", help="Skip GA step")
+    p.add_argument(
+        "--engine",
+        default="ga",
+        choices=("ga", "anneal"),
+        help="Optimizer for the contig ordering, genetic algorithm or "
+        "simulated annealing",
+    )
+    p.add_argument(
+        "--islands",
+        default=1,
+        type=int,
+        help="Populations evolving in parallel in the GA, with migration",
+    )
     p.set_outfile(outfile=None)
     p.set_cpus()
     opts, args = p.parse_args(args)
@@ -1283,26 +1878,59 @@ def optimize(args):
         sys.exit(not p.print_help())
 
     (clmfile,) = args
-    startover = opts.startover
-    runGA = not opts.skipGA
-    cpus = opts.cpus
+    optimize_partition(
+        clmfile,
+        tourfile=opts.outfile,
+        startover=opts.startover,
+        skiprecover=opts.skiprecover,
+        runGA=not opts.skipGA,
+        engine=opts.engine,
+        islands=opts.islands,
+        cpus=opts.cpus,
+    )
+
 
+def optimize_partition(
+    clmfile,
+    tourfile=None,
+    startover=False,
+    skiprecover=False,
+    runGA=True,
+    engine="ga",
+    islands=1,
+    cpus=1,
+):
+    """
+    Optimize the contig order and orientation of one partition, writing the
+    tours to `tourfile`, next to the CLM file by default. An existing tour
+    file is resumed from unless `startover`.
+    """
     # Load contact map
-    clm = CLMFile(clmfile, skiprecover=opts.skiprecover)
+    clm = CLMFile(clmfile, skiprecover=skiprecover)
 
-    tourfile = opts.outfile or clmfile.rsplit(".", 1)[0] + ".tour"
-    if startover:
-        tourfile = None
-    tour = clm.activate(tourfile=tourfile)
+    tourfile = tourfile or clmfile.rsplit(".", 1)[0] + ".tour"
+    tour = clm.activate(tourfile=None if startover else tourfile)
 
     fwtour = open(tourfile, "w")
     # Store INIT tour
     print_tour(fwtour, clm.tour, "INIT", clm.active_contigs, clm.oo, signs=clm.signs)
 
-    if runGA:
+    if runGA and engine == "anneal":
         for phase in range(1, 3):
-            tour = optimize_ordering(fwtour, clm, phase, cpus)
-            tour = clm.prune_tour(tour, cpus)
+            tour = anneal_ordering(fwtour, clm, phase)
+            tour = clm.prune_tour(tour)
+    elif runGA:
+        # One pool for all phases, the workers attach to each phase's contacts
+        pool = Pool(cpus) if cpus > 1 and islands == 1 else None
+        try:
+            for phase in range(1, 3):
+                tour = optimize_ordering(
+                    fwtour, clm, phase, cpus, pool=pool, islands=islands
+                )
+                tour = clm.prune_tour(tour)
+        finally:
+            if pool is not None:
+                pool.terminate()
 
     # Flip orientations
     phase = 1
@@ -1316,11 +1944,185 @@ def optimize(args):
     fwtour.close()
 
 
-def optimize_ordering(fwtour, clm, phase, cpus):
+def optimizeall(args):
     """
-    Optimize the ordering of contigs by Genetic Algorithm (GA).
+    %prog optimizeall groups.txt
+
+    Optimize many partitions as `optimize` does, one CLM file each. Arguments
+    are CLM files, or text files that list one CLM file per line. Partitions
+    run in parallel, largest CLM file first, each with `--partcpus` of the
+    `--cpus` available. Tours are written next to the CLM files and resumed
+    from if present, and partitions recorded as finished in the summary are
+    skipped. The summary reports the time and score trajectory of each.
     """
-    from .chic import score_evaluate_M
+    p = OptionParser(optimizeall.__doc__)
+    p.add_argument(
+        "--skiprecover",
+        default=False,
+        action="store_true",
+        help="Do not import 'recover' contigs",
+    )
+    p.add_argument(
+        "--startover",
+        default=False,
+        action="store_true",
+        help="Do not resume from existing tour files",
+    )
+    p.add_argument("--skipGA", default=False, action="store_true", help="Skip GA step")
+    p.add_argument(
+        "--engine",
+        default="ga",
+        choices=("ga", "anneal"),
+        help="Optimizer for the contig ordering, genetic algorithm or "
+        "simulated annealing",
+    )
+    p.add_argument(
+        "--islands",
+        default=1,
+        type=int,
+        help="Populations evolving in parallel in the GA, with migration",
+    )
+    p.add_argument(
+        "--partcpus",
+        default=0,
+        type=int,
+        help="CPUs for each partition, 0=share --cpus among the partitions",
+    )
+    p.set_outfile(outfile="optimize.summary")
+    p.set_cpus()
+    opts, args = p.parse_args(args)
+
+    if len(args) < 1:
+        sys.exit(not p.print_help())
+
+    clmfiles = []
+    for arg in args:
+        if arg.endswith(".clm"):
+            clmfiles.append(arg)
+        else:
+            clmfiles.extend(row.split()[0] for row in open(arg) if row.strip())
+
+    summaryfile = opts.outfile
+    done = {}
+    if op.exists(summaryfile) and not opts.startover:
+        for row in open(summaryfile):
+            if row[0] == "#":
+                continue
+            atoms = row.rstrip("\n").split("\t")
+            clmfile, tourfile, status = atoms[0], atoms[1], atoms[5]
+            if status == "done" and not need_update(clmfile, tourfile):
+                done[clmfile] = row
+    todo = [x for x in clmfiles if x not in done]
+    logger.debug("%d partitions to optimize, %d finished before", len(todo), len(done))
+
+    cpus = opts.cpus
+    partcpus = min(opts.partcpus or max(cpus // max(len(todo), 1), 1), cpus)
+    kwargs = dict(
+        startover=opts.startover,
+        skiprecover=opts.skiprecover,
+        runGA=not opts.skipGA,
+        engine=opts.engine,
+        islands=opts.islands,
+        cpus=partcpus,
+    )
+    fw = open(summaryfile, "w")
+    print("#clmfile\ttourfile\tcontigs\tcpus\tseconds\tstatus\ttrajectory", file=fw)
+    for clmfile in clmfiles:
+        if clmfile in done:
+            fw.write(done[clmfile])
+    fw.flush()
+
+    def report(clmfile, exitcode, seconds):
+        tourfile = clmfile.rsplit(".", 1)[0] + ".tour"
+        status = "done" if exitcode == 0 else "failed({})".format(exitcode)
+        ncontigs, trajectory = 0, ""
+        if op.exists(tourfile):
+            # A partition that died may leave an empty or partial tour file
+            with open(tourfile) as fp:
+                tours = [x for x in fp if x[0] != ">" and x.endswith("\n")]
+            ncontigs = len(tours[-1].split()) if tours else 0
+            trajectory = " ".join(
+                "{}:{:.6g}>{:.6g}".format(phase, scores[0], scores[-1])
+                for phase, scores in tour_trajectory(tourfile).items()
+            )
+        logger.info(
+            "Partition `%s` %s in %.1fs: %s", clmfile, status, seconds, trajectory
+        )
+        print(
+            "\t".join(
+                str(x)
+                for x in (
+                    clmfile,
+                    tourfile,
+                    ncontigs,
+                    partcpus,
+                    "{:.1f}".format(seconds),
+                    status,
+                    trajectory,
+                )
+            ),
+            file=fw,
+        )
+        fw.flush()
+
+    # Largest first, so that the longest runs do not start last
+    todo.sort(key=lambda x: -op.getsize(x))
+    schedule_partitions(todo, kwargs, cpus, partcpus, report)
+    fw.close()
+    logger.debug("Summary written to `%s`", summaryfile)
+
+
+def schedule_partitions(clmfiles, kwargs, cpus, partcpus, callback):
+    """
+    Run optimize_partition() on each CLM file in its own process, in the
+    given order, keeping at most `cpus` // `partcpus` running at a time.
+    `callback(clmfile, exitcode, seconds)` is called as each one finishes.
+    """
+    from multiprocessing import Process
+    from multiprocessing.connection import wait
+    from time import time
+
+    slots = max(cpus // partcpus, 1)
+    pending = list(clmfiles)
+    running = {}
+    while pending or running:
+        while pending and len(running) < slots:
+            clmfile = pending.pop(0)
+            job = Process(target=optimize_partition, args=(clmfile,), kwargs=kwargs)
+            job.start()
+            running[job.sentinel] = (job, clmfile, time())
+        for sentinel in wait(list(running)):
+            job, clmfile, start = running.pop(sentinel)
+            job.join()
+            callback(clmfile, job.exitcode, time() - start)
+
+
+def tour_trajectory(tourfile):
+    """
+    Scores along the GA or annealing phases of a tour file, keyed by phase,
+    e.g. {"GA1": [0.0175, ..., 0.1052], "GA2": [...]}.
+    """
+    trajectory = {}
+    with open(tourfile) as fp:
+        for row in fp:
+            # Skip the last line if it was cut short
+            if row[0] != ">" or not row.endswith("\n"):
+                continue
+            atoms = row[1:].strip().split("-", 2)
+            if not atoms[0].startswith(("GA", "SA")) or len(atoms) < 3:
+                continue
+            phase, _, score = atoms
+            trajectory.setdefault(phase, []).append(float(score))
+    return trajectory
+
+
+def optimize_ordering(fwtour, clm, phase, cpus, pool=None, islands=1):
+    """
+    Optimize the ordering of contigs by Genetic Algorithm (GA). With a pool,
+    the tours are scored by its workers against memory-mapped contacts. With
+    islands, the populations evolve on up to `cpus` processes of their own.
+    """
+    from .chic import score_delta_M, score_evaluate_M
 
     # Prepare input files
     tour_contigs = clm.active_contigs
@@ -1342,10 +2144,63 @@ def optimize_ordering(fwtour, clm, phase, cpus):
 
     callbacki = partial(callback, phase=phase, oo=oo)
     toolbox = GA_setup(tour)
-    toolbox.register("evaluate", score_evaluate_M, tour_sizes=tour_sizes, tour_M=tour_M)
-    tour, tour_fitness = GA_run(
-        toolbox, ngen=1000, npop=100, cpus=cpus, callback=callbacki
+    toolbox.register(
+        "evaluate_delta", score_delta_M, tour_sizes=tour_sizes, tour_M=tour_M
     )
+    shared = None
+    if pool is not None:
+        shared = SharedContacts(tour_sizes, tour_M)
+        toolbox.register("evaluate", score_evaluate_M_shared, spec=shared.spec)
+    else:
+        toolbox.register(
+            "evaluate", score_evaluate_M, tour_sizes=tour_sizes, tour_M=tour_M
+        )
+    try:
+        tour, tour_fitness = GA_run(
+            toolbox,
+            ngen=1000,
+            npop=100,
+            cpus=cpus,
+            callback=callbacki,
+            pool=pool,
+            islands=islands,
+        )
+    finally:
+        if shared is not None:
+            shared.close()
+    clm.tour = tour
+
+    return tour
+
+
+def anneal_ordering(fwtour, clm, phase, restarts=3, window=50, seed=666):
+    """
+    Optimize the ordering of contigs by simulated annealing, an alternative
+    to optimize_ordering() on the same objective. Checkpoints are written to
+    the tour file as the GA does.
+    """
+    from .chic import anneal_M
+
+    tour_contigs = clm.active_contigs
+    signs = clm.signs
+    oo = clm.oo
+    checkpoints = [0]
+
+    def callback(tour, restart, step, score):
+        label = "SA{}-{}-{}".format(phase, checkpoints[0], score)
+        checkpoints[0] += 1
+        print_tour(fwtour, tour, label, tour_contigs, oo, signs=signs)
+
+    tour, score = anneal_M(
+        array.array("i", clm.tour),
+        clm.active_sizes,
+        clm.M,
+        restarts=restarts,
+        window=window,
+        seed=seed,
+        callback=callback,
+    )
+    logger.debug("Annealing phase %d: score=%s", phase, score)
     clm.tour = tour
 
     return tour
@@ -1459,7 +2314,7 @@ def iter_tours(tourfile, frames=1):
     for row in fp:
         if row[0] == ">":
             label = row[1:].strip()
-            if label.startswith("GA"):
+            if label.startswith(("GA", "SA")):
                 pf, j, score = label.split("-", 2)
                 j = int(j)
             else:
@@ -1602,13 +2457,16 @@ def score(args):
         print_tour(fwtour, tour, "INIT", contig_names, oo)
 
         # Faster Cython version for evaluation
-        from .chic import score_evaluate_M
+        from .chic import score_delta_M, score_evaluate_M
 
         callbacki = partial(callback, oo=oo)
         toolbox = GA_setup(tour)
         toolbox.register(
             "evaluate", score_evaluate_M, tour_sizes=tour_sizes, tour_M=tour_M
         )
+        toolbox.register(
+            "evaluate_delta", score_delta_M, tour_sizes=tour_sizes, tour_M=tour_M
+        )
         tour, tour.fitness = GA_run(
             toolbox, npop=100, cpus=opts.cpus, callback=callbacki
         )
@@ -1637,7 +2495,7 @@ def prepare_ec(oo, sizes, M):
     """
     tour = range(len(oo))
     tour_sizes = np.array([sizes.sizes[x] for x in oo])
-    tour_M = M[oo, :][:, oo]
+    tour_M = csr_matrix(M[oo, :][:, oo])
     return tour, tour_sizes, tour_M
 
 
@@ -1,15 +1,169 @@
 from collections import defaultdict
 from typing import Dict, Tuple
 
-from ..apps.base import logger
+import numpy as np
+
+from ..apps.base import logger, need_update
 from ..formats.base import BaseFile, read_block, must_open
 from ..utils.range import Range
 
 
 class AnchorFile(BaseFile):
-    def __init__(self, filename, minsize=0):
+    """
+    Anchors compiled into flat arrays. Gene names are interned in `genes`, the
+    pairs are stored as `qi`, `si` (indices into `genes`) and `scores` (the raw
+    score column), and block i spans rows `offsets[i]:offsets[i + 1]`.
+
+    `blocks` is materialized from the arrays on first access for the callers
+    that work on lists of rows. Any edit made through `blocks`, in place or by
+    assignment, is picked up by the array-based methods.
+    """
+
+    def __init__(self, filename, minsize=0, cache=False):
         super().__init__(filename)
-        self.blocks = list(self.iter_blocks(minsize=minsize))
+        self._blocks = None
+        self._dirty = False
+        if cache:
+            self.load_cache()
+        else:
+            self.compile(self.iter_blocks())
+        if minsize:
+            self.filter_size(minsize)
+
+    @property
+    def cachefile(self):
+        return self.filename + ".npz"
+
+    def load_cache(self):
+        """
+        Load the compiled arrays from `cachefile`, rebuilding the cache when it
+        is missing or older than the anchors file. If the cache cannot be
+        written, e.g. next to a read-only input, the arrays are still built.
+        """
+        cachefile = self.cachefile
+        if need_update(self.filename, cachefile):
+            self.compile(self.iter_blocks())
+            try:
+                np.savez(
+                    cachefile,
+                    genes=self.genes,
+                    qi=self.qi,
+                    si=self.si,
+                    scores=self.scores,
+                    offsets=self.offsets,
+                )
+            except OSError as e:
+                logger.warning("Anchors cache not written to `%s`: %s", cachefile, e)
+                return
+            logger.debug("Anchors cache written to `%s`", cachefile)
+            return
+
+        with np.load(cachefile, allow_pickle=False) as data:
+            self.genes = data["genes"]
+            self.qi = data["qi"]
+            self.si = data["si"]
+            self.scores = data["scores"]
+            self.offsets = data["offsets"]
+        self.gene_index = dict((x, i) for i, x in enumerate(self.genes.tolist()))
+        logger.debug("Anchors cache loaded from `%s`", cachefile)
+
+    def compile(self, blocks):
+        """
+        Build the arrays from lists of rows `[a, b, score]`.
+        """
+        index = {}
+        qi, si, scores = [], [], []
+        offsets = [0]
+        for block in blocks:
+            for row in block:
+                if len(row) < 2:
+                    continue
+                a, b = row[:2]
+                qi.append(index.setdefault(a, len(index)))
+                si.append(index.setdefault(b, len(index)))
+                scores.append(row[2] if len(row) > 2 else "")
+            offsets.append(len(qi))
+
+        self.gene_index = index
+        self.genes = np.array(list(index), dtype=str)
+        self.qi = np.array(qi, dtype=np.int32)
+        self.si = np.array(si, dtype=np.int32)
+        self.scores = np.array(scores, dtype=str)
+        self.offsets = np.array(offsets, dtype=np.int64)
+
+    def sync(self):
+        """
+        Recompile the arrays if `blocks` has been handed out or assigned since
+        the arrays were built, as the rows may have been edited in place.
+        """
+        if self._dirty:
+            self.compile(self._blocks)
+            self._dirty = False
+
+    @property
+    def blocks(self):
+        if self._blocks is None:
+            self._blocks = [self.block_rows(i) for i in range(self.nblocks)]
+        self._dirty = True
+        return self._blocks
+
+    @blocks.setter
+    def blocks(self, blocks):
+        self._blocks = [list(x) for x in blocks]
+        self._dirty = True
+
+    @property
+    def nblocks(self):
+        return len(self.offsets) - 1
+
+    @property
+    def sizes(self):
+        return np.diff(self.offsets)
+
+    @property
+    def block_ids(self):
+        """Block id of each pair."""
+        return np.repeat(np.arange(self.nblocks), self.sizes)
+
+    @property
+    def weights(self):
+        """
+        Numeric scores with the `L` (lifted) suffix removed, NaN where the
+        score is missing or not a number.
+        """
+        scores = np.char.rstrip(self.scores, "L")
+        try:
+            return np.where(scores == "", "nan", scores).astype(float)
+        except ValueError:
+            return np.array([_to_float(x) for x in scores.tolist()])
+
+    def block_rows(self, i):
+        genes = self.genes
+        lo, hi = self.offsets[i], self.offsets[i + 1]
+        rows = []
+        for a, b, score in zip(
+            self.qi[lo:hi].tolist(), self.si[lo:hi].tolist(), self.scores[lo:hi]
+        ):
+            row = [str(genes[a]), str(genes[b])]
+            if score:
+                row.append(str(score))
+            rows.append(row)
+        return rows
+
+    def filter_size(self, minsize):
+        """
+        Keep the blocks with at least `minsize` pairs.
+        """
+        self.sync()
+        sizes = self.sizes
+        keep = sizes >= minsize
+        rows = np.repeat(keep, sizes)
+        self.qi = self.qi[rows]
+        self.si = self.si[rows]
+        self.scores = self.scores[rows]
+        self.offsets = np.concatenate(([0], np.cumsum(sizes[keep])))
+        if self._blocks is not None:
+            self._blocks = [x for x, k in zip(self._blocks, keep) if k]
 
     def iter_blocks(self, minsize=0):
         fp = open(self.filename)
@@ -19,36 +173,92 @@ class AnchorFile(BaseFile):
                 yield lines
 
     def iter_pairs(self, minsize=0):
-        block_id = -1
-        for rows in self.iter_blocks(minsize=minsize):
-            block_id += 1
-            for row in rows:
-                a, b = row[:2]
-                yield a, b, block_id
+        self.sync()
+        genes = self.genes.tolist()
+        offsets = self.offsets.tolist()
+        qi, si = self.qi.tolist(), self.si.tolist()
+        for block_id, (lo, hi) in enumerate(zip(offsets, offsets[1:])):
+            if hi - lo < minsize:
+                continue
+            for i in range(lo, hi):
+                yield genes[qi[i]], genes[si[i]], block_id
+
+    def ranks(self, order):
+        """
+        Rank of each interned gene in the bed `order`, -1 if absent.
+        """
+        return np.array(
+            [order[x][0] if x in order else -1 for x in self.genes.tolist()],
+            dtype=np.int64,
+        )
+
+    def block_spans(self, qorder, sorder):
+        """
+        Smallest and largest ranks of each block on either side, returned as
+        four arrays `qmin, qmax, smin, smax` (-1 for empty blocks). Raises
+        KeyError if a gene is missing from its bed.
+        """
+        self.sync()
+        spans = []
+        nonempty = self.sizes > 0
+        starts = self.offsets[:-1][nonempty]
+        for order, idx in ((qorder, self.qi), (sorder, self.si)):
+            r = self.ranks(order)[idx]
+            missing = np.flatnonzero(r < 0)
+            if len(missing):
+                raise KeyError(str(self.genes[idx[missing[0]]]))
+            rmin = np.full(self.nblocks, -1, dtype=np.int64)
+            rmax = np.full(self.nblocks, -1, dtype=np.int64)
+            if len(r):
+                rmin[nonempty] = np.minimum.reduceat(r, starts)
+                rmax[nonempty] = np.maximum.reduceat(r, starts)
+            spans.extend((rmin, rmax))
+        return tuple(spans)
 
     def make_ranges(self, order, clip=10):
         """Prepare anchors information into a set of ranges for chaining"""
+        self.sync()
         ranges = []
         block_pairs = defaultdict(dict)
-        blocks = self.blocks
-        for i, ib in enumerate(blocks):
-            q, s, t = zip(*ib)
-            if q[0] not in order:
+        ranks = self.ranks(order)
+        weights = self.weights
+        offsets = self.offsets.tolist()
+        for i, (lo, hi) in enumerate(zip(offsets, offsets[1:])):
+            q, s, t = self.qi[lo:hi], self.si[lo:hi], weights[lo:hi]
+            if ranks[q[0]] < 0:
                 q, s = s, q
 
-            r = make_range(q, s, t, i, order, block_pairs, clip=clip)
+            r = self.make_range(q, s, t, i, ranks, block_pairs, clip=clip)
             ranges.append(r)
 
-            assert q[0] in order
-            if s[0] not in order:
+            assert ranks[q[0]] >= 0
+            if ranks[s[0]] < 0:
                 continue
 
             # is_self comparison
             q, s = s, q
-            r = make_range(q, s, t, i, order, block_pairs, clip=clip)
+            r = self.make_range(q, s, t, i, ranks, block_pairs, clip=clip)
             ranges.append(r)
         return ranges, block_pairs
 
+    def make_range(self, q, s, t, i, ranks, block_pairs, clip=10):
+        pairs = get_best_pair(q.tolist(), s.tolist(), t.tolist())
+        score = len(pairs)
+        genes = self.genes
+        block_pairs[i].update((str(genes[a]), str(genes[b])) for a, b in pairs.items())
+
+        missing = np.flatnonzero(ranks[q] < 0)
+        if len(missing):
+            raise KeyError(str(genes[q[missing[0]]]))
+        q = ranks[q]
+        qmin = int(q.min())
+        qmax = int(q.max())
+        if qmax - qmin >= 2 * clip:
+            qmin += clip / 2
+            qmax -= clip / 2
+
+        return Range("0", qmin, qmax, score=score, id=i)
+
     def filter_blocks(self, accepted: Dict[Tuple[str, str], str]):
         """
         Filter the blocks based on the accepted pairs. This is used to update
@@ -87,12 +297,12 @@ class AnchorFile(BaseFile):
         Print the anchors to a file, optionally filtering them based on the
         accepted pairs.
         """
+        self.sync()
         fw = must_open(filename, "w")
-        for block in self.blocks:
+        for i in range(self.nblocks):
             print("###", file=fw)
-            for line in block:
-                a, b, score = line
-                print("\t".join((a, b, score)), file=fw)
+            for row in self.block_rows(i):
+                print("\t".join(row), file=fw)
         fw.close()
 
         logger.debug("Anchors written to `%s`", filename)
@@ -132,14 +342,22 @@ class AnchorFile(BaseFile):
 
     @property
     def is_empty(self):
-        blocks = self.blocks
-        return not blocks or not blocks[0]
+        self.sync()
+        return self.nblocks == 0 or self.offsets[1] == 0
+
+
+def _to_float(x):
+    try:
+        return float(x)
+    except ValueError:
+        return np.nan
 
 
 def get_best_pair(qs, ss, ts):
     pairs = {}
     for q, s, t in zip(qs, ss, ts):
-        t = int(t[:-1]) if t[-1] == "L" else int(t)
+        if isinstance(t, str):
+            t = int(t[:-1]) if t[-1] == "L" else int(t)
         if q not in pairs or pairs[q][1] < t:
             pairs[q] = (s, t)
 
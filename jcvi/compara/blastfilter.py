@@ -23,7 +23,6 @@ import sys
 import os.path as op
 
 from collections import defaultdict
-from itertools import groupby
 
 from ..apps.base import OptionParser, logger
 from ..compara.synteny import check_beds
@@ -260,26 +259,57 @@ def filter_tandem(blast_list, qdups_to_mother, sdups_to_mother):
 
 
 def tandem_grouper(blast_list, tandem_Nmax=10, flip=True):
+    """
+    Group local duplicates that hit the same gene. Hits sorted by rank are
+    linked to their neighbours when on the same chr and within tandem_Nmax,
+    then the groups are the connected components of this sparse adjacency.
+    """
+    import numpy as np
+
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+
     if not flip:
         simple_blast = [
-            (b.query, (b.sseqid, b.si)) for b in blast_list if b.evalue < 1e-10
+            (b.query, b.sseqid, b.si) for b in blast_list if b.evalue < 1e-10
         ]
     else:
         simple_blast = [
-            (b.subject, (b.qseqid, b.qi)) for b in blast_list if b.evalue < 1e-10
+            (b.subject, b.qseqid, b.qi) for b in blast_list if b.evalue < 1e-10
         ]
 
-    simple_blast.sort()
-
     standems = Grouper()
-    for name, hits in groupby(simple_blast, key=lambda x: x[0]):
-        # these are already sorted.
-        hits = [x[1] for x in hits]
-        for ia, a in enumerate(hits[:-1]):
-            b = hits[ia + 1]
-            # on the same chr and rank difference no larger than tandem_Nmax
-            if b[1] - a[1] <= tandem_Nmax and b[0] == a[0]:
-                standems.join(a[1], b[1])
+    if not simple_blast:
+        return standems
+
+    names, seqids, ranks = zip(*simple_blast)
+    _, names = np.unique(names, return_inverse=True)
+    _, seqids = np.unique(seqids, return_inverse=True)
+    ranks = np.array(ranks, dtype=int)
+    order = np.lexsort((ranks, seqids, names))
+    names, seqids, ranks = names[order], seqids[order], ranks[order]
+
+    # on the same chr and rank difference no larger than tandem_Nmax
+    adjacent = (
+        (names[1:] == names[:-1])
+        & (seqids[1:] == seqids[:-1])
+        & (ranks[1:] - ranks[:-1] <= tandem_Nmax)
+    )
+    a, b = ranks[:-1][adjacent], ranks[1:][adjacent]
+    if not len(a):
+        return standems
+
+    nodes, edges = np.unique(np.concatenate((a, b)), return_inverse=True)
+    n, m = len(nodes), len(a)
+    adjacency = coo_matrix(
+        (np.ones(m, dtype=bool), (edges[:m], edges[m:])), shape=(n, n)
+    )
+    _, labels = connected_components(adjacency, directed=False)
+
+    order = np.argsort(labels, kind="stable")
+    breaks = np.flatnonzero(np.diff(labels[order])) + 1
+    for group in np.split(nodes[order], breaks):
+        standems.join(*group.tolist())
 
     return standems
 
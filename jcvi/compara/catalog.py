@@ -4,9 +4,14 @@
 import os.path as op
 import sys
 import string
+import time
 
+from array import array
 from collections import defaultdict
-from itertools import product, combinations
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from itertools import combinations, islice, product
+
+import numpy as np
 
 from ..apps.base import (
     ActionDispatcher,
@@ -17,7 +22,14 @@ from ..apps.base import (
     need_update,
     sh,
 )
-from ..apps.align import last as last_main, diamond_blastp_main, blast_main
+from ..apps.align import (
+    last as last_main,
+    diamond_blastp_main,
+    blast_main,
+    run_diamond_makedb,
+    run_formatdb,
+    run_lastdb,
+)
 from ..compara.blastfilter import main as blastfilter_main
 from ..compara.quota import main as quota_main
 from ..compara.synteny import scan, mcscan, liftover
@@ -30,8 +42,9 @@ from ..formats.blast import (
     filtered_blastfile_name,
 )
 from ..formats.fasta import Fasta
+from ..formats.sizes import Sizes
 from ..utils.cbook import gene_name
-from ..utils.grouper import Grouper
+from ..utils.grouper import Grouper, UnionFind
 
 from .base import AnchorFile
 from .synteny import check_beds
@@ -77,6 +90,7 @@ def main():
     actions = (
         ("tandem", "identify tandem gene groups within certain distance"),
         ("ortholog", "run a combined synteny and RBH pipeline to call orthologs"),
+        ("multiortholog", "run the ortholog pipeline for all pairs of species"),
         ("group", "cluster the anchors into ortho-groups"),
         ("omgprepare", "prepare weights file to run Sankoff OMG algorithm"),
         ("omg", "generate a series of Sankoff OMG algorithm inputs"),
@@ -88,28 +102,85 @@ def main():
     p.dispatch(globals())
 
 
-def get_weights(weightsfiles=None):
-    if weightsfiles is None:
-        weightsfiles = glob("*.weights")
-
-    weights = defaultdict(list)
-    for row in must_open(weightsfiles):
-        a, b, c = row.split()
-        weights[a].append((a, b, c))
-    return weights
-
-
-def get_edges(weightsfiles=None):
-    if weightsfiles is None:
-        weightsfiles = glob("*.weights")
+class WeightsGraph:
+    """
+    Sparse graph over the pairs in `.weights` files (gene_a, gene_b, weight).
+    Gene names are interned into integer ids and the edges are stored in CSR
+    form with float32 weights, keeping the file order within each gene. The
+    files are streamed so only the arrays are held in memory.
+    """
 
-    edges = {}
-    for row in must_open(weightsfiles):
-        a, b, c = row.split()
-        c = int(c)
-        edges[(a, b)] = c
-        edges[(b, a)] = c
-    return edges
+    def __init__(self, weightsfiles=None):
+        if weightsfiles is None:
+            weightsfiles = glob("*.weights")
+
+        gene_index = {}
+        src, dst, weights = array("i"), array("i"), array("f")
+        for row in must_open(weightsfiles):
+            a, b, c = row.split()
+            src.append(gene_index.setdefault(a, len(gene_index)))
+            dst.append(gene_index.setdefault(b, len(gene_index)))
+            weights.append(float(c))
+
+        n = len(gene_index)
+        src = np.frombuffer(src, dtype=np.int32)
+        dst = np.frombuffer(dst, dtype=np.int32)
+        weights = np.frombuffer(weights, dtype=np.float32)
+        order = np.argsort(src, kind="stable")
+
+        self.gene_index = gene_index
+        self.genes = list(gene_index)
+        self.indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(src, minlength=n), out=self.indptr[1:])
+        self.indices = dst[order]
+        self.weights = weights[order]
+
+        # Undirected lookup table, the last weight seen for a pair wins
+        lo, hi = np.minimum(src, dst), np.maximum(src, dst)
+        keys = (lo.astype(np.int64) * n + hi)[::-1]
+        self.keys, first = np.unique(keys, return_index=True)
+        self.key_weights = weights[::-1][first]
+        logger.debug("Imported %d edges among %d genes", len(src), n)
+
+    def __len__(self):
+        return len(self.genes)
+
+    def neighbors(self, gene):
+        """Yield (gene_b, weight) for the pairs that start with `gene`."""
+        i = self.gene_index[gene]
+        lo, hi = self.indptr[i], self.indptr[i + 1]
+        for j, w in zip(self.indices[lo:hi].tolist(), self.weights[lo:hi].tolist()):
+            yield self.genes[j], w
+
+    def weight(self, a, b):
+        """Weight between `a` and `b` in either direction, 0 if not linked."""
+        if a not in self.gene_index or b not in self.gene_index:
+            return 0
+        ia, ib = self.gene_index[a], self.gene_index[b]
+        key = min(ia, ib) * len(self.genes) + max(ia, ib)
+        k = np.searchsorted(self.keys, key)
+        if k < len(self.keys) and self.keys[k] == key:
+            return float(self.key_weights[k])
+        return 0
+
+    def components(self):
+        """
+        Connected components as sorted lists of gene names, ordered by their
+        first gene.
+        """
+        from scipy.sparse import csr_matrix
+        from scipy.sparse.csgraph import connected_components
+
+        n = len(self.genes)
+        graph = csr_matrix(
+            (np.ones(len(self.indices), dtype=np.int8), self.indices, self.indptr),
+            shape=(n, n),
+        )
+        _, labels = connected_components(graph, directed=True, connection="weak")
+        members = defaultdict(list)
+        for gene, label in zip(self.genes, labels.tolist()):
+            members[label].append(gene)
+        return sorted(sorted(x) for x in members.values())
 
 
 def get_info():
@@ -144,7 +215,7 @@ def enrich(args):
     ghost = opts.ghost
 
     # Get gene pair => weight mapping
-    weights = get_edges()
+    weights = WeightsGraph()
     info = get_info()
     # Get gene => taxon mapping
     info = dict((k, v.split()[5]) for k, v in info.items())
@@ -203,10 +274,10 @@ def enrich(args):
         # print leftover_sorted_by_taxa
         solutions = []
         for solution in product(*leftover_sorted_by_taxa.values()):
-            score = sum(weights.get((a, b), 0) for a in solution for b in genes)
+            score = sum(weights.weight(a, b) for a in solution for b in genes)
             if score == 0:
                 continue
-            score += sum(weights.get((a, b), 0) for a, b in combinations(solution, 2))
+            score += sum(weights.weight(a, b) for a, b in combinations(solution, 2))
             solutions.append((score, solution))
             # print solution, score
 
@@ -441,37 +512,31 @@ def omg(args):
         sys.exit(not p.print_help())
 
     weightsfiles = args
-    groupfile = group(weightsfiles + ["--outfile=groups"])
-
-    weights = get_weights(weightsfiles)
+    weights = WeightsGraph(weightsfiles)
     info = get_info()
+    components = weights.components()
 
-    fp = open(groupfile)
+    groupfile = "groups"
+    fw = open(groupfile, "w")
+    for genes in components:
+        print(",".join(genes), file=fw)
+    fw.close()
+    logger.debug("Created %d groups with %d members.", len(components), len(weights))
 
     work = "work"
     mkdir(work)
-    for i, row in enumerate(fp):
+    for i, genes in enumerate(components):
         gf = op.join(work, "gf{0:05d}".format(i))
-        genes = row.rstrip().split(",")
+        contents = []
+        for a in genes:
+            for b, c in weights.neighbors(a):
+                contents.append("weight {0:g}\n".format(c))
+                contents.append("{0}\n{1}\n\n".format(info[a], info[b]))
 
         fw = open(gf, "w")
-        contents = ""
-        npairs = 0
-        for gene in genes:
-            gene_pairs = weights[gene]
-            for a, b, c in gene_pairs:
-                if b not in genes:
-                    continue
-
-                contents += "weight {0}".format(c) + "\n"
-                contents += info[a] + "\n"
-                contents += info[b] + "\n\n"
-                npairs += 1
-
-        header = "a group of genes  :length ={0}".format(npairs)
+        header = "a group of genes  :length ={0}".format(len(contents) // 2)
         print(header, file=fw)
-        print(contents, file=fw)
-
+        print("".join(contents), file=fw)
         fw.close()
 
 
@@ -544,7 +609,8 @@ def omgprepare(args):
     cscorefile = pf + ".cscore"
     cscore([blastfile, "-o", cscorefile, "--cutoff=0", "--pct"])
     ac = AnchorFile(anchorfile)
-    pairs = set((a, b) for a, b, i in ac.iter_pairs())
+    gene_index, ngenes = ac.gene_index, len(ac.genes)
+    pairs = set((ac.qi.astype(np.int64) * ngenes + ac.si).tolist())
     logger.debug("Imported %d pairs from `%s`.", len(pairs), anchorfile)
 
     weightsfile = pf + ".weights"
@@ -555,7 +621,8 @@ def omgprepare(args):
         a, b, c, pct = row.split()
         c, pct = float(c), float(pct)
         c = int(c * 100)
-        if (a, b) not in pairs:
+        ia, ib = gene_index.get(a), gene_index.get(b)
+        if ia is None or ib is None or ia * ngenes + ib not in pairs:
             if norbh:
                 continue
             if c < cs:
@@ -802,6 +869,247 @@ def ortholog(args):
         make_ortholog(qblocks, rbh, qortho)
 
 
+def make_database(fastafile, dbtype="nucl", align_soft="last"):
+    """
+    Build the sequence database for `fastafile` once, so that the pairwise
+    comparisons against the same subject can run concurrently.
+    """
+    if align_soft == "blast":
+        db_suffix = ".nin" if dbtype == "nucl" else ".pin"
+        run_formatdb(infile=fastafile, outfile=fastafile + db_suffix, dbtype=dbtype)
+    elif dbtype == "prot" and align_soft == "diamond_blastp":
+        run_diamond_makedb(infile=fastafile, outfile=fastafile + ".dmnd")
+    else:
+        subjectdb = fastafile.rsplit(".", 1)[0]
+        run_lastdb(infile=fastafile, outfile=subjectdb + ".prj", dbtype=dbtype)
+
+
+def run_dag(tasks, cpus=1):
+    """
+    Run `tasks`, a dict of name => (func, args, dependencies), over a process
+    pool. A task is submitted as soon as all its dependencies have finished;
+    tasks that depend on a failed task are skipped. Returns the names of the
+    tasks that did not complete.
+    """
+    waiting = dict(tasks)
+    running = {}
+    done, failed = set(), set()
+    with ProcessPoolExecutor(max_workers=cpus) as executor:
+        while waiting or running:
+            for name, (func, fargs, deps) in list(waiting.items()):
+                if deps & failed:
+                    logger.error("Skip `%s` since its dependencies failed", name)
+                    failed.add(name)
+                    del waiting[name]
+                elif deps <= done:
+                    future = executor.submit(func, *fargs)
+                    running[future] = (name, time.time())
+                    del waiting[name]
+
+            if not running:
+                break
+
+            finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in finished:
+                name, start = running.pop(future)
+                try:
+                    future.result()
+                except BaseException as e:
+                    logger.error("Task `%s` failed: %s", name, e)
+                    failed.add(name)
+                    continue
+                done.add(name)
+                logger.debug("Task `%s` done (%.1fs)", name, time.time() - start)
+
+    return failed
+
+
+def multiortholog(args):
+    """
+    %prog multiortholog species_a species_b species_c ...
+
+    Run the `ortholog` pipeline for every pair of species on a process pool.
+    The sequence database of each species is built once before the pairwise
+    comparisons that use it, and within each pair the steps whose outputs are
+    newer than their inputs are skipped, so an interrupted run can simply be
+    restarted.
+
+    Options not listed below are passed to `ortholog`, and must be given in
+    the --option=value form, e.g. --full --quota=1:1 --cscore=.99
+    """
+    p = OptionParser(multiortholog.__doc__)
+    p.add_argument(
+        "--dbtype",
+        default="nucl",
+        choices=("nucl", "prot"),
+        help="Molecule type of subject database",
+    )
+    p.add_argument(
+        "--align_soft",
+        default="last",
+        choices=("last", "blast", "diamond_blastp"),
+        help="Sequence alignment software",
+    )
+    p.add_argument(
+        "--self", default=False, action="store_true", help="Also compare to itself"
+    )
+    p.add_argument(
+        "--threads", default=1, type=int, help="Aligner threads for each pair"
+    )
+    p.set_cpus(cpus=1)
+    opts, args = p.parse_args(args)
+
+    species = [x for x in args if not x.startswith("-")]
+    extra = [x for x in args if x.startswith("-")]
+    if len(species) < 2 and not (opts.self and species):
+        sys.exit(not p.print_help())
+
+    dbtype, align_soft = opts.dbtype, opts.align_soft
+    suffix = ".cds" if dbtype == "nucl" else ".pep"
+    extra += [
+        "--dbtype={}".format(dbtype),
+        "--align_soft={}".format(align_soft),
+        "--cpus={}".format(opts.threads),
+    ]
+    pairs = list(combinations(species, 2))
+    if opts.self:
+        pairs += [(x, x) for x in species]
+
+    tasks = {}
+    for b in set(b for _, b in pairs):
+        tasks["db:" + b] = (make_database, (b + suffix, dbtype, align_soft), set())
+    for a, b in pairs:
+        name = "ortholog:{}.{}".format(op.basename(a), op.basename(b))
+        tasks[name] = (ortholog, ([a, b] + extra,), {"db:" + b})
+
+    logger.debug(
+        "Run %d pairwise comparisons among %d species", len(pairs), len(species)
+    )
+    failed = run_dag(tasks, cpus=opts.cpus)
+    if failed:
+        logger.error("%d tasks failed: %s", len(failed), ", ".join(sorted(failed)))
+        sys.exit(1)
+
+
+def load_sizes(filename):
+    """
+    Sequence lengths keyed by name. A .fai index, given directly or sitting next
+    to the FASTA file, is read as is; otherwise the lengths come from `Sizes`,
+    which keeps a .sizes file so the sequences are parsed at most once.
+    """
+    if not filename.endswith(".fai") and op.exists(filename + ".fai"):
+        filename += ".fai"
+    if filename.endswith(".fai"):
+        sizes = {}
+        with open(filename) as fp:
+            for row in fp:
+                name, size = row.split()[:2]
+                sizes[name] = int(size)
+        return sizes
+    return Sizes(filename).mapping
+
+
+def iter_blast_chunks(blast_file, chunksize=100000):
+    """
+    Query, subject, hit length and e-value columns of a tabular BLAST file, in
+    chunks of `chunksize` rows.
+    """
+    fp = must_open(blast_file)
+    while True:
+        rows = [row.split() for row in islice(fp, chunksize)]
+        if not rows:
+            break
+        query = [x[0] for x in rows]
+        subject = [x[1] for x in rows]
+        hitlen = np.array([x[3] for x in rows], dtype=int)
+        evalue = np.array([x[10] for x in rows], dtype=float)
+        yield query, subject, hitlen, evalue
+    fp.close()
+
+
+def tandem_families(
+    blast_file,
+    sizes,
+    bed,
+    N=3,
+    P=50,
+    is_self=True,
+    evalue=0.01,
+    strip_name=".",
+    genefam=False,
+    chunksize=100000,
+):
+    """
+    Low-memory version of the clustering in `tandem_main()`. BLAST rows are
+    filtered a chunk at a time and joined in a `UnionFind` over integer gene
+    ids, so only per-gene arrays are kept. Returns the same families, as sorted
+    lists of gene names, but ordered lexicographically rather than in the
+    order of the `Grouper` lists.
+    """
+    order = bed.order
+    names = list(dict.fromkeys(b.accn for b in bed))
+    gene_ids = dict((x, i) for i, x in enumerate(names))
+    nbed = len(names)
+    seqids = {}
+    position = np.array([order[x][0] for x in names], dtype=int)
+    seqid = np.array([seqids.setdefault(order[x][1].seqid, len(seqids)) for x in names])
+
+    # Raw BLAST ids to (length, gene id), the gene id being -1 outside the bed
+    hits = {}
+
+    def add_hit(hit):
+        gene = gene_name(hit, sep=strip_name)
+        if gene not in gene_ids and not is_self:
+            gene_ids[gene] = len(names)
+            names.append(gene)
+        hits[hit] = info = (sizes[hit], gene_ids.get(gene, -1))
+        return info
+
+    def lookup(chunk):
+        info = [hits[x] if x in hits else add_hit(x) for x in chunk]
+        return np.array(info, dtype=int).reshape(-1, 2)
+
+    g = UnionFind(nbed)
+    for query, subject, hitlen, evalues in iter_blast_chunks(blast_file, chunksize):
+        q, s = lookup(query), lookup(subject)
+        keep = hitlen >= np.minimum(q[:, 0], s[:, 0]) * P / 100.0
+        if not is_self:
+            keep &= evalues <= evalue
+            g.resize(len(names))
+            g.union(q[keep, 1], s[keep, 1])
+            continue
+
+        qi, si, evalues = q[keep, 1], s[keep, 1], evalues[keep]
+        missing = np.flatnonzero((qi < 0) | (si < 0))
+        if len(missing):
+            k = np.flatnonzero(keep)[missing[0]]
+            hit = query[k] if qi[missing[0]] < 0 else subject[k]
+            raise KeyError(gene_name(hit, sep=strip_name))
+        ok = (np.abs(position[qi] - position[si]) <= N) & (evalues <= evalue)
+        if not genefam:
+            ok &= seqid[qi] == seqid[si]
+        g.union(qi[ok], si[ok])
+
+    if not is_self and not genefam:
+        homologs, g = g, UnionFind(nbed)
+        roots = homologs.find(np.arange(nbed))
+        lengths = np.array([sizes.get(x, -1) for x in names[:nbed]])
+        line_genes = np.array([gene_ids[b.accn] for b in bed], dtype=int)
+        line_seqids = seqid[line_genes]
+        for x in range(1, N + 1):
+            gi, gx = line_genes[x:], line_genes[:-x]
+            joined = (line_seqids[x:] == line_seqids[:-x]) & (roots[gi] == roots[gx])
+            gi, gx = gi[joined], gx[joined]
+            leni, lenx = lengths[gi], lengths[gx]
+            if (leni < 0).any() or (lenx < 0).any():
+                k = gi[leni < 0][0] if (leni < 0).any() else gx[lenx < 0][0]
+                raise KeyError(names[k])
+            ok = np.abs(leni - lenx) <= np.maximum(leni, lenx) * (1 - P / 100.0)
+            g.union(gi[ok], gx[ok])
+
+    return sorted(sorted(names[i] for i in group) for group in g if len(group) >= 2)
+
+
 def tandem_main(
     blast_file,
     cds_file,
@@ -813,16 +1121,33 @@ def tandem_main(
     strip_name=".",
     ofile=sys.stderr,
     genefam=False,
+    lowmem=False,
+    chunksize=100000,
 ):
     if genefam:
         N = 1e5
 
+    # retrieve the locations
+    bed = Bed(bed_file)
+
+    if lowmem:
+        families = tandem_families(
+            blast_file,
+            load_sizes(cds_file),
+            bed,
+            N=N,
+            P=P,
+            is_self=is_self,
+            evalue=evalue,
+            strip_name=strip_name,
+            genefam=genefam,
+            chunksize=chunksize,
+        )
+        return report_families(families, N, ofile)
+
     # get the sizes for the CDS first
     f = Fasta(cds_file)
     sizes = dict(f.itersizes())
-
-    # retrieve the locations
-    bed = Bed(bed_file)
     order = bed.order
 
     if is_self:
@@ -882,16 +1207,18 @@ def tandem_main(
                             continue
                         g.join(bed[i - x].accn, atom.accn)
 
-    # dump the grouper
+    families = [sorted(group) for group in sorted(g) if len(group) >= 2]
+    return report_families(families, N, ofile)
+
+
+def report_families(families, N, ofile):
+    """
+    Write one family per line and summarize them on stderr.
+    """
     fw = must_open(ofile, "w")
-    ngenes, nfamilies = 0, 0
-    families = []
-    for group in sorted(g):
-        if len(group) >= 2:
-            print(",".join(sorted(group)), file=fw)
-            ngenes += len(group)
-            nfamilies += 1
-            families.append(sorted(group))
+    for family in families:
+        print(",".join(family), file=fw)
+    ngenes, nfamilies = sum(len(x) for x in families), len(families)
 
     longest_family = max(families, key=lambda x: len(x))
 
@@ -914,7 +1241,8 @@ def tandem(args):
     blast_file by enforcing alignments between any two genes at least 50%
     (or user specified value) of either gene.
 
-    pep_file can also be used in same manner.
+    pep_file can also be used in same manner. With --lowmem, cds_file can also
+    be a .sizes or .fai file since only the sequence lengths are needed.
     """
     p = OptionParser(tandem.__doc__)
     p.add_argument(
@@ -950,6 +1278,19 @@ def tandem(args):
         action="store_true",
         help="compile gene families based on similarity",
     )
+    p.add_argument(
+        "--lowmem",
+        default=False,
+        action="store_true",
+        help="filter blast in chunks and take lengths from .sizes/.fai, "
+        "for very large inputs; families are written in sorted order",
+    )
+    p.add_argument(
+        "--chunksize",
+        default=100000,
+        type=int,
+        help="blast rows per chunk in --lowmem mode",
+    )
     p.set_outfile()
 
     opts, args = p.parse_args(args)
@@ -975,6 +1316,8 @@ def tandem(args):
         strip_name=sep,
         ofile=ofile,
         genefam=opts.genefam,
+        lowmem=opts.lowmem,
+        chunksize=opts.chunksize,
     )
 
 
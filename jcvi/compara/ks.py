@@ -4,20 +4,22 @@
 """
 Calculation of synonymous substitutions (Ks).
 """
+
 import csv
+import json
 import os
 import os.path as op
 import sys
 
 from functools import partial
-from itertools import combinations, product
-from math import exp, log, pi, sqrt
+from itertools import combinations, islice, product
+from math import exp, pi, sqrt
+from multiprocessing import Pool
 from typing import Optional
 
 import numpy as np
 
 from Bio import AlignIO, SeqIO
-from Bio.Align.Applications import ClustalwCommandline, MuscleCommandline
 
 from ..apps.base import (
     ActionDispatcher,
@@ -28,6 +30,7 @@ from ..apps.base import (
     iglob,
     logger,
     mkdir,
+    need_update,
     sh,
 )
 from ..formats.base import LineFile, must_open
@@ -50,10 +53,10 @@ class AbstractCommandline:
 class YnCommandline(AbstractCommandline):
     """Little commandline for yn00."""
 
-    def __init__(self, ctl_file, command=PAML_BIN("yn00")):
+    def __init__(self, ctl_file, command=None):
         self.ctl_file = ctl_file
         self.parameters = []
-        self.command = command
+        self.command = command or PAML_BIN("yn00")
 
     def __str__(self):
         return self.command + " %s >/dev/null" % self.ctl_file
@@ -68,13 +71,13 @@ class MrTransCommandline(AbstractCommandline):
         nuc_file,
         output_file,
         outfmt="paml",
-        command=PAL2NAL_BIN("pal2nal.pl"),
+        command=None,
     ):
         self.prot_align_file = prot_align_file
         self.nuc_file = nuc_file
         self.output_file = output_file
         self.outfmt = outfmt
-        self.command = command
+        self.command = command or PAL2NAL_BIN("pal2nal.pl")
 
         self.parameters = []
 
@@ -201,6 +204,7 @@ class KsPlot(object):
         fill=False,
         fitted=True,
         kde=False,
+        mixture=None,
     ):
 
         ax = self.ax
@@ -220,6 +224,7 @@ class KsPlot(object):
             fill=fill,
             fitted=fitted,
             kde=kde,
+            mixture=mixture,
         )
         self.lines.append(line)
         self.labels.append(label)
@@ -280,6 +285,7 @@ def multireport(args):
     """
     p = OptionParser(multireport.__doc__)
     p.set_outfile(outfile="Ks_plot.pdf")
+    p.set_cpus(cpus=1)
     add_plot_options(p)
     opts, args, iopts = p.set_image_options(args, figsize="8x6")
 
@@ -297,11 +303,15 @@ def multireport(args):
     fig = plt.figure(1, (iopts.w, iopts.h))
     ax = fig.add_axes([0.12, 0.13, 0.8, 0.8])
 
+    tasks = [(lo.ksfile, lo.components, ks_min, ks_max, opts.fit) for lo in layout]
+    if opts.cpus > 1 and len(tasks) > 1:
+        with Pool(min(opts.cpus, len(tasks))) as pool:
+            results = pool.map(load_ks_data, tasks)
+    else:
+        results = [load_ks_data(x) for x in tasks]
+
     kp = KsPlot(ax, ks_max, bins, legendp=opts.legendp)
-    for lo in layout:
-        data = KsFile(lo.ksfile)
-        data = [x.ng_ks for x in data]
-        data = [x for x in data if ks_min <= x <= ks_max]
+    for lo, (data, mixture) in zip(layout, results):
         kp.add_data(
             data,
             lo.components,
@@ -311,6 +321,7 @@ def multireport(args):
             fill=fill,
             fitted=opts.fit,
             kde=opts.kde,
+            mixture=mixture,
         )
 
     kp.draw(title=opts.title, filename=opts.outfile)
@@ -563,6 +574,24 @@ def calc(args):
         help="software used to align the proteins",
     )
     p.add_argument("--workdir", default=os.getcwd(), help="Work directory")
+    p.add_argument(
+        "--engine",
+        default="yn00",
+        choices=("yn00", "ng86"),
+        help="yn00 runs the external aligner, pal2nal and PAML; ng86 aligns "
+        "and estimates Nei-Gojobori Ks in-process",
+    )
+    p.add_argument(
+        "--resume",
+        action="store_true",
+        help="Skip pairs already in the output file and append to it",
+    )
+    p.add_argument(
+        "--unordered",
+        action="store_true",
+        help="Write pairs as they finish instead of in input order",
+    )
+    p.set_cpus(cpus=1)
     p.set_outfile()
 
     opts, args = p.parse_args(args)
@@ -575,8 +604,15 @@ def calc(args):
         print("Incorrect arguments", file=sys.stderr)
         sys.exit(not p.print_help())
 
-    output_h = must_open(opts.outfile, "w")
-    print(fields, file=output_h)
+    outfile = opts.outfile
+    done = set()
+    if opts.resume and outfile != "stdout" and op.exists(outfile):
+        done = set(x.name for x in KsFile(outfile))
+        logger.debug("%d pairs found in `%s`, skipped", len(done), outfile)
+        output_h = open(outfile, "a")
+    else:
+        output_h = must_open(outfile, "w")
+        print(fields, file=output_h)
     work_dir = op.join(opts.workdir, "syn_analysis")
     mkdir(work_dir)
 
@@ -589,43 +625,134 @@ def calc(args):
 
     prot_iterator = SeqIO.parse(open(protein_file), "fasta")
     dna_iterator = SeqIO.parse(open(dna_file), "fasta")
-    for p_rec_1, p_rec_2, n_rec_1, n_rec_2 in zip(
-        prot_iterator, prot_iterator, dna_iterator, dna_iterator
-    ):
+    tasks = (
+        (p_rec_1, p_rec_2, n_rec_1, n_rec_2, opts.msa, opts.engine, work_dir)
+        for p_rec_1, p_rec_2, n_rec_1, n_rec_2 in zip(
+            prot_iterator, prot_iterator, dna_iterator, dna_iterator
+        )
+        if "%s;%s" % (p_rec_1.name, p_rec_2.name) not in done
+    )
 
-        print("--------", p_rec_1.name, p_rec_2.name, file=sys.stderr)
-        if opts.msa == "clustalw":
-            align_fasta = clustal_align_protein((p_rec_1, p_rec_2), work_dir)
-        elif opts.msa == "muscle":
-            align_fasta = muscle_align_protein((p_rec_1, p_rec_2), work_dir)
-        mrtrans_fasta = run_mrtrans(align_fasta, (n_rec_1, n_rec_2), work_dir)
-        if mrtrans_fasta:
-            ds_subs_yn, dn_subs_yn, ds_subs_ng, dn_subs_ng = find_synonymous(
-                mrtrans_fasta, work_dir
-            )
-            if ds_subs_yn is not None:
-                pair_name = "%s;%s" % (p_rec_1.name, p_rec_2.name)
-                output_h.write(
-                    "%s\n"
-                    % (
-                        ",".join(
-                            str(x)
-                            for x in (
-                                pair_name,
-                                ds_subs_yn,
-                                dn_subs_yn,
-                                ds_subs_ng,
-                                dn_subs_ng,
-                            )
-                        )
-                    )
-                )
-                output_h.flush()
+    cpus = opts.cpus
+    if cpus > 1:
+        pool = Pool(cpus)
+        imap = pool.imap_unordered if opts.unordered else pool.imap
+        results = imap(calc_pair, tasks)
+    else:
+        pool = None
+        results = map(calc_pair, tasks)
+
+    if opts.engine == "ng86":
+        results = ng86_rows(results)
+
+    for row in results:
+        if row is None:
+            continue
+        print(",".join(str(x) for x in row), file=output_h)
+        output_h.flush()
+
+    if pool:
+        pool.close()
+        pool.join()
+    output_h.close()
 
     # Clean-up
+    cleanup(work_dir)
     sh("rm -rf 2YN.t 2YN.dN 2YN.dS rst rub rst1 syn_analysis")
 
 
+def calc_pair(task):
+    """
+    Compute Ks/Ka for one pair of records. Each worker process runs the
+    external programs in its own scratch folder under `work_dir`. For the
+    ng86 engine only the codon alignment is returned, the estimates are
+    computed in batches by `ng86_rows`.
+    """
+    p_rec_1, p_rec_2, n_rec_1, n_rec_2, msa, engine, work_dir = task
+    pair_name = "%s;%s" % (p_rec_1.name, p_rec_2.name)
+    print("--------", p_rec_1.name, p_rec_2.name, file=sys.stderr)
+    if engine == "ng86":
+        return (pair_name,) + align_codons((p_rec_1, p_rec_2), (n_rec_1, n_rec_2))
+
+    work_dir = op.join(work_dir, "worker{}".format(os.getpid()))
+    if not op.isdir(work_dir):
+        os.makedirs(work_dir)
+    if msa == "clustalw":
+        align_fasta = clustal_align_protein((p_rec_1, p_rec_2), work_dir)
+    elif msa == "muscle":
+        align_fasta = muscle_align_protein((p_rec_1, p_rec_2), work_dir)
+    mrtrans_fasta = run_mrtrans(align_fasta, (n_rec_1, n_rec_2), work_dir)
+    if not mrtrans_fasta:
+        return None
+
+    ds_subs_yn, dn_subs_yn, ds_subs_ng, dn_subs_ng = find_synonymous(
+        mrtrans_fasta, work_dir
+    )
+    if ds_subs_yn is None:
+        return None
+    return pair_name, ds_subs_yn, dn_subs_yn, ds_subs_ng, dn_subs_ng
+
+
+def align_codons(prot_recs, nuc_recs):
+    """
+    Align the proteins with a global pairwise alignment and thread the CDS
+    through it, returning the two gapped codon sequences.
+
+    >>> from Bio.SeqRecord import SeqRecord
+    >>> from Bio.Seq import Seq
+    >>> prots = [SeqRecord(Seq(x)) for x in ("MKW", "MW")]
+    >>> nucs = [SeqRecord(Seq(x)) for x in ("ATGAAATGG", "ATGTGG")]
+    >>> align_codons(prots, nucs)
+    ('ATGAAATGG', 'ATG---TGG')
+    """
+    from Bio.Align import PairwiseAligner, substitution_matrices
+
+    aligner = PairwiseAligner(
+        mode="global",
+        substitution_matrix=substitution_matrices.load("BLOSUM62"),
+        open_gap_score=-10,
+        extend_gap_score=-0.5,
+    )
+    a, b = (str(x.seq).upper() for x in prot_recs)
+    alignment = aligner.align(a, b)[0]
+    codon_alignment = []
+    for prot, nuc in zip((alignment[0], alignment[1]), nuc_recs):
+        nuc = str(nuc.seq).upper()
+        codons = []
+        i = 0
+        for aa in prot:
+            if aa == "-":
+                codons.append("---")
+                continue
+            codon = nuc[i : i + 3]
+            codons.append(codon if len(codon) == 3 else "---")
+            i += 3
+        codon_alignment.append("".join(codons))
+    return tuple(codon_alignment)
+
+
+def ng86_rows(alignments, batch_size=1000):
+    """
+    Nei-Gojobori Ks and Ka for `(pair_name, codon_a, codon_b)` alignments,
+    computed without external programs, `batch_size` pairs at a time. The
+    values that cannot be estimated (e.g. saturated) are written as NA.
+    """
+    from .dnds import ng86
+
+    def fmt(x):
+        return "NA" if np.isnan(x) else "{:.4f}".format(x)
+
+    alignments = iter(alignments)
+    while True:
+        batch = list(islice(alignments, batch_size))
+        if not batch:
+            break
+        names, a, b = zip(*batch)
+        ds, dn = ng86(zip(a, b))
+        for pair_name, s, n in zip(names, ds.tolist(), dn.tolist()):
+            yield pair_name, "NA", "NA", fmt(s), fmt(n)
+
+
 def find_synonymous(input_file, work_dir):
     """Run yn00 to find the synonymous subsitution rate for the alignment."""
     cwd = os.getcwd()
@@ -739,6 +866,8 @@ def clustal_align_protein(recs, work_dir, outfmt="fasta"):
     Align given proteins with clustalw.
     recs are iterable of Biopython SeqIO objects
     """
+    from Bio.Align.Applications import ClustalwCommandline
+
     fasta_file = op.join(work_dir, "prot-start.fasta")
     align_file = op.join(work_dir, "prot.aln")
     SeqIO.write(recs, open(fasta_file, "w"), "fasta")
@@ -766,6 +895,8 @@ def muscle_align_protein(recs, work_dir, outfmt="fasta", inputorder=True):
     Align given proteins with muscle.
     recs are iterable of Biopython SeqIO objects
     """
+    from Bio.Align.Applications import MuscleCommandline
+
     fasta_file = op.join(work_dir, "prot-start.fasta")
     align_file = op.join(work_dir, "prot.aln")
     SeqIO.write(recs, open(fasta_file, "w"), "fasta")
@@ -958,13 +1089,13 @@ def my_hist(ax, l, interval, max_r, color="g", marker=".", fill=False, kde=False
     if not l:
         return
 
-    n, p = [], []
     total_len = len(l)
-    for i in np.arange(0, max_r, interval):
-        xmin, xmax = i - 0.5 * interval, i + 0.5 * interval
-        nx = [x for x in l if xmin <= x < xmax]
-        n.append(i)
-        p.append(len(nx) * 100.0 / total_len)
+    n = np.arange(0, max_r, interval)
+    xs = np.sort(l)
+    nx = np.searchsorted(xs, n + 0.5 * interval) - np.searchsorted(
+        xs, n - 0.5 * interval
+    )
+    p = nx * 100.0 / total_len
 
     if kde:
         from scipy import stats
@@ -1003,40 +1134,93 @@ def lognormpdf_mix(bins, probs, mus, sigmas, interval=0.1):
     return y
 
 
-def get_mixture(data, components):
+def get_mixture(data, components, nbins=1000, maxiter=1000, tol=1e-8):
     """
-    probs = [.476, .509]
-    mus = [.69069, -.15038]
-    variances = [.468982e-1, .959052e-1]
+    Fit a mixture of lognormal distributions to the Ks values (> 0.05) by EM
+    on the histogram of log(Ks), so that each iteration costs O(components *
+    nbins) regardless of the number of pairs. Returns the mixing proportions,
+    and the means and standard deviations of log(Ks) for each component.
+
+    >>> rng = np.random.default_rng(0)
+    >>> data = np.exp(np.r_[rng.normal(-1, .2, 5000), rng.normal(.5, .2, 5000)])
+    >>> probs, mus, sigmas = get_mixture(data, 2)
+    >>> [np.round(x, 1).tolist() for x in (probs, mus, sigmas)]
+    [[0.5, 0.5], [-1.0, 0.5], [0.2, 0.2]]
     """
-    from jcvi.apps.base import popen
-
-    probs, mus, sigmas = [], [], []
-    fw = must_open("tmp", "w")
-    log_data = [log(x) for x in data if x > 0.05]
-    data = "\n".join(["%.4f" % x for x in log_data]).replace("inf\n", "")
-    fw.write(data)
-    fw.close()
-
-    cmd = "gmm-bic {0} {1} {2}".format(components, len(log_data), fw.name)
-    pipe = popen(cmd)
-
-    for row in pipe:
-        if row[0] != "#":
-            continue
+    data = np.asarray(data, dtype=float)
+    log_data = np.log(data[data > 0.05])
+    if not len(log_data):
+        return [], [], []
+
+    counts, edges = np.histogram(log_data, bins=nbins)
+    keep = counts > 0
+    x = ((edges[:-1] + edges[1:]) / 2)[keep]
+    w = counts[keep].astype(float)
+    min_var = (edges[1] - edges[0]) ** 2 / 12 + 1e-12
+
+    probs = np.full(components, 1.0 / components)
+    mus = np.quantile(log_data, (np.arange(components) + 0.5) / components)
+    sigmas = np.full(components, max(log_data.std() / components, sqrt(min_var)))
+    prev_ll = -np.inf
+    for _ in range(maxiter):
+        # E-step, responsibilities of each component for each bin
+        logp = (
+            np.log(probs)[:, None]
+            - np.log(sigmas)[:, None]
+            - 0.5 * ((x - mus[:, None]) / sigmas[:, None]) ** 2
+        )
+        top = logp.max(axis=0)
+        resp = np.exp(logp - top)
+        total = resp.sum(axis=0)
+        resp /= total
+        ll = (w * (top + np.log(total))).sum()
+
+        # M-step, weighted by the bin counts
+        nk = resp @ w + 1e-12
+        probs = nk / nk.sum()
+        mus = resp @ (w * x) / nk
+        var = (resp * (x - mus[:, None]) ** 2) @ w / nk
+        sigmas = np.sqrt(np.maximum(var, min_var))
+        if ll - prev_ll <= tol * abs(ll):
+            break
+        prev_ll = ll
 
-        atoms = row.split(",")
-        a, b, c = atoms[1:4]
-        a = float(a)
-        b = float(b)
-        c = float(c)
+    return probs.tolist(), mus.tolist(), sigmas.tolist()
 
-        mus.append(a)
-        sigmas.append(b)
-        probs.append(c)
 
-    cleanup(fw.name)
-    return probs, mus, sigmas
+def load_mixture(ksfile, data, components, ks_min, ks_max):
+    """
+    Fit the lognormal mixture to `data`, the Ks values read from `ksfile`
+    within [ks_min, ks_max]. Fitted parameters are cached in
+    `ksfile.mixture.json` and reused as long as the Ks file is unchanged.
+    """
+    cachefile = ksfile + ".mixture.json"
+    key = "{}:{}:{}".format(components, ks_min, ks_max)
+    cache = {}
+    if not need_update(ksfile, cachefile):
+        with open(cachefile) as fp:
+            cache = json.load(fp)
+    if key in cache:
+        logger.debug("Mixture for `%s` loaded from `%s`", ksfile, cachefile)
+        return tuple(cache[key])
+
+    mixture = get_mixture(data, components)
+    cache[key] = mixture
+    with open(cachefile, "w") as fw:
+        json.dump(cache, fw)
+    return mixture
+
+
+def load_ks_data(task):
+    """
+    Read the NG Ks values within [ks_min, ks_max] from a Ks file, and fit the
+    mixture if `fitted`. Used by multireport to process the files in parallel.
+    """
+    ksfile, components, ks_min, ks_max, fitted = task
+    data = [x.ng_ks for x in KsFile(ksfile)]
+    data = [x for x in data if ks_min <= x <= ks_max]
+    mixture = load_mixture(ksfile, data, components, ks_min, ks_max) if fitted else None
+    return data, mixture
 
 
 def plot_ks_dist(
@@ -1050,6 +1234,7 @@ def plot_ks_dist(
     fill=False,
     fitted=True,
     kde=False,
+    mixture=None,
 ):
 
     (line,) = my_hist(
@@ -1059,7 +1244,7 @@ def plot_ks_dist(
 
     line_mixture = None
     if fitted:
-        probs, mus, variances = get_mixture(data, components)
+        probs, mus, variances = mixture or get_mixture(data, components)
 
         iv = 0.001
         bins = np.arange(iv, ks_max, iv)
@@ -1164,11 +1349,21 @@ def report(args):
     components = opts.components
     data = [x.ng_ks for x in data]
     data = [x for x in data if ks_min <= x <= ks_max]
+    mixture = (
+        load_mixture(ks_file, data, components, ks_min, ks_max) if opts.fit else None
+    )
 
     fig = plt.figure(1, (iopts.w, iopts.h))
     ax = fig.add_axes([0.12, 0.1, 0.8, 0.8])
     kp = KsPlot(ax, ks_max, opts.bins, legendp=opts.legendp)
-    kp.add_data(data, components, fill=opts.fill, fitted=opts.fit, kde=opts.kde)
+    kp.add_data(
+        data,
+        components,
+        fill=opts.fill,
+        fitted=opts.fit,
+        kde=opts.kde,
+        mixture=mixture,
+    )
     kp.draw(title=opts.title)
 
 
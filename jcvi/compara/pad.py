@@ -12,6 +12,7 @@ format (use compara.synteny.scan()), then segment the chromosomes and cluster
 segments according to the matching patterns. Finally the putative ancestral
 regions (PAR) are identified and visualized.
 """
+
 import os.path as op
 import sys
 
@@ -23,7 +24,6 @@ from more_itertools import pairwise
 
 from ..apps.base import ActionDispatcher, OptionParser, logger, need_update, sh
 from ..formats.bed import Bed
-from ..formats.blast import BlastLine
 
 from .base import AnchorFile
 from .synteny import check_beds
@@ -44,8 +44,22 @@ def make_arrays(blastfile, qpadbed, spadbed, qpadnames, spadnames):
     This function makes three matrices: observed, expected and logmp. The logmp
     contains the statistical significance for each comparison.
     """
+    observed, expected = count_arrays(blastfile, qpadbed, spadbed, qpadnames, spadnames)
+
+    # Calculate the statistical significance for each cell, in log space to
+    # avoid underflow
+    from scipy.stats.distributions import poisson
+
+    logmp = np.maximum(-poisson.logpmf(observed, expected), 0)
+
+    return logmp
+
+
+def count_arrays(blastfile, qpadbed, spadbed, qpadnames, spadnames):
+    """
+    Observed and expected counts of BLAST hits between each pair of PADs.
+    """
     m, n = len(qpadnames), len(spadnames)
-    qpadorder, spadorder = qpadbed.order, spadbed.order
     qpadid = dict((a, i) for i, a in enumerate(qpadnames))
     spadid = dict((a, i) for i, a in enumerate(spadnames))
     qpadlen = dict((a, len(b)) for a, b in qpadbed.sub_beds())
@@ -58,44 +72,31 @@ def make_arrays(blastfile, qpadbed, spadbed, qpadnames, spadnames):
 
     # Populate arrays of observed counts and expected counts
     logger.debug("Initialize array of size ({0} x {1})".format(m, n))
-    observed = np.zeros((m, n))
+    qpadindex = dict((b.accn, qpadid[b.seqid]) for b in qpadbed)
+    spadindex = dict((b.accn, spadid[b.seqid]) for b in spadbed)
+    qsi, ssi = [], []
     fp = open(blastfile)
-    all_dots = 0
     for row in fp:
-        b = BlastLine(row)
-        qi, q = qpadorder[b.query]
-        si, s = spadorder[b.subject]
-        qseqid, sseqid = q.seqid, s.seqid
-        qsi, ssi = qpadid[qseqid], spadid[sseqid]
-        observed[qsi, ssi] += 1
-        all_dots += 1
+        query, subject = row.split("\t", 2)[:2]
+        qsi.append(qpadindex[query])
+        ssi.append(spadindex[subject])
+    fp.close()
+    all_dots = len(qsi)
+
+    observed = np.zeros((m, n))
+    np.add.at(observed, (qsi, ssi), 1)
 
     assert int(round(observed.sum())) == all_dots
 
     logger.debug("Total area: {0} x {1}".format(qsize, ssize))
     S = qsize * ssize
-    expected = np.zeros((m, n))
-    qsum = 0
-    for i, a in enumerate(qpadnames):
-        alen = qpadlen[a]
-        qsum += alen
-        for j, b in enumerate(spadnames):
-            blen = spadlen[b]
-            expected[i, j] = all_dots * alen * blen * 1.0 / S
+    qlens = np.array([qpadlen[a] for a in qpadnames], dtype=float)
+    slens = np.array([spadlen[b] for b in spadnames], dtype=float)
+    expected = np.outer(qlens, slens) * all_dots / S
 
     assert int(round(expected.sum())) == all_dots
 
-    # Calculate the statistical significance for each cell
-    from scipy.stats.distributions import poisson
-
-    logmp = np.zeros((m, n))
-    for i in range(m):
-        for j in range(n):
-            obs, exp = observed[i, j], expected[i, j]
-            pois = max(poisson.pmf(obs, exp), 1e-250)  # Underflow
-            logmp[i, j] = max(-log(pois), 0)
-
-    return logmp
+    return observed, expected
 
 
 def pad(args):
@@ -9,7 +9,8 @@ Quota synteny alignment (QUOTA-ALIGN)
 This python program does the following:
 1. merge 2D-overlapping blocks (now skipped, but existed in original version)
 2. build constraints that represent 1D-overlap among blocks
-3. feed the data into the linear programming solver
+3. split the constraints into independent components, and feed each component
+   into the linear programming solver (in parallel)
 
 The algorithm is described in Tang et al. BMC Bioinformatics 2011.
 "Screening synteny blocks in pairwise genome comparisons through integer
@@ -18,11 +19,20 @@ programming."
 
 import os.path as op
 import sys
+import time
+
+from collections import defaultdict
+from heapq import heappop, heappush
+from multiprocessing import Pool
+from tempfile import mkdtemp
+
+import numpy as np
 
 from ..algorithms.lpsolve import MIPDataModel
-from ..apps.base import OptionParser, logger
+from ..apps.base import OptionParser, cleanup, logger
 from ..compara.synteny import _score, check_beds
 from ..formats.base import must_open
+from ..utils.grouper import Grouper
 
 from .base import AnchorFile
 
@@ -30,30 +40,51 @@ from .base import AnchorFile
 def get_1D_overlap(eclusters, depth=1):
     """
     Find blocks that are 1D overlapping,
-    returns cliques of block ids that are in conflict
+    returns maximal cliques of block ids that are in conflict
+
+    The endpoints are sorted once, and the sweep keeps the active blocks in a
+    heap keyed by their right ends. A maximal clique is reported whenever a
+    run of left ends is followed by a right end; smaller cliques are implied.
+
+    >>> sorted(get_1D_overlap([("1", 0, 10), ("1", 5, 15), ("1", 8, 20), ("1", 12, 30)]))
+    [(0, 1, 2), (1, 2, 3)]
+    >>> sorted(get_1D_overlap([("1", 0, 10), ("2", 5, 15), ("1", 10, 20)]))
+    [(0, 2)]
     """
     overlap_set = set()
-    active = set()
-
-    ends = []
-    for i, (chr, left, right) in enumerate(eclusters):
-        ends.append((chr, left, 0, i))  # 0/1 for left/right-ness
-        ends.append((chr, right, 1, i))
-    ends.sort()
-
-    chr_last = ""
-    for chr, _, left_right, i in ends:
-        if chr != chr_last:
-            active.clear()
-        if left_right == 0:
-            active.add(i)
-        else:
-            active.remove(i)
-
-        if len(active) > depth:
-            overlap_set.add(tuple(sorted(active)))
+    if not eclusters:
+        return overlap_set
+
+    n = len(eclusters)
+    chrs, lefts, rights = zip(*eclusters)
+    _, chrs = np.unique(chrs, return_inverse=True)
+    ids = np.tile(np.arange(n), 2)
+    is_right = np.repeat([0, 1], n)  # 0/1 for left/right-ness
+    order = np.lexsort((ids, is_right, lefts + rights, np.tile(chrs, 2)))
+    ids, is_right = ids[order], is_right[order]
+
+    nends = len(order)
+    rank = np.empty(nends, dtype=int)
+    rank[order] = np.arange(nends)
+    right_rank = rank[n:].tolist()
+
+    depths = np.cumsum(1 - 2 * is_right)
+    peaks = np.flatnonzero(
+        (is_right[:-1] == 0) & (is_right[1:] == 1) & (depths[:-1] > depth)
+    )
 
-        chr_last = chr
+    left_ranks = np.flatnonzero(is_right == 0).tolist()
+    left_ids = ids[is_right == 0].tolist()
+    active = []
+    j = 0
+    for k in peaks.tolist():
+        while j < n and left_ranks[j] <= k:
+            i = left_ids[j]
+            heappush(active, (right_rank[i], i))
+            j += 1
+        while active[0][0] <= k:
+            heappop(active)
+        overlap_set.add(tuple(sorted(i for _, i in active)))
 
     return overlap_set
 
@@ -106,45 +137,123 @@ def get_constraints(clusters, quota=(1, 1), Nmax=0):
     return nodes, constraints_x, constraints_y
 
 
-def create_data_model(nodes, constraints_x, qa, constraints_y, qb):
+def get_components(nodes, constraints_x, qa, constraints_y, qb):
     """
-    Maximize
-     4 x1 + 2 x2 + 3 x3 + x4
-    Subject To
-     x1 + x2 <= 1
-    End
-    """
-    num_vars = len(nodes)
-    obj_coeffs = nodes[:]
-    constraint_coeffs = []
-    bounds = []
-    for c in constraints_x:
-        constraint_coeffs.append({x: 1 for x in c})
-        bounds.append(qa)
-    num_constraints = len(constraints_x)
+    Split the MIP instance into independent components. Blocks that never
+    share a constraint can be solved separately, the union of the optimal
+    solutions of the components is optimal for the full instance.
 
+    Returns list of (ids, obj_coeffs, constraints, bounds), where the
+    constraints are reindexed to the positions within ids.
+    """
+    constraints = [(c, qa) for c in constraints_x]
     # non-self
     if not (constraints_x is constraints_y):
-        for c in constraints_y:
-            constraint_coeffs.append({x: 1 for x in c})
-            bounds.append(qb)
-        num_constraints += len(constraints_y)
+        constraints += [(c, qb) for c in constraints_y]
+
+    g = Grouper()
+    for c, _ in constraints:
+        g.join(*c)
+
+    groups = [sorted(ids) for ids in g]
+    group_of = dict((x, gi) for gi, ids in enumerate(groups) for x in ids)
+    component_constraints = defaultdict(list)
+    for c, bound in constraints:
+        component_constraints[group_of[c[0]]].append((c, bound))
+
+    components = []
+    for gi, ids in enumerate(groups):
+        idx = dict((x, i) for i, x in enumerate(ids))
+        cc = component_constraints[gi]
+        components.append(
+            (
+                ids,
+                [nodes[x] for x in ids],
+                [tuple(idx[x] for x in c) for c, _ in cc],
+                [bound for _, bound in cc],
+            )
+        )
 
-    return MIPDataModel(
-        constraint_coeffs, bounds, obj_coeffs, num_vars, num_constraints
-    )
+    # blocks that are not in conflict with any other block
+    for i, score in enumerate(nodes):
+        if i not in group_of:
+            components.append(([i], [score], [], []))
+
+    return components
+
+
+def greedy_solution(obj_coeffs, constraints, bounds):
+    """
+    Pick blocks in decreasing scores as long as no constraint is violated. The
+    feasible solution is used to warm start the MIP solver.
+
+    >>> greedy_solution([4, 2, 3, 1], [(0, 1), (1, 2, 3)], [1, 2])
+    [0, 2, 3]
+    """
+    var_constraints = defaultdict(list)
+    for ci, c in enumerate(constraints):
+        for x in c:
+            var_constraints[x].append(ci)
+
+    counts = [0] * len(constraints)
+    selected = []
+    for j in sorted(range(len(obj_coeffs)), key=lambda x: -obj_coeffs[x]):
+        cis = var_constraints[j]
+        if all(counts[ci] < bounds[ci] for ci in cis):
+            for ci in cis:
+                counts[ci] += 1
+            selected.append(j)
+
+    return sorted(selected)
+
+
+def solve_component(args):
+    """
+    Solve one independent component, returns the selected block ids and the
+    time spent in the solver
+    """
+    ids, obj_coeffs, constraints, bounds, work_dir, warm_start, verbose = args
+    start = time.time()
+    num_vars = len(ids)
+    if not constraints:
+        selected = [j for j in range(num_vars) if obj_coeffs[j] > 0]
+    elif len(constraints) == 1 and len(constraints[0]) == num_vars:
+        # single clique, simply keep the best blocks
+        (bound,) = bounds
+        ranked = sorted(range(num_vars), key=lambda x: -obj_coeffs[x])
+        selected = sorted(j for j in ranked[:bound] if obj_coeffs[j] > 0)
+    else:
+        hint = None
+        if warm_start:
+            greedy = set(greedy_solution(obj_coeffs, constraints, bounds))
+            hint = [int(j in greedy) for j in range(num_vars)]
+        data = MIPDataModel(
+            [{x: 1 for x in c} for c in constraints],
+            bounds,
+            obj_coeffs,
+            num_vars,
+            len(constraints),
+            hint=hint,
+        )
+        selected = data.solve(work_dir=work_dir, verbose=verbose)
+
+    return [ids[j] for j in selected], time.time() - start
 
 
 def solve_lp(
     clusters,
     quota,
-    work_dir="work",
+    work_dir=None,
     Nmax=0,
     self_match=False,
     verbose=False,
+    cpus=1,
+    warm_start=False,
 ):
     """
-    Solve the formatted LP instance
+    Solve the formatted LP instance, component by component. The fallback
+    solvers write to `work_dir`, a fresh temporary directory by default so
+    that concurrent solves do not overwrite each other's files.
     """
     qb, qa = quota  # flip it
     nodes, constraints_x, constraints_y = get_constraints(clusters, (qa, qb), Nmax=Nmax)
@@ -152,8 +261,56 @@ def solve_lp(
     if self_match:
         constraints_x = constraints_y = constraints_x | constraints_y
 
-    data = create_data_model(nodes, constraints_x, qa, constraints_y, qb)
-    return data.solve(work_dir=work_dir, verbose=verbose)
+    components = get_components(nodes, constraints_x, qa, constraints_y, qb)
+    # solve the largest components first for better load balancing
+    components.sort(key=lambda x: (-len(x[2]), x[0]))
+    nmip = sum(1 for x in components if len(x[2]) > 1)
+    logger.debug(
+        "A total of %d components (%d require MIP) from %d blocks",
+        len(components),
+        nmip,
+        len(nodes),
+    )
+
+    own_work_dir = work_dir is None
+    if own_work_dir:
+        work_dir = mkdtemp(prefix="quota-")
+    tasks = [
+        (
+            ids,
+            obj_coeffs,
+            constraints,
+            bounds,
+            op.join(work_dir, "component{}".format(i)),
+            warm_start,
+            verbose,
+        )
+        for i, (ids, obj_coeffs, constraints, bounds) in enumerate(components)
+    ]
+    cpus = min(cpus, nmip)
+    try:
+        if cpus > 1:
+            with Pool(processes=cpus) as pool:
+                results = pool.map(solve_component, tasks)
+        else:
+            results = [solve_component(x) for x in tasks]
+    finally:
+        if own_work_dir:
+            cleanup(work_dir)
+
+    selected_ids = []
+    for (ids, _, constraints, _), (selected, elapsed) in zip(components, results):
+        if len(constraints) > 1:
+            logger.debug(
+                "Component with %d blocks and %d constraints solved in %.2fs",
+                len(ids),
+                len(constraints),
+                elapsed,
+            )
+        selected_ids.extend(selected)
+
+    logger.debug("Total solver time %.2fs", sum(elapsed for _, elapsed in results))
+    return sorted(selected_ids)
 
 
 def read_clusters(qa_file, qorder, sorder):
@@ -212,6 +369,13 @@ def main(args):
         help="you might turn this on when screening paralogous blocks, "
         "esp. if you have reduced mirrored blocks into non-redundant set",
     )
+    p.add_argument(
+        "--warm_start",
+        default=False,
+        action="store_true",
+        help="warm start the MIP solver with a greedy solution",
+    )
+    p.set_cpus(cpus=1)
     p.set_verbose(help="Show verbose solver output")
 
     p.add_argument(
@@ -253,15 +417,14 @@ def main(args):
         assert len(cluster) > 0
 
     # below runs `quota mapping`
-    work_dir = op.join(op.dirname(op.abspath(qa_file)), "work")
-
     selected_ids = solve_lp(
         clusters,
         quota,
-        work_dir=work_dir,
         Nmax=opts.Nmax,
         self_match=self_match,
         verbose=opts.verbose,
+        cpus=opts.cpus,
+        warm_start=opts.warm_start,
     )
 
     logger.debug("Selected %d blocks", len(selected_ids))
@@ -19,24 +19,137 @@ S is "Syntelog", which means it has a match to the region. In this case, the mat
 itself is used to represent the region.  The number in the 4th column is the
 synteny score. For the same query, it is ordered with decreasing synteny score.
 The last column means orientation. "+" is same direction.
+
+With --sqlite the results are loaded into a `synteny` table in batches; with
+--shards they are split into TSV or Parquet files of --batch_size rows each.
 """
+
 import os.path as op
 import sqlite3
 import sys
 
-from bisect import bisect_left
+from abc import ABC, abstractmethod
+from bisect import bisect_left, insort
 from itertools import groupby, tee
+from multiprocessing import Pool
 
 from ..algorithms.lis import (
     longest_increasing_subsequence,
     longest_decreasing_subsequence,
 )
-from ..apps.base import OptionParser, logger
+from ..apps.base import OptionParser, logger, mkdir
 from ..formats.base import must_open
 from ..utils.grouper import Grouper
 
 from .synteny import check_beds, read_blast
 
+SYNTENY_FIELDS = (
+    "query",
+    "anchor",
+    "gray",
+    "score",
+    "dr",
+    "orientation",
+    "qnote",
+    "snote",
+)
+
+
+class SyntenyWriter(ABC):
+    """
+    Buffers rows and hands them to flush() every batch_size rows.
+    """
+
+    def __init__(self, batch_size=10000):
+        self.batch_size = batch_size
+        self.buffer = []
+
+    def write(self, row):
+        self.buffer.append(row)
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+            self.buffer = []
+
+    @abstractmethod
+    def flush(self):
+        """Write out the rows in `self.buffer`."""
+
+    def close(self):
+        if self.buffer:
+            self.flush()
+            self.buffer = []
+
+
+class SyntenyDB(SyntenyWriter):
+    """
+    Buffered writer to the sqlite synteny table. Rows are inserted with
+    executemany() every batch_size rows, the index is built after loading.
+    """
+
+    def __init__(self, filename, batch_size=10000):
+        super().__init__(batch_size=batch_size)
+        self.filename = filename
+        self.conn = sqlite3.connect(filename)
+        c = self.cursor = self.conn.cursor()
+        c.execute("pragma journal_mode=wal")
+        c.execute("pragma synchronous=normal")
+        c.execute("drop table if exists synteny")
+        c.execute(
+            "create table synteny (query text, anchor text, "
+            "gray varchar(1), score integer, dr integer, "
+            "orientation varchar(1), qnote text, snote text)"
+        )
+
+    def flush(self):
+        self.cursor.executemany(
+            "insert into synteny values (?,?,?,?,?,?,?,?)", self.buffer
+        )
+        self.conn.commit()
+
+    def close(self):
+        super().close()
+        logger.debug("Create index on `%s`", self.filename)
+        self.cursor.execute("create index q on synteny (query)")
+        self.conn.commit()
+        self.cursor.close()
+        self.conn.close()
+
+
+class SyntenyShards(SyntenyWriter):
+    """
+    Buffered writer that emits every batch_size rows into a separate TSV or
+    Parquet file under outdir, as an alternative to the sqlite database.
+    """
+
+    def __init__(self, outdir, batch_size=10000, fmt="tsv"):
+        assert fmt in ("tsv", "parquet"), "Unknown shard format `{}`".format(fmt)
+        super().__init__(batch_size=batch_size)
+        self.outdir = outdir
+        self.fmt = fmt
+        self.nshards = 0
+        mkdir(outdir)
+
+    def flush(self):
+        shardfile = op.join(
+            self.outdir, "synteny.{:05d}.{}".format(self.nshards, self.fmt)
+        )
+        if self.fmt == "parquet":
+            import pandas as pd
+
+            df = pd.DataFrame(self.buffer, columns=SYNTENY_FIELDS)
+            df.to_parquet(shardfile, index=False)
+        else:
+            fw = open(shardfile, "w")
+            print("\t".join(SYNTENY_FIELDS), file=fw)
+            for row in self.buffer:
+                print("\t".join(str(x) for x in row), file=fw)
+            fw.close()
+        self.nshards += 1
+
+    def close(self):
+        super().close()
+        logger.debug("A total of %d shards written to `%s`", self.nshards, self.outdir)
+
 
 def transposed(data):
     x, y = zip(*data)
@@ -86,7 +199,41 @@ def find_synteny_region(query, sbed, data, window, cutoff, colinear=False):
         if pos2 - pos1 < window and sbed[pos1].seqid == sbed[pos2].seqid:
             g.join(ia, ib)
 
-    for group in sorted(g):
+    return score_synteny_groups(query, sorted(g), cutoff, colinear=colinear)
+
+
+def get_synteny_groups(ysorted, sseqids, window):
+    """
+    Single linkage of anchors sorted by subject rank, neighbors are linked if
+    they are within window and on the same subject seqid. Returns groups with
+    at least two anchors, as (query rank, subject rank), sorted like Grouper.
+
+    >>> get_synteny_groups([(1, 5), (2, 3), (9, 4), (10, 6)], "aaaa" + "ab" * 4, 3)
+    [[(5, 1), (3, 2)]]
+    """
+    groups = []
+    group = []
+    last_y = None
+    for y, x in ysorted:
+        if group and (y - last_y >= window or sseqids[last_y] != sseqids[y]):
+            if len(group) > 1:
+                groups.append(group)
+            group = []
+        group.append((x, y))
+        last_y = y
+    if len(group) > 1:
+        groups.append(group)
+
+    return sorted(groups)
+
+
+def score_synteny_groups(query, groups, cutoff, colinear=False):
+    """
+    Score the single linkage groups around query, and return the syntenic
+    regions in decreasing synteny score
+    """
+    regions = []
+    for group in groups:
         (qflanker, syntelog), (far_flanker, far_syntelog), flanked = get_flanker(
             group, query
         )
@@ -128,7 +275,40 @@ def find_synteny_region(query, sbed, data, window, cutoff, colinear=False):
     return sorted(regions, key=lambda x: -x[-1])  # decreasing synteny score
 
 
-def batch_query(qbed, sbed, all_data, opts, fw=None, c=None, transpose=False):
+def scan_seqid(args):
+    """
+    Slide the window along one query seqid. Anchors in the window are kept
+    sorted by subject rank, updated as the window moves, so each query only
+    needs one linear pass to find its synteny groups.
+    """
+    ranks, data, sseqids, window, cutoff, colinear = args
+    n = len(data)
+    ysorted = []
+    lo = hi = 0
+    results = []
+    for r in ranks:
+        rmin = max(r - window, ranks[0])
+        rmax = min(r + window + 1, ranks[-1])
+        while lo < n and data[lo][0] < rmin:
+            if lo < hi:
+                x, y = data[lo]
+                del ysorted[bisect_left(ysorted, (y, x))]
+            lo += 1
+        hi = max(hi, lo)
+        while hi < n and data[hi][0] < rmax:
+            x, y = data[hi]
+            insort(ysorted, (y, x))
+            hi += 1
+
+        groups = get_synteny_groups(ysorted, sseqids, window)
+        regions = score_synteny_groups(r, groups, cutoff, colinear=colinear)
+        if regions:
+            results.append((r, regions))
+
+    return results
+
+
+def batch_query(qbed, sbed, all_data, opts, fw=None, db=None, transpose=False):
 
     cutoff = int(opts.cutoff * opts.window)
     window = opts.window / 2
@@ -144,24 +324,29 @@ def batch_query(qbed, sbed, all_data, opts, fw=None, c=None, transpose=False):
         qbed, sbed = sbed, qbed
         qnote, snote = snote, qnote
 
-    all_data.sort()
+    all_data = sorted(all_data)
 
     def simple_bed(x):
         return sbed[x].seqid, sbed[x].start
 
     qsimplebed = qbed.simple_bed
+    sseqids = [x.seqid for x in sbed]
 
+    # partition the anchors by query seqid
+    tasks = []
     for seqid, ranks in groupby(qsimplebed, key=lambda x: x[0]):
         ranks = [x[1] for x in ranks]
-        for r in ranks:
-            rmin = max(r - window, ranks[0])
-            rmax = min(r + window + 1, ranks[-1])
-            rmin_pos = bisect_left(all_data, (rmin, 0))
-            rmax_pos = bisect_left(all_data, (rmax, 0))
-            data = all_data[rmin_pos:rmax_pos]
-            regions = find_synteny_region(
-                r, sbed, data, window, cutoff, colinear=colinear
-            )
+        start = bisect_left(all_data, (ranks[0], 0))
+        end = bisect_left(all_data, (ranks[-1] + 1, 0))
+        data = all_data[start:end]
+        tasks.append((ranks, data, sseqids, window, cutoff, colinear))
+
+    cpus = min(opts.cpus, len(tasks))
+    pool = Pool(processes=cpus) if cpus > 1 else None
+    results = pool.imap(scan_seqid, tasks) if pool else map(scan_seqid, tasks)
+
+    for seqid_results in results:
+        for r, regions in seqid_results:
             for (
                 syntelog,
                 far_syntelog,
@@ -200,7 +385,11 @@ def batch_query(qbed, sbed, all_data, opts, fw=None, c=None, transpose=False):
                 if fw:
                     print("\t".join(str(x) for x in pdata), file=fw)
                     continue
-                c.execute("insert into synteny values (?,?,?,?,?,?,?,?)", pdata)
+                db.write(pdata)
+
+    if pool:
+        pool.close()
+        pool.join()
 
 
 def main(blastfile, p, opts):
@@ -212,30 +401,24 @@ def main(blastfile, p, opts):
     )
     all_data = [(b.qi, b.si) for b in filtered_blast]
 
-    c = None
+    db = fw = None
     if sqlite:
-        conn = sqlite3.connect(sqlite)
-        c = conn.cursor()
-        c.execute("drop table if exists synteny")
-        c.execute(
-            "create table synteny (query text, anchor text, "
-            "gray varchar(1), score integer, dr integer, "
-            "orientation varchar(1), qnote text, snote text)"
+        db = SyntenyDB(sqlite, batch_size=opts.batch_size)
+    elif opts.shards:
+        db = SyntenyShards(
+            opts.shards, batch_size=opts.batch_size, fmt=opts.shard_format
         )
-        fw = None
     else:
         fw = must_open(opts.outfile, "w")
 
-    batch_query(qbed, sbed, all_data, opts, fw=fw, c=c, transpose=False)
+    batch_query(qbed, sbed, all_data, opts, fw=fw, db=db, transpose=False)
     if qbed.filename == sbed.filename:
         logger.debug("Self comparisons, mirror ignored")
     else:
-        batch_query(qbed, sbed, all_data, opts, fw=fw, c=c, transpose=True)
+        batch_query(qbed, sbed, all_data, opts, fw=fw, db=db, transpose=True)
 
-    if sqlite:
-        c.execute("create index q on synteny (query)")
-        conn.commit()
-        c.close()
+    if db:
+        db.close()
     else:
         fw.close()
 
@@ -246,9 +429,25 @@ if __name__ == "__main__":
     p.set_beds()
     p.set_stripnames()
     p.set_outfile()
+    p.set_cpus(cpus=1)
 
     coge_group = p.add_argument_group("CoGe-specific options")
     coge_group.add_argument("--sqlite", help="Write sqlite database")
+    coge_group.add_argument(
+        "--shards", help="Write TSV/Parquet shards into this folder instead"
+    )
+    coge_group.add_argument(
+        "--shard_format",
+        choices=("tsv", "parquet"),
+        default="tsv",
+        help="Format of the shards",
+    )
+    coge_group.add_argument(
+        "--batch_size",
+        type=int,
+        default=10000,
+        help="Number of rows per sqlite batch insert or per shard",
+    )
     coge_group.add_argument("--qnote", default="null", help="Query dataset group id")
     coge_group.add_argument("--snote", default="null", help="Subject dataset group id")
 
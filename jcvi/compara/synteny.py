@@ -1,13 +1,12 @@
 #!/usr/bin/env python
 # -*- coding: UTF-8 -*-
 
-"""Syntenty inference in comparative genomics
-"""
+"""Syntenty inference in comparative genomics"""
 
 import os.path as op
 import sys
 
-from collections import defaultdict
+from collections import Counter, defaultdict
 from collections.abc import Iterable
 
 import numpy as np
@@ -19,7 +18,7 @@ from ..formats.bed import Bed, BedLine
 from ..formats.blast import Blast
 from ..utils.cbook import gene_name, human_size
 from ..utils.grouper import Grouper
-from ..utils.range import range_chain
+from ..utils.range import range_chain_tracks
 
 from .base import AnchorFile
 
@@ -1254,13 +1253,19 @@ def screen(args):
     p.add_argument(
         "--simple", action="store_true", help="Write simple anchorfile with block ends"
     )
+    p.add_argument(
+        "--cache",
+        default=False,
+        action="store_true",
+        help="Keep the parsed anchors in `anchorfile.npz` for later runs",
+    )
     opts, args = p.parse_args(args)
 
     if len(args) != 2:
         sys.exit(not p.print_help())
 
     anchorfile, newanchorfile = args
-    ac = AnchorFile(anchorfile)
+    ac = AnchorFile(anchorfile, cache=opts.cache)
     idsfile = opts.ids
     seqidsfile = opts.seqids
     seqpairsfile = opts.seqpairs
@@ -1284,25 +1289,26 @@ def screen(args):
             seqpairs.add((b, a))
 
     qbed, sbed, qorder, sorder, is_self = check_beds(anchorfile, p, opts)
-    blocks = ac.blocks
+    nblocks = ac.nblocks
+    sizes = ac.sizes.tolist()
+    qmin, qmax, smin, smax = ac.block_spans(qorder, sorder)
     selected = 0
     fw = open(newanchorfile, "w")
 
-    for i, block in enumerate(blocks):
+    for i in range(nblocks):
         if ids and i not in ids:
             continue
+        # An empty block has no genes to take the seqids and spans from
+        if not sizes[i]:
+            continue
 
-        a, b, scores = zip(*block)
-        a = [qorder[x] for x in a]
-        b = [sorder[x] for x in b]
-        ia, oa = zip(*a)
-        ib, ob = zip(*b)
-        min_ia, max_ia = min(ia), max(ia)
-        min_ib, max_ib = min(ib), max(ib)
+        lo = ac.offsets[i]
+        min_ia, max_ia = int(qmin[i]), int(qmax[i])
+        min_ib, max_ib = int(smin[i]), int(smax[i])
         aspan = max_ia - min_ia + 1
         bspan = max_ib - min_ib + 1
-        aseqid = oa[0].seqid
-        bseqid = ob[0].seqid
+        aseqid = qorder[ac.genes[ac.qi[lo]]][1].seqid
+        bseqid = sorder[ac.genes[ac.si[lo]]][1].seqid
 
         if seqids:
             if (aseqid not in seqids) or (bseqid not in seqids):
@@ -1322,7 +1328,7 @@ def screen(args):
                 continue
 
         if minsize:
-            if len(block) < minsize:
+            if sizes[i] < minsize:
                 continue
 
         if minspan:
@@ -1331,7 +1337,7 @@ def screen(args):
 
         selected += 1
         print("###", file=fw)
-        for line in block:
+        for line in ac.block_rows(i):
             print("\t".join(line), file=fw)
 
     fw.close()
@@ -1346,7 +1352,7 @@ def screen(args):
             ]
         )
 
-    logger.debug("Before: {0} blocks, After: {1} blocks".format(len(blocks), selected))
+    logger.debug("Before: {0} blocks, After: {1} blocks".format(nblocks, selected))
 
 
 def summary(args):
@@ -1475,6 +1481,12 @@ def mcscan(args):
         help="merge tandems genes in output acoording to PATH-TO-TANDEM_FILE, "
         "cannot be used with --ascii",
     )
+    p.add_argument(
+        "--cache",
+        default=False,
+        action="store_true",
+        help="Keep the parsed anchors in `anchorfile.npz` for later runs",
+    )
     p.set_outfile()
     opts, args = p.parse_args(args)
 
@@ -1503,45 +1515,44 @@ def mcscan(args):
             for atom in row:
                 tandems[atom] = s
 
-    ac = AnchorFile(anchorfile)
+    ac = AnchorFile(anchorfile, cache=opts.cache)
     ranges, block_pairs = ac.make_ranges(order, clip=clip)
 
     fw = must_open(ofile, "w")
 
     tracks = []
     print("Chain started: {0} blocks".format(len(ranges)), file=sys.stderr)
-    iteration = 0
-    while ranges:
+    remaining = len(ranges)
+    nranges = Counter(x.id for x in ranges)
+    for iteration, (selected, score) in enumerate(range_chain_tracks(ranges)):
         if iteration >= opts.iter:
             break
 
-        selected, score = range_chain(ranges)
-        tracks.append(selected)
+        # first block in the track wins if a gene is covered twice
+        track = {}
+        for x in selected:
+            for a, b in block_pairs[x.id].items():
+                track.setdefault(a, b)
+        tracks.append(track)
         selected = set(x.id for x in selected)
         if trackids:
             print(",".join(str(x) for x in sorted(selected)), file=fwlog)
 
-        ranges = [x for x in ranges if x.id not in selected]
+        remaining -= sum(nranges[x] for x in selected)
         msg = "Chain {0}: score={1}".format(iteration, score)
-        if ranges:
-            msg += " {0} blocks remained..".format(len(ranges))
+        if remaining:
+            msg += " {0} blocks remained..".format(remaining)
         else:
             msg += " done!"
 
         print(msg, file=sys.stderr)
-        iteration += 1
 
     mbed = []
     for b in bed:
         id = b.accn
         atoms = []
         for track in tracks:
-            track_ids = [x.id for x in track]
-            for tid in track_ids:
-                pairs = block_pairs[tid]
-                anchor = pairs.get(id, ".")
-                if anchor != ".":
-                    break
+            anchor = track.get(id, ".")
             if ascii and anchor != ".":
                 anchor = "x"
             atoms.append(anchor)
@@ -1588,6 +1599,12 @@ def depth(args):
     p.add_argument("--xmax", type=int, help="x-axis maximum to display in plot")
     p.add_argument("--title", default=None, help="Title to display in plot")
     p.add_argument("--quota", help="Force to use this quota, e.g. 1:1, 1:2 ...")
+    p.add_argument(
+        "--cache",
+        default=False,
+        action="store_true",
+        help="Keep the parsed anchors in `anchorfile.npz` for later runs",
+    )
     p.set_beds()
 
     opts, args = p.parse_args(args)
@@ -1598,20 +1615,12 @@ def depth(args):
     (anchorfile,) = args
     qbed, sbed, qorder, sorder, is_self = check_beds(anchorfile, p, opts)
     depthfile = opts.depthfile
-    ac = AnchorFile(anchorfile)
-    qranges = []
-    sranges = []
-    blocks = ac.blocks
-    for ib in blocks:
-        q, s, t = zip(*ib)
-        q = [qorder[x] for x in q]
-        s = [sorder[x] for x in s]
-        qrange = (min(q)[0], max(q)[0])
-        srange = (min(s)[0], max(s)[0])
-        qranges.append(qrange)
-        sranges.append(srange)
-        if is_self:
-            qranges.append(srange)
+    ac = AnchorFile(anchorfile, cache=opts.cache)
+    qmin, qmax, smin, smax = ac.block_spans(qorder, sorder)
+    qranges = list(zip(qmin.tolist(), qmax.tolist()))
+    sranges = list(zip(smin.tolist(), smax.tolist()))
+    if is_self:
+        qranges = [x for pair in zip(qranges, sranges) for x in pair]
 
     qgenome = op.basename(qbed.filename).split(".")[0]
     sgenome = op.basename(sbed.filename).split(".")[0]
@@ -34,6 +34,8 @@ from copy import deepcopy
 from random import sample
 from typing import Optional
 
+import numpy as np
+
 from ..apps.base import OptionParser, logger, need_update
 from ..compara.base import AnchorFile
 from ..compara.synteny import batch_scan, check_beds, get_orientation
@@ -91,7 +93,13 @@ class Palette(dict):
 
     @classmethod
     def from_block_orientation(
-        cls, anchorfile, qbed, sbed, forward_color="#e7298a", reverse_color="#3690c0"
+        cls,
+        anchorfile,
+        qbed,
+        sbed,
+        forward_color="#e7298a",
+        reverse_color="#3690c0",
+        cache=False,
     ):
         """Generate a palette which contains mapping from block_id (1-based) to colors.
 
@@ -101,22 +109,17 @@ class Palette(dict):
             sbed (BedFile): Subject BED
             forward_color (str, optional): Color of forward block. Defaults to "#e7298a".
             reverse_color (str, optional): Color of reverse block. Defaults to "#3690c0".
+            cache (bool, optional): Keep the parsed anchors in `anchorfile.npz`. Defaults to False.
         """
-        ac = AnchorFile(anchorfile)
-        blocks = ac.blocks
+        ac = AnchorFile(anchorfile, cache=cache)
         palette = {}
-        qorder = qbed.order
-        sorder = sbed.order
+        qranks = ac.ranks(qbed.order)[ac.qi]
+        sranks = ac.ranks(sbed.order)[ac.si]
+        offsets = ac.offsets.tolist()
 
-        for i, block in enumerate(blocks):
+        for i, (lo, hi) in enumerate(zip(offsets, offsets[1:])):
             block_id = i + 1
-
-            a, b, _ = zip(*block)
-            a = [qorder[x] for x in a]
-            b = [sorder[x] for x in b]
-            ia, _ = zip(*a)
-            ib, _ = zip(*b)
-
+            ia, ib = qranks[lo:hi], sranks[lo:hi]
             orientation = get_orientation(ia, ib)
             palette[block_id] = reverse_color if orientation == "-" else forward_color
         return cls(palettedict=palette)
@@ -263,11 +266,12 @@ def dotplot(
     stdpf: bool = True,
     chpf: bool = True,
     usetex: bool = True,
+    cache: bool = False,
 ):
     """
     Draw a dotplot from an anchor file.
     """
-    fp = open(anchorfile, encoding="utf-8")
+    ac = AnchorFile(anchorfile, cache=cache)
     # add genome names
     if genomenames:
         gx, gy = genomenames.split("_")
@@ -281,51 +285,30 @@ def dotplot(
     qorder = qbed.order
     sorder = sbed.order
 
-    data = []
     if cmap_text:
         logger.debug("Capping values within [%.1f, %.1f]", vmin, vmax)
 
-    block_id = 0
-    block_color = "k"
-    for row in fp:
-        atoms = row.split()
-        if row[0] == "#":
-            block_id += 1
-            block_color = palette.get(block_id, "k") if palette else None
-            continue
-
-        # first two columns are query and subject, and an optional third column
-        if len(atoms) < 2:
-            continue
-
-        query, subject = atoms[:2]
-        value = atoms[-1]
-
-        if cmap_text:
-            try:
-                value = float(value)
-            except ValueError:
-                value = vmax
-
-            if value < vmin:
-                continue
-            if value > vmax:
-                continue
-        else:
-            value = 0
-
-        if query not in qorder:
-            continue
-        if subject not in sorder:
-            continue
+    # first two columns are query and subject, and an optional third column
+    qi = ac.ranks(qorder)[ac.qi]
+    si = ac.ranks(sorder)[ac.si]
+    keep = (qi >= 0) & (si >= 0)
+    if cmap_text:
+        # Lifted (`L`) and missing scores are capped at vmax
+        values = ac.weights
+        values[np.isnan(values) | np.char.endswith(ac.scores, "L")] = vmax
+        keep &= (values >= vmin) & (values <= vmax)
+    else:
+        values = np.zeros(len(qi), dtype=int)
 
-        qi, q = qorder[query]
-        si, s = sorder[subject]
+    if palette:
+        block_colors = [palette.get(i + 1, "k") for i in range(ac.nblocks)]
+        values = np.array(block_colors, dtype=object)[ac.block_ids]
 
-        nv = block_color or value
-        data.append((qi, si, nv))
-        if is_self:  # Mirror image
-            data.append((si, qi, nv))
+    qi, si, values = qi[keep].tolist(), si[keep].tolist(), values[keep].tolist()
+    data = list(zip(qi, si, values))
+    if is_self:  # Mirror image
+        mirror = list(zip(si, qi, values))
+        data = [x for pair in zip(data, mirror) for x in pair]
 
     npairs = len(data)
     data = downsample(data, sample_number=sample_number)
@@ -459,6 +442,12 @@ def dotplot_main(args):
         "--nosep", default=False, action="store_true", help="Do not add contig lines"
     )
     p.add_argument("--title", help="Title of the dot plot")
+    p.add_argument(
+        "--cache",
+        default=False,
+        action="store_true",
+        help="Keep the parsed anchors in `anchorfile.npz` for later runs",
+    )
     p.set_dotplot_opts()
     p.set_outfile(outfile=None)
     opts, args, iopts = p.set_image_options(
@@ -477,7 +466,9 @@ def dotplot_main(args):
     if palette:
         palette = Palette(palettefile=palette)
     elif opts.colororientation:
-        palette = Palette.from_block_orientation(anchorfile, qbed, sbed)
+        palette = Palette.from_block_orientation(
+            anchorfile, qbed, sbed, cache=opts.cache
+        )
 
     cmaptext = opts.cmaptext
     if anchorfile.endswith(".ks"):
@@ -492,7 +483,7 @@ def dotplot_main(args):
         anchorfile = anchorksfile
 
     if opts.skipempty:
-        ac = AnchorFile(anchorfile)
+        ac = AnchorFile(anchorfile, cache=opts.cache)
         if is_self:
             qseqids = sseqids = set()
         else:
@@ -538,6 +529,7 @@ def dotplot_main(args):
         stdpf=(not opts.nostdpf),
         chpf=(not opts.nochpf),
         usetex=iopts.usetex,
+        cache=opts.cache,
     )
 
     image_name = opts.outfile or (op.splitext(anchorfile)[0] + "." + opts.format)
@@ -108,6 +108,99 @@ class Grouper(object):
         return self._mapping.keys()
 
 
+class UnionFind(object):
+    """
+    Disjoint sets over the integers 0..n-1, kept in a single parent array so
+    that millions of members cost a few bytes each. Joins are applied a batch
+    at a time, with each batch resolved as a graph over the current roots.
+
+    >>> uf = UnionFind(6)
+    >>> uf.union([0, 3], [1, 4])
+    >>> uf.union([1], [2])
+    >>> [x.tolist() for x in uf]
+    [[0, 1, 2], [3, 4], [5]]
+    >>> uf.joined(0, 2), uf.joined(0, 3)
+    (True, False)
+    """
+
+    def __init__(self, n=0):
+        import numpy as np
+
+        self.parent = np.arange(n)
+
+    def __len__(self):
+        return len(self.parent)
+
+    def resize(self, n):
+        """
+        Add singleton sets so that ids up to n-1 are valid.
+        """
+        import numpy as np
+
+        if n > len(self.parent):
+            self.parent = np.concatenate((self.parent, np.arange(len(self.parent), n)))
+
+    def find(self, x):
+        """
+        Roots of the given ids, compressing their paths along the way.
+        """
+        import numpy as np
+
+        x = np.asarray(x, dtype=int)
+        root = self.parent[x]
+        while True:
+            up = self.parent[root]
+            if (up == root).all():
+                break
+            root = up
+        self.parent[x] = root
+        return root
+
+    def union(self, a, b):
+        """
+        Join a[i] with b[i] for every i.
+        """
+        import numpy as np
+
+        from scipy.sparse import csr_matrix
+        from scipy.sparse.csgraph import connected_components
+
+        ra, rb = self.find(a), self.find(b)
+        keep = ra != rb
+        if not keep.any():
+            return
+        roots, inv = np.unique(
+            np.concatenate((ra[keep], rb[keep])), return_inverse=True
+        )
+        k = len(inv) // 2
+        graph = csr_matrix(
+            (np.ones(k, dtype=bool), (inv[:k], inv[k:])), shape=(len(roots),) * 2
+        )
+        _, labels = connected_components(graph, directed=False)
+        # roots are sorted, so the first root seen per label is the smallest
+        _, first = np.unique(labels, return_index=True)
+        self.parent[roots] = roots[first][labels]
+
+    def joined(self, a, b):
+        """
+        Returns True if a and b are members of the same set.
+        """
+        return bool(self.find(a) == self.find(b))
+
+    def __iter__(self):
+        """
+        Returns an iterator over the disjoint sets, each an array of sorted ids,
+        ordered by their smallest member.
+        """
+        import numpy as np
+
+        roots = self.find(np.arange(len(self.parent)))
+        order = np.argsort(roots, kind="stable")
+        bounds = np.flatnonzero(np.diff(roots[order])) + 1
+        groups = np.split(order, bounds) if len(order) else []
+        return iter(sorted(groups, key=lambda x: x[0]))
+
+
 if __name__ == "__main__":
     import doctest
 
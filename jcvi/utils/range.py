@@ -5,8 +5,10 @@
 This script implements algorithm for finding intersecting rectangles,
 both on the 2D dotplot and 1D-projection
 
-`range_chain` implements the exon-chain algorithm
+`range_chain` implements the exon-chain algorithm, `range_chain_tracks`
+repeats it to stack multiple non-overlapping tracks
 """
+
 import sys
 
 from collections import namedtuple, defaultdict
@@ -14,7 +16,6 @@ from itertools import groupby
 
 from more_itertools import pairwise
 
-
 LEFT, RIGHT = 0, 1
 Range = namedtuple("Range", "seqid start end score id")
 
@@ -426,7 +427,71 @@ def range_chain(ranges):
     ([Range(seqid='2', start=0, end=1, score=3, id=0), Range(seqid='3', start=5, end=7, score=3, id=2)], 6)
     """
     endpoints = _make_endpoints(ranges)
+    chains, score = _chain_endpoints(endpoints)
+    selected = [ranges[x] for x in chains]
+
+    return selected, score
 
+
+def range_chain_tracks(ranges):
+    """
+    Repeatedly take the best chain out of the ranges, same as calling
+    range_chain() and removing the ranges with the selected ids in a loop, but
+    the endpoints are only sorted once. The chaining decomposes over the piles
+    (see range_piles()), so after each round only the piles that lost ranges
+    are split and chained again. Yields (selected, score) until no range is
+    left.
+
+    >>> ranges = [Range("1", 0, 9, 22, 0), Range("1", 3, 18, 24, 1), Range("1", 10, 28, 20, 2)]
+    >>> for selected, score in range_chain_tracks(ranges):
+    ...     print([x.id for x in selected], score)
+    [0, 2] 42
+    [1] 24
+    """
+    if not ranges:
+        return
+
+    ids = [x.id for x in ranges]
+    piles = [(x, _chain_endpoints(x)) for x in _split_piles(_make_endpoints(ranges))]
+    while piles:
+        chains = []
+        score = 0
+        for _, (chain, chain_score) in piles:
+            chains.extend(chain)
+            score += chain_score
+        yield [ranges[x] for x in chains], score
+
+        selected = set(ids[x] for x in chains)
+        updated_piles = []
+        for pile, chain in piles:
+            if not any(ids[x[3]] in selected for x in pile):  # unaffected
+                updated_piles.append((pile, chain))
+                continue
+            pile = [x for x in pile if ids[x[3]] not in selected]
+            updated_piles.extend((x, _chain_endpoints(x)) for x in _split_piles(pile))
+        piles = updated_piles
+
+
+def _split_piles(endpoints):
+    """
+    Split sorted endpoints into piles, which are only interrupted by regions of
+    zero coverage.
+    """
+    pile = []
+    depth = 0
+    for endpoint in endpoints:
+        pile.append(endpoint)
+        depth += 1 if endpoint[2] == LEFT else -1
+        if depth == 0:
+            yield pile
+            pile = []
+
+
+def _chain_endpoints(endpoints):
+    """
+    Exon-chain dynamic programming over sorted endpoints, returns the indices
+    of the chained ranges and the total score.
+    """
     # stores the left end index for quick retrieval
     left_index = {}
     # dynamic programming, each entry [score, from_index, which_chain]
@@ -457,9 +522,7 @@ def range_chain(ranges):
 
     chains.reverse()
 
-    selected = [ranges[x] for x in chains]
-
-    return selected, score
+    return chains, score
 
 
 def ranges_depth(ranges, sizes, verbose=True):
@@ -31,3 +31,67 @@ def test_ec(input_array, expected):
 
     assert list(tour) == expected
     assert tour.fitness == creator.FitnessMax((200.0,))
+
+
+def test_evaluate_delta():
+    import random
+
+    from jcvi.algorithms.ec import GA_setup, evaluate, genome_mutation
+
+    def weighted(tour):
+        return (sum(i * x for i, x in enumerate(tour)),)
+
+    def weighted_delta(tour, lo, hi, segment):
+        return sum(i * (x - y) for i, x, y in zip(range(lo, hi), tour[lo:hi], segment))
+
+    toolbox = GA_setup(list(range(10)))
+    toolbox.register("evaluate", weighted)
+    toolbox.register("evaluate_delta", weighted_delta)
+    random.seed(1)
+    for _ in range(20):
+        ind = toolbox.individual()
+        random.shuffle(ind)
+        evaluate(toolbox, [ind])
+        (mutant,) = genome_mutation(toolbox.clone(ind))
+        assert hasattr(mutant, "move")
+        del mutant.fitness.values
+        evaluate(toolbox, [mutant])
+        assert not hasattr(mutant, "move")
+        assert mutant.fitness.values == weighted(mutant)
+
+
+def test_ga_islands():
+    from jcvi.algorithms.ec import (
+        GA_setup,
+        GA_run,
+        colinear_evaluate,
+        eaIslands,
+        make_data,
+    )
+
+    scaffolds = make_data(200, 20)
+    guess = list(range(20))
+    guess[5:15] = guess[5:15][::-1]
+    guess[7:18] = guess[7:18][::-1]
+    tours = []
+    for cpus in (1, 3):
+        toolbox = GA_setup(guess)
+        toolbox.register("evaluate", colinear_evaluate, scaffolds=scaffolds)
+        gens = []
+        tour, fitness = GA_run(
+            toolbox,
+            ngen=100,
+            npop=50,
+            cpus=cpus,
+            islands=3,
+            callback=lambda tour, gen: gens.append(gen),
+        )
+        assert fitness.values == (200.0,) and gens[:2] == [20, 40]
+        tours.append((list(tour), gens))
+    assert tours[0] == tours[1]  # Same islands in serial or in parallel
+
+    # The hall of fame is optional
+    population = eaIslands(
+        toolbox, 2, 10, 0.7, 0.2, 20, interval=10, cpus=1, verbose=False
+    )
+    assert len(population) == 20
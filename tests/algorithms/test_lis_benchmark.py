@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+
+import random
+import time
+
+import pytest
+
+
+def heaviest_increasing_subsequence_weight(a):
+    """
+    Previous quadratic implementation, kept here as a reference to check and
+    benchmark against the Fenwick tree version
+    """
+    L = {0: -1}
+    for i, (key, weight) in enumerate(a):
+        for w, j in list(L.items()):
+            if j != -1 and a[j][0] >= key:
+                continue
+            new_weight = w + weight
+            if new_weight in L and a[L[new_weight]][0] <= key:
+                continue
+            L[new_weight] = i
+    return max(L)
+
+
+def make_data(size=2000, seed=666):
+    random.seed(seed)
+    return [(random.randint(0, size), random.randint(1, 100)) for _ in range(size)]
+
+
+def test_heaviest_increasing_subsequence_weight():
+    from jcvi.algorithms.lis import heaviest_increasing_subsequence
+
+    for seed in range(20):
+        a = make_data(size=200, seed=seed)
+        seq, weight = heaviest_increasing_subsequence(a)
+        assert weight == heaviest_increasing_subsequence_weight(a)
+        assert sum(w for _, w in seq) == weight
+        assert all(x[0] < y[0] for x, y in zip(seq, seq[1:]))
+
+
+@pytest.mark.benchmark(
+    group="heaviest increasing subsequence", timer=time.time, warmup=False
+)
+def test_his_fenwick(benchmark):
+    from jcvi.algorithms.lis import heaviest_increasing_subsequence
+
+    a = make_data()
+    _, weight = benchmark(heaviest_increasing_subsequence, a)
+    assert weight > 0
+
+
+@pytest.mark.benchmark(
+    group="heaviest increasing subsequence", timer=time.time, warmup=False
+)
+def test_his_quadratic(benchmark):
+    a = make_data()
+    weight = benchmark.pedantic(
+        heaviest_increasing_subsequence_weight, args=(a,), rounds=1
+    )
+    assert weight > 0
+
+
+@pytest.mark.benchmark(group="longest monotonic subsequence", timer=time.time)
+def test_lms_numpy(benchmark):
+    import numpy as np
+
+    from jcvi.algorithms.lis import longest_monotonic_subseq_length
+
+    xs = np.random.RandomState(666).randint(0, 10000, size=10000)
+    score, diff = benchmark(longest_monotonic_subseq_length, xs)
+    assert (score, diff) == longest_monotonic_subseq_length(list(xs))
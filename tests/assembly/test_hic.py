@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import numpy as np
+
+
+def make_clm(tmp_path):
+    (tmp_path / "test.ids").write_text(
+        "#Contig\tRECounts\tLength\ntig1\t10\t30000\ntig2\t10\t20000\ntig3\t10\t50000\n"
+    )
+    rows = []
+    for a, b, dists in (("tig1", "tig2", [1000, 50000]), ("tig2", "tig3", [200000])):
+        for ao in "+-":
+            for bo in "+-":
+                d = " ".join(str(x + (ao == "-") * 7000) for x in dists)
+                rows.append("{}{} {}{}\t{}\t{}\n".format(a, ao, b, bo, len(dists), d))
+    (tmp_path / "test.clm").write_text("".join(rows))
+    return str(tmp_path / "test.clm")
+
+
+def test_clm_matrices(tmp_path):
+    from jcvi.assembly.hic import BB, CLMFile
+
+    clm = CLMFile(make_clm(tmp_path))
+    idx = clm.tig_to_idx
+    i1, i2, i3 = idx["tig1"], idx["tig2"], idx["tig3"]
+    M = clm.M.toarray()
+    assert M[i1, i2] == M[i2, i1] == 2
+    assert M[i2, i3] == 1 and M[i1, i3] == 0
+    assert clm.M is clm.M
+    assert clm.P.toarray().shape == (3, 3, 2)
+
+    clm.signs = np.ones(3, dtype=int)
+    Q = clm.Q
+    assert Q is clm.Q
+    assert Q.toarray(fill=-1)[i1, i3, 0] == -1
+    assert Q.toarray()[i1, i2].sum() == 2 and Q.data.shape == (4, BB)
+    clm.signs[i1] = -1
+    assert clm.Q is not Q
+
+    clm.active -= {"tig3"}
+    assert clm.N == 2 and clm.M.shape == (2, 2)
+    assert clm.M.toarray().sum() == 4
+
+
+def test_score_deltas(tmp_path):
+    from array import array
+
+    from jcvi.assembly.chic import (
+        score_delta_flip_Q,
+        score_delta_M,
+        score_delta_remove_M,
+        score_evaluate_M,
+        tour_layout,
+    )
+    from jcvi.assembly.hic import CLMFile
+
+    clm = CLMFile(make_clm(tmp_path))
+    clm.signs = np.array([1, -1, 1])
+    sizes, M = clm.active_sizes, clm.M
+    tour = array("i", [2, 0, 1])
+    (score,) = clm.evaluate_tour_Q(tour)
+    pos, sizes_cum = tour_layout(tour, sizes)
+    for t in tour:
+        delta = score_delta_flip_Q(t, pos, sizes_cum, clm.signs, clm.Q4)
+        clm.signs[t] *= -1
+        (flipped,) = clm.evaluate_tour_Q(tour)
+        clm.signs[t] *= -1
+        assert np.isclose(flipped - score, delta)
+
+    (score,) = score_evaluate_M(tour, sizes, M)
+    deltas = score_delta_remove_M(tour, sizes, M)
+    for i in range(3):
+        (removed,) = score_evaluate_M(tour[:i] + tour[i + 1 :], sizes, M)
+        assert np.isclose(score - removed, deltas[i])
+
+    moved = array("i", [0, 2, 1])
+    (after,) = score_evaluate_M(moved, sizes, M)
+    assert np.isclose(after - score, score_delta_M(moved, 0, 2, tour[:2], sizes, M))
+
+
+def test_shared_contacts(tmp_path):
+    import os.path as op
+
+    from array import array
+
+    from jcvi.assembly.chic import score_evaluate_M
+    from jcvi.assembly.hic import CLMFile, SharedContacts, score_evaluate_M_shared
+
+    clm = CLMFile(make_clm(tmp_path))
+    tour = array("i", [2, 0, 1])
+    shared = SharedContacts(clm.active_sizes, clm.M)
+    assert score_evaluate_M_shared(tour, spec=shared.spec) == score_evaluate_M(
+        tour, clm.active_sizes, clm.M
+    )
+    shared.close()
+    assert not op.exists(shared.dirname)
+
+
+def test_anneal_M(tmp_path):
+    from array import array
+    from itertools import permutations
+
+    from jcvi.assembly.chic import anneal_M, score_evaluate_M
+    from jcvi.assembly.hic import CLMFile
+
+    clm = CLMFile(make_clm(tmp_path))
+    sizes, M = clm.active_sizes, clm.M
+    best = max(
+        score_evaluate_M(array("i", x), sizes, M)[0] for x in permutations(range(3))
+    )
+    checkpoints = []
+    tour, score = anneal_M(
+        array("i", [1, 2, 0]),
+        sizes,
+        M,
+        restarts=2,
+        callback=lambda *args: checkpoints.append(args),
+    )
+    assert sorted(tour) == [0, 1, 2]
+    assert np.isclose(score, best) and score == score_evaluate_M(tour, sizes, M)[0]
+    assert checkpoints[-1][1:] == (1, 900, score)
+
+
+def test_bam2mat(tmp_path):
+    import pysam
+
+    from jcvi.assembly.hic import bam2mat, load_contacts
+
+    header = {"SQ": [{"SN": "chr1", "LN": 600}, {"SN": "chr2", "LN": 400}]}
+    bamfile = str(tmp_path / "test.bam")
+    reads = [  # flag, mapq, chr, pos, mate chr, mate pos
+        (0x41, 60, 0, 5, 1, 250),
+        (0x41, 60, 0, 50, 0, 330),
+        (0x41, 60, 1, 20, 1, 270),
+        (0x41, 60, 0, 50, 0, 60),  # Too close
+        (0x81, 60, 0, 5, 1, 250),  # Read2
+        (0x41, 0, 0, 5, 1, 250),  # Unmapped
+        (0xD41, 60, 0, 5, 1, 250),  # Secondary and supplementary
+    ]
+    with pysam.AlignmentFile(bamfile, "wb", header=header) as fw:
+        for i, (flag, mapq, atid, apos, btid, bpos) in enumerate(reads):
+            a = pysam.AlignedSegment()
+            a.query_name = "r{}".format(i)
+            a.query_sequence = "ACGT"
+            a.cigarstring = "4M"
+            a.flag, a.mapping_quality = flag, mapq
+            a.reference_id, a.reference_start = atid, apos
+            a.next_reference_id, a.next_reference_start = btid, bpos
+            fw.write(a)
+
+    bam2mat([bamfile, "--resolution=10", "--chunksize=2"])
+    A = load_contacts(str(tmp_path / "test.resolution_10.npz"))
+    assert A.shape == (102, 102) and A.dtype == int and A.sum() == 6
+    assert A[0, 86] == A[86, 0] == A[5, 33] == A[63, 88] == 1
+
+
+def test_contact_pyramid(tmp_path):
+    from scipy.sparse import random as sparse_random
+
+    from jcvi.assembly.hic import ContactPyramid, coarsen
+
+    A = sparse_random(50, 50, density=0.2, random_state=1, format="csr") * 10
+    A = A.astype(int)
+    P = ContactPyramid.build(A, str(tmp_path / "a.pyramid"), minbins=10)
+    assert P.zooms == [1, 2, 4, 8] and P.shape == (50, 50)
+    assert P.zoom_for(50, 20) == 4 and P.zoom_for(50, 1) == 8
+    assert (P.tile(10, 30, 1) == A[10:30, 10:30].toarray()).all()
+    A4 = coarsen(coarsen(A))
+    assert (P.tile(10, 30, 4, 0, 50) == A4[2:8].toarray()).all()
+    assert P.level(8).sum() == A.sum()
+
+    M = ContactPyramid.merge([P, P], str(tmp_path / "m.pyramid"))
+    assert (M.level(4) != 2 * A4).nnz == 0
+
+
+def test_clm_cache(tmp_path):
+    import os.path as op
+
+    from jcvi.assembly.hic import CLMFile
+
+    clmfile = make_clm(tmp_path)
+    clm = CLMFile(clmfile)
+    assert op.exists(clm.cachefile)
+    for other in (CLMFile(clmfile), CLMFile(clmfile, cache=False)):
+        for key in ("contacts", "orientations", "oriented"):
+            for x, y in zip(other.pairs[key], clm.pairs[key]):
+                assert (x == y).all()
+    cached = CLMFile(clmfile)
+    assert cached.contacts == clm.contacts
+    assert (cached.M != clm.M).nnz == 0
+
+
+def test_optimizeall(tmp_path, monkeypatch):
+    from jcvi.assembly.hic import optimizeall, tour_trajectory
+
+    monkeypatch.chdir(tmp_path)
+    make_clm(tmp_path)
+    (tmp_path / "groups.txt").write_text("test.clm\n")
+    optimizeall(["groups.txt", "--engine=anneal", "--cpus=1"])
+    rows = open("optimize.summary").readlines()
+    assert len(rows) == 2 and rows[1].split("\t")[5] == "done"
+    trajectory = tour_trajectory("test.tour")
+    assert sorted(trajectory) == ["SA1", "SA2"]
+    assert rows[1].split("\t")[6].startswith("SA1:")
+
+    # Finished partitions are skipped on a rerun
+    optimizeall(["groups.txt", "--cpus=1"])
+    assert open("optimize.summary").readlines() == rows
+
+    # A partition that dies leaves a partial tour file behind
+    (tmp_path / "bad.clm").write_text("")
+    (tmp_path / "bad.tour").write_text(">GA1-20-0.1\ntig1+ tig2+\n>GA1-40-0.")
+    optimizeall(["test.clm", "bad.clm", "--cpus=1"])
+    _, tourfile, ncontigs, _, _, status, trajectory = (
+        open("optimize.summary").readlines()[2].rstrip("\n").split("\t")
+    )
+    assert (tourfile, ncontigs, status) == ("bad.tour", "2", "failed(1)")
+    assert trajectory == "GA1:0.1>0.1"
+
+
+def test_simulate(tmp_path, monkeypatch):
+    from jcvi.assembly.hic import CLMFile, golden_array, simulate
+
+    monkeypatch.chdir(tmp_path)
+    simulate(["test", "--genomesize=2000000", "--contigs=10", "--seed=1"])
+    rows = [x.split("\t") for x in open("test.clm")]
+    assert len(rows) % 4 == 0
+    for row in rows:
+        dists = [int(x) for x in row[2].split()]
+        assert dists == sorted(dists) and len(dists) <= int(row[1])
+    clm = CLMFile("test.clm")
+    assert clm.N == 10 and clm.M.toarray().sum() > 0
+    assert golden_array([1000, 7349, 7350, 10**7]).tolist() == [2, 1] + [0] * 9 + [1]
@@ -12,3 +12,82 @@ def test_anchorfile():
     assert not anchor_file.is_empty
     assert len(list(anchor_file.iter_blocks())) == 3
     assert len(list(anchor_file.iter_pairs())) == 14
+
+
+def test_anchorfile_arrays(tmp_path):
+    import shutil
+
+    from jcvi.compara.base import AnchorFile
+
+    test_file = tmp_path / "test.anchors"
+    shutil.copy(op.join(op.dirname(__file__), "test.anchors"), test_file)
+    anchor_file = AnchorFile(str(test_file))
+    blocks = list(anchor_file.iter_blocks())
+    assert anchor_file.offsets.tolist() == [0, 4, 9, 14]
+    assert anchor_file.block_ids.tolist() == [0] * 4 + [1] * 5 + [2] * 5
+    assert anchor_file.blocks == blocks
+    assert [(a, b) for a, b, _ in anchor_file.iter_pairs()] == [
+        tuple(row[:2]) for block in blocks for row in block
+    ]
+
+    # The arrays are recompiled only after blocks is handed out or assigned
+    anchor_file.sync()
+    qi = anchor_file.qi
+    anchor_file.sync()
+    assert anchor_file.qi is qi
+    anchor_file.blocks[0].append(["geneA", "geneB", "100L"])
+    assert len(list(anchor_file.iter_pairs())) == 15
+    assert anchor_file.weights[4] == 100
+    # Same-size edits in place are picked up too
+    anchor_file.blocks[0][0] = ["geneC", "geneD", "7"]
+    assert next(anchor_file.iter_pairs())[:2] == ("geneC", "geneD")
+    assert anchor_file.weights[0] == 7
+
+    anchor_file = AnchorFile(str(test_file), minsize=5)
+    assert anchor_file.nblocks == 2
+    assert anchor_file.blocks == blocks[1:]
+
+    cached = AnchorFile(str(test_file), cache=True)
+    assert op.exists(cached.cachefile)
+    cached = AnchorFile(str(test_file), cache=True)
+    assert cached.blocks == blocks
+    assert (cached.qi == AnchorFile(str(test_file)).qi).all()
+
+
+def test_anchorfile_cache_unwritable(tmp_path, monkeypatch):
+    import shutil
+
+    import numpy as np
+
+    from jcvi.compara.base import AnchorFile
+
+    test_file = tmp_path / "test.anchors"
+    shutil.copy(op.join(op.dirname(__file__), "test.anchors"), test_file)
+
+    def savez(*args, **kwargs):
+        raise OSError("Read-only file system")
+
+    monkeypatch.setattr(np, "savez", savez)
+    anchor_file = AnchorFile(str(test_file), cache=True)
+    assert not op.exists(anchor_file.cachefile)
+    assert anchor_file.offsets.tolist() == [0, 4, 9, 14]
+
+
+def test_anchorfile_block_spans():
+    import pytest
+
+    from jcvi.compara.base import AnchorFile
+
+    anchor_file = AnchorFile(op.join(op.dirname(__file__), "test.anchors"))
+    genes = anchor_file.genes.tolist()
+    order = dict((x, (i, None)) for i, x in enumerate(genes))
+    qmin, qmax, smin, smax = anchor_file.block_spans(order, order)
+    for i, block in enumerate(anchor_file.blocks):
+        qranks = [genes.index(row[0]) for row in block]
+        sranks = [genes.index(row[1]) for row in block]
+        assert (qmin[i], qmax[i]) == (min(qranks), max(qranks))
+        assert (smin[i], smax[i]) == (min(sranks), max(sranks))
+
+    del order[anchor_file.blocks[1][0][1]]
+    with pytest.raises(KeyError):
+        anchor_file.block_spans(order, order)
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+from types import SimpleNamespace
+
+
+def make_hit(query, subject, qseqid, qi, sseqid, si, evalue=1e-20):
+    return SimpleNamespace(
+        query=query,
+        subject=subject,
+        qseqid=qseqid,
+        qi=qi,
+        sseqid=sseqid,
+        si=si,
+        evalue=evalue,
+    )
+
+
+def test_tandem_grouper():
+    from jcvi.compara.blastfilter import tandem_grouper
+
+    blast_list = [
+        # q1, q2, q4 all hit s1 and are close on chr1, chained through q2
+        make_hit("q1", "s1", "chr1", 1, "chrA", 0),
+        make_hit("q2", "s1", "chr1", 2, "chrA", 0),
+        make_hit("q4", "s1", "chr1", 4, "chrA", 0),
+        # q30 is too far away
+        make_hit("q30", "s1", "chr1", 30, "chrA", 0),
+        # q31 is adjacent in rank but on another chr
+        make_hit("q31", "s1", "chr2", 31, "chrA", 0),
+        # q30 and q31 are not linked through s2 either
+        make_hit("q30", "s2", "chr1", 30, "chrA", 1),
+        make_hit("q31", "s2", "chr2", 31, "chrA", 1),
+        # q4 and q6 joined via s3, merging into the first group
+        make_hit("q4", "s3", "chr1", 4, "chrA", 5),
+        make_hit("q6", "s3", "chr1", 6, "chrA", 5),
+        # weak hits are ignored
+        make_hit("q40", "s4", "chr1", 40, "chrA", 9, evalue=1),
+        make_hit("q41", "s4", "chr1", 41, "chrA", 9, evalue=1),
+    ]
+    qtandems = tandem_grouper(blast_list, tandem_Nmax=3, flip=True)
+    assert sorted(sorted(x) for x in qtandems) == [[1, 2, 4, 6]]
+
+    standems = tandem_grouper(blast_list, tandem_Nmax=3, flip=False)
+    assert sorted(sorted(x) for x in standems) == [[0, 1]]
+
+    assert len(tandem_grouper([], flip=True)) == 0
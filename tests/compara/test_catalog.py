@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+
+def touch(filename, wait_for=None):
+    """Create `filename`, requiring that `wait_for` already exists."""
+    import os.path as op
+
+    if wait_for:
+        assert op.exists(wait_for)
+    open(filename, "w").close()
+
+
+def fail():
+    raise ValueError("failed")
+
+
+def test_run_dag(tmp_path):
+    from jcvi.compara.catalog import run_dag
+
+    a, b, c, d = (str(tmp_path / x) for x in "abcd")
+    tasks = {
+        "a": (touch, (a,), set()),
+        "b": (touch, (b, a), {"a"}),
+        "c": (touch, (c, b), {"a", "b"}),
+        "x": (fail, (), set()),
+        "d": (touch, (d,), {"x"}),
+    }
+    failed = run_dag(tasks, cpus=2)
+    assert failed == {"x", "d"}
+    assert all((tmp_path / x).exists() for x in "abc")
+    assert not (tmp_path / "d").exists()
+
+
+def test_weights_graph(tmp_path):
+    from jcvi.compara.catalog import WeightsGraph
+
+    weightsfile = tmp_path / "a.b.weights"
+    weightsfile.write_text("a1\tb1\t90\na1\tb2\t9.5\nb1\ta1\t80\nc1\td1\t70\n")
+    graph = WeightsGraph([str(weightsfile)])
+    assert len(graph) == 5
+    assert list(graph.neighbors("a1")) == [("b1", 90), ("b2", 9.5)]
+    assert graph.weight("a1", "b1") == graph.weight("b1", "a1") == 80
+    assert graph.weight("b2", "a1") == 9.5
+    assert graph.weight("a1", "c1") == 0
+    assert graph.weight("a1", "missing") == 0
+    assert graph.components() == [["a1", "b1", "b2"], ["c1", "d1"]]
+
+
+def test_tandem_lowmem(tmp_path):
+    from jcvi.compara.catalog import tandem_main
+
+    genes = ["g{}".format(i) for i in range(6)]
+    bedfile = tmp_path / "a.bed"
+    bedfile.write_text(
+        "".join(
+            "chr1\t{0}\t{1}\t{2}\n".format(i * 100, i * 100 + 50, x)
+            for i, x in enumerate(genes)
+        )
+    )
+    cdsfile = tmp_path / "a.cds"
+    cdsfile.write_text("".join(">{0}.1\n{1}\n".format(x, "A" * 100) for x in genes))
+    (tmp_path / "a.cds.fai").write_text(
+        "".join("{0}.1\t100\t0\t100\t101\n".format(x) for x in genes)
+    )
+    blastfile = tmp_path / "a.blast"
+    rows = [("g0", "g1", 90, 1e-20), ("g1", "g2", 30, 1e-20), ("g3", "g5", 80, 1e-5)]
+    rows += [("g0", "g4", 80, 1e-20), ("g4", "g5", 80, 1)]
+    blastfile.write_text(
+        "".join(
+            "{0}.1\t{1}.1\t95\t{2}\t0\t0\t1\t{2}\t1\t{2}\t{3}\t100\n".format(*x)
+            for x in rows
+        )
+    )
+    args = [str(blastfile), str(cdsfile), str(bedfile)]
+    families = tandem_main(*args, ofile=str(tmp_path / "default.txt"))
+    assert families == [["g0", "g1"], ["g3", "g5"]]
+    lowmem = tandem_main(
+        *args, ofile=str(tmp_path / "lowmem.txt"), lowmem=True, chunksize=2
+    )
+    assert lowmem == sorted(families)
+    assert (tmp_path / "lowmem.txt").read_text() == "g0,g1\ng3,g5\n"
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import random
+import warnings
+
+import numpy as np
+import pytest
+
+
+def random_pair(rng, ncodons, rate):
+    """A random codon alignment that differs at most once per codon."""
+    from jcvi.compara.dnds import CODONS, STOP
+
+    sense = [c for c, stop in zip(CODONS, STOP) if not stop]
+    a, b = [], []
+    for _ in range(ncodons):
+        codon = rng.choice(sense)
+        other = codon
+        if rng.random() < rate:
+            pos = rng.randrange(3)
+            mutant = codon[:pos] + rng.choice("ACGT") + codon[pos + 1 :]
+            if mutant in sense:
+                other = mutant
+        a.append(codon)
+        b.append(other)
+    return "".join(a), "".join(b)
+
+
+@pytest.mark.parametrize("kappa", [1, 2.5])
+def test_ng86_biopython(kappa):
+    from Bio import BiopythonExperimentalWarning
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", BiopythonExperimentalWarning)
+        from Bio.codonalign.codonseq import CodonSeq, cal_dn_ds
+
+    from jcvi.compara.dnds import ng86
+
+    rng = random.Random(kappa)
+    pairs = [random_pair(rng, rng.randint(50, 200), 0.3) for _ in range(20)]
+    ds, dn = ng86(pairs, kappa=kappa)
+    for (a, b), s, n in zip(pairs, ds, dn):
+        expected_dn, expected_ds = cal_dn_ds(
+            CodonSeq(a), CodonSeq(b), method="NG86", k=kappa
+        )
+        assert s == pytest.approx(expected_ds)
+        assert n == pytest.approx(expected_dn)
+
+
+def test_ng86_gaps():
+    from jcvi.compara.dnds import ng86
+
+    ds, dn = ng86([("ATG---CTTGGGNNN", "ATGAAACTAGGG---"), ("", ""), ("TTT", "CCG")])
+    assert ds[0] == pytest.approx(0.7166, abs=1e-4) and dn[0] == 0
+    assert np.isnan(ds[1]) and np.isnan(dn[1])
+    assert np.isnan(ds[2])  # saturated
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import random
+import warnings
+
+from .test_dnds import random_pair
+
+
+def write_pairs(tmp_path, npairs=6):
+    """Adjacent CDS and protein records to compare, with one pair saturated."""
+    from Bio.Seq import Seq
+
+    rng = random.Random(1)
+    pairs = [random_pair(rng, rng.randint(30, 60), 0.2) for _ in range(npairs - 1)]
+    pairs.append(("TTTAAAGGG", "CCCGGGTTT"))
+    cds, pep = [], []
+    for i, pair in enumerate(pairs):
+        for j, seq in enumerate(pair):
+            name = "gene{}{}".format(i, "ab"[j])
+            cds.append(">{}\n{}\n".format(name, seq))
+            pep.append(">{}\n{}\n".format(name, Seq(seq).translate()))
+    (tmp_path / "test.cds").write_text("".join(cds))
+    (tmp_path / "test.pep").write_text("".join(pep))
+    return ["test.pep", "test.cds", "--engine=ng86"]
+
+
+def biopython_ng86(p_rec_1, p_rec_2, n_rec_1, n_rec_2):
+    """Reference row from Bio.codonalign's NG86 on the same codon alignment."""
+    from Bio import BiopythonExperimentalWarning
+    from Bio.Data.CodonTable import unambiguous_dna_by_id
+
+    from jcvi.compara.ks import align_codons
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", BiopythonExperimentalWarning)
+        from Bio.codonalign.codonseq import CodonSeq, cal_dn_ds
+
+    codon_table = unambiguous_dna_by_id[1]
+    a, b = align_codons((p_rec_1, p_rec_2), (n_rec_1, n_rec_2))
+    sa, sb = [], []
+    for i in range(0, len(a), 3):
+        ca, cb = a[i : i + 3], b[i : i + 3]
+        if ca in codon_table.forward_table and cb in codon_table.forward_table:
+            sa.append(ca)
+            sb.append(cb)
+    name = "{};{}".format(p_rec_1.name, p_rec_2.name)
+    try:
+        dn, ds = cal_dn_ds(CodonSeq("".join(sa)), CodonSeq("".join(sb)), method="NG86")
+    except (ValueError, ZeroDivisionError):
+        return "{},NA,NA,NA,NA".format(name)
+    return "{},NA,NA,{:.4f},{:.4f}".format(name, ds, dn)
+
+
+def test_calc_ng86(tmp_path, monkeypatch):
+    from Bio import SeqIO
+
+    from jcvi.compara.ks import KsLine, calc, fields
+
+    monkeypatch.chdir(tmp_path)
+    args = write_pairs(tmp_path)
+    calc(args + ["-o", "serial.ks"])
+    rows = open("serial.ks").read().splitlines()
+    assert rows[0] == fields and len(rows) == 7
+
+    peps = list(SeqIO.parse("test.pep", "fasta"))
+    cdss = list(SeqIO.parse("test.cds", "fasta"))
+    expected = [
+        biopython_ng86(*peps[i : i + 2], *cdss[i : i + 2])
+        for i in range(0, len(peps), 2)
+    ]
+    assert rows[1:-1] == expected[:-1]
+    # Biopython reports the saturated pair as -1, ng86_rows() writes NA, and
+    # KsLine reads both the same way
+    assert rows[-1].endswith(",NA,NA") and expected[-1].endswith(",-1.0000,-1.0000")
+    for row, ref in zip(rows[1:], expected):
+        a, b = KsLine(row), KsLine(ref)
+        assert (a.name, a.ng_ks, a.ng_ka) == (b.name, b.ng_ks, b.ng_ka)
+
+
+def test_calc_parallel(tmp_path, monkeypatch):
+    from jcvi.compara.ks import calc, fields
+
+    monkeypatch.chdir(tmp_path)
+    args = write_pairs(tmp_path)
+    calc(args + ["-o", "serial.ks"])
+    rows = open("serial.ks").read().splitlines()
+    assert rows[0] == fields and len(rows) == 7
+
+    calc(args + ["-o", "parallel.ks", "--cpus=2"])
+    assert open("parallel.ks").read().splitlines() == rows
+
+
+def test_calc_resume(tmp_path, monkeypatch):
+    from jcvi.compara.ks import calc
+
+    monkeypatch.chdir(tmp_path)
+    args = write_pairs(tmp_path)
+    calc(args + ["-o", "full.ks"])
+    rows = open("full.ks").read().splitlines()
+
+    (tmp_path / "partial.ks").write_text("\n".join(rows[:3]) + "\n")
+    calc(args + ["-o", "partial.ks", "--resume"])
+    assert open("partial.ks").read().splitlines() == rows
@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import numpy as np
+
+
+def test_make_arrays(tmp_path):
+    from math import log
+
+    from scipy.stats.distributions import poisson
+
+    from jcvi.compara.pad import count_arrays, make_arrays
+    from jcvi.formats.bed import Bed
+
+    qbedfile, sbedfile = tmp_path / "q.pad.bed", tmp_path / "s.pad.bed"
+    qbedfile.write_text("q1\t0\t1\tqa\nq1\t1\t2\tqb\nq2\t0\t1\tqc\n")
+    sbedfile.write_text("s1\t0\t1\tsa\ns2\t0\t1\tsb\ns2\t1\t2\tsc\n")
+    blastfile = tmp_path / "test.blast"
+    pairs = (("qa", "sa"), ("qa", "sb"), ("qb", "sb"), ("qc", "sc"))
+    blastfile.write_text(
+        "".join("\t".join((a, b) + ("0",) * 10) + "\n" for a, b in pairs)
+    )
+
+    args = (str(blastfile), Bed(str(qbedfile)), Bed(str(sbedfile)))
+    args += (["q1", "q2"], ["s1", "s2"])
+    observed, expected = count_arrays(*args)
+    logmp = make_arrays(*args)
+    # 4 dots over a 3 x 3 area, PADs of 2 and 1 genes on either side
+    assert (observed == [[1, 2], [0, 1]]).all()
+    assert np.allclose(expected, np.outer([2, 1], [1, 2]) * 4 / 9)
+    assert logmp.shape == (2, 2)
+    for i in range(2):
+        for j in range(2):
+            pois = poisson.pmf(observed[i, j], expected[i, j])
+            assert np.isclose(logmp[i, j], max(-log(pois), 0))
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import pytest
+
+
+@pytest.mark.parametrize(
+    "eclusters,depth,expected",
+    [
+        ([], 1, set()),
+        ([("1", 0, 10), ("1", 11, 20)], 1, set()),
+        ([("1", 0, 10), ("1", 10, 20)], 1, {(0, 1)}),
+        ([("1", 0, 10), ("2", 5, 15), ("1", 8, 20)], 1, {(0, 2)}),
+        (
+            [("1", 0, 10), ("1", 5, 15), ("1", 8, 20), ("1", 12, 30)],
+            1,
+            {(0, 1, 2), (1, 2, 3)},
+        ),
+        (
+            [("1", 0, 10), ("1", 5, 15), ("1", 8, 20), ("1", 12, 30)],
+            2,
+            {(0, 1, 2), (1, 2, 3)},
+        ),
+        ([("1", 0, 10), ("1", 5, 15), ("1", 12, 30)], 2, set()),
+    ],
+)
+def test_get_1D_overlap(eclusters, depth, expected):
+    from jcvi.compara.quota import get_1D_overlap
+
+    assert get_1D_overlap(eclusters, depth) == expected
+
+
+def test_get_components():
+    from jcvi.compara.quota import get_components
+
+    nodes = [4, 2, 3, 1, 5]
+    constraints_x = {(0, 1), (1, 2)}
+    constraints_y = {(3,)}
+    components = get_components(nodes, constraints_x, 1, constraints_y, 2)
+    components = sorted(
+        (ids, obj_coeffs, sorted(constraints), bounds)
+        for ids, obj_coeffs, constraints, bounds in components
+    )
+    assert components == [
+        ([0, 1, 2], [4, 2, 3], [(0, 1), (1, 2)], [1, 1]),
+        ([3], [1], [(0,)], [2]),
+        ([4], [5], [], []),
+    ]
+
+
+def make_clusters():
+    def make_cluster(xchr, xstart, ychr, ystart, size):
+        return [((xchr, xstart + i), (ychr, ystart + i), 1) for i in range(size)]
+
+    return [
+        make_cluster("x1", 0, "y1", 0, 10),
+        make_cluster("x1", 5, "y2", 0, 6),  # overlaps block 0 on x
+        make_cluster("x1", 100, "y1", 100, 3),
+        make_cluster("x2", 0, "y1", 102, 5),  # overlaps block 2 on y
+        make_cluster("x3", 0, "y3", 0, 4),
+    ]
+
+
+@pytest.mark.parametrize("cpus,warm_start", [(1, False), (2, True)])
+def test_solve_lp(cpus, warm_start):
+    from jcvi.compara.quota import solve_lp
+
+    selected = solve_lp(make_clusters(), (1, 1), cpus=cpus, warm_start=warm_start)
+    assert selected == [0, 3, 4]
+
+
+def test_solve_lp_work_dir(monkeypatch):
+    import os.path as op
+
+    from jcvi.algorithms.lpsolve import MIPDataModel
+    from jcvi.compara.quota import solve_lp
+
+    work_dirs = []
+    solve = MIPDataModel.solve
+
+    def record(self, work_dir="work", verbose=False):
+        work_dirs.append(op.dirname(work_dir))
+        return solve(self, work_dir=work_dir, verbose=verbose)
+
+    monkeypatch.setattr(MIPDataModel, "solve", record)
+    clusters = make_clusters()
+    # Block 5 overlaps block 1 on y, so blocks 0, 1 and 5 need the MIP
+    clusters.append([(("x4", i), ("y2", 3 + i), 1) for i in range(6)])
+    # Each solve gets a scratch directory of its own, removed afterwards
+    for _ in range(2):
+        assert solve_lp(clusters, (1, 1)) == [0, 3, 4, 5]
+    assert len(work_dirs) == 2 and len(set(work_dirs)) == 2
+    assert not any(op.exists(x) for x in work_dirs)
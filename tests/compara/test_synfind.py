@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import os.path as op
+import random
+
+from bisect import bisect_left
+from types import SimpleNamespace
+
+
+def test_scan_seqid():
+    from jcvi.compara.synfind import find_synteny_region, scan_seqid
+
+    random.seed(42)
+    sbed = [SimpleNamespace(seqid="s{}".format(i // 150)) for i in range(300)]
+    sseqids = [x.seqid for x in sbed]
+    all_data = set()
+    for x in range(200):
+        all_data.add((x, (x + random.randint(-3, 3)) % 300))
+        all_data.add((x, random.randrange(300)))
+    all_data = sorted(all_data)
+    ranks = list(range(20, 180))
+    window, cutoff = 10, 2
+
+    expected = []
+    for r in ranks:
+        rmin = max(r - window, ranks[0])
+        rmax = min(r + window + 1, ranks[-1])
+        data = all_data[
+            bisect_left(all_data, (rmin, 0)) : bisect_left(all_data, (rmax, 0))
+        ]
+        regions = find_synteny_region(r, sbed, data, window, cutoff, colinear=True)
+        if regions:
+            expected.append((r, regions))
+
+    start = bisect_left(all_data, (ranks[0], 0))
+    end = bisect_left(all_data, (ranks[-1] + 1, 0))
+    data = all_data[start:end]
+    assert scan_seqid((ranks, data, sseqids, window, cutoff, True)) == expected
+
+
+def test_synteny_writers(tmp_path):
+    import sqlite3
+
+    import pytest
+
+    from jcvi.compara.synfind import SyntenyDB, SyntenyShards, SyntenyWriter
+
+    # flush() is abstract, the base class only buffers
+    with pytest.raises(TypeError):
+        SyntenyWriter()
+
+    rows = [
+        ["q{}".format(i), "s{}".format(i), "S", i, 10000, "+", "a", "b"]
+        for i in range(25)
+    ]
+
+    dbfile = str(tmp_path / "synteny.db")
+    db = SyntenyDB(dbfile, batch_size=10)
+    for row in rows:
+        db.write(row)
+    db.close()
+    conn = sqlite3.connect(dbfile)
+    assert conn.execute("select count(*) from synteny").fetchone() == (25,)
+    assert conn.execute("pragma journal_mode").fetchone() == ("wal",)
+    conn.close()
+
+    outdir = str(tmp_path / "shards")
+    shards = SyntenyShards(outdir, batch_size=10)
+    for row in rows:
+        shards.write(row)
+    shards.close()
+    assert shards.nshards == 3
+    lines = open(op.join(outdir, "synteny.00002.tsv")).readlines()
+    assert lines[0].split() == [
+        "query",
+        "anchor",
+        "gray",
+        "score",
+        "dr",
+        "orientation",
+        "qnote",
+        "snote",
+    ]
+    assert len(lines) == 6
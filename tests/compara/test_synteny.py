@@ -38,3 +38,25 @@ def test_get_bed_filenames(hintfile, bed_filenames):
     opts = SimpleNamespace()
     opts.qbed, opts.sbed = None, None
     assert get_bed_filenames(hintfile, None, opts) == bed_filenames
+
+
+def test_screen_empty_blocks(tmp_path):
+    import os.path as op
+
+    from jcvi.compara.synteny import screen
+
+    inputs = op.join(op.dirname(__file__), "synteny.py", "inputs")
+    beds = [
+        "--qbed=" + op.join(inputs, "test_empty_blocks.a.bed"),
+        "--sbed=" + op.join(inputs, "test_empty_blocks.b.bed"),
+    ]
+    anchors = open(op.join(inputs, "test_empty_blocks.anchors")).read()
+    blocks = anchors.split("###\n")
+    padded = tmp_path / "padded.anchors"
+    padded.write_text("###\n".join(blocks[:3] + ["", ""] + blocks[3:]))
+
+    screen([op.join(inputs, "test_empty_blocks.anchors"), str(tmp_path / "a")] + beds)
+    screen([str(padded), str(tmp_path / "b")] + beds)
+    screen([str(padded), str(tmp_path / "c"), "--minspan=2"] + beds)
+    assert (tmp_path / "a").read_text() == (tmp_path / "b").read_text()
+    assert (tmp_path / "c").read_text().count("###") == 5
@@ -12,3 +12,15 @@ def test_grouper():
     assert not g.joined("a", "d")
     del g["b"]
     assert list(g) == [["a", "c"], ["d", "e"]]
+
+
+def test_union_find():
+    from jcvi.utils.grouper import UnionFind
+
+    uf = UnionFind(3)
+    uf.union([0], [2])
+    uf.resize(5)
+    uf.union([4, 3], [3, 2])
+    assert [x.tolist() for x in uf] == [[0, 2, 3, 4], [1]]
+    assert uf.joined(0, 4)
+    assert not uf.joined(0, 1)
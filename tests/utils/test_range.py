@@ -212,4 +212,31 @@ def test_range_conflict(ranges, expected):
 def test_range_chain(ranges, expected):
     from jcvi.utils.range import range_chain
 
-    assert range_chain(ranges) == expected
\ No newline at end of file
+    assert range_chain(ranges) == expected
+
+
+def test_range_chain_tracks():
+    from jcvi.utils.range import Range, range_chain, range_chain_tracks
+
+    ranges = [
+        Range("1", 0, 9, 22, 0),
+        Range("1", 3, 18, 24, 1),
+        Range("1", 10, 28, 20, 2),
+        Range("1", 40, 50, 5, 3),
+        Range("2", 0, 10, 7, 3),  # same block on another seqid
+        Range("2", 5, 15, 8, 4),
+    ]
+    expected = []
+    remaining = ranges[:]
+    while remaining:
+        selected, score = range_chain(remaining)
+        expected.append((selected, score))
+        selected = set(x.id for x in selected)
+        remaining = [x for x in remaining if x.id not in selected]
+
+    assert list(range_chain_tracks(ranges)) == expected
+    assert [[x.id for x in selected] for selected, _ in expected] == [
+        [0, 2, 3, 4],
+        [1],
+    ]
+    assert list(range_chain_tracks([])) == []